@@ -0,0 +1,122 @@
+import asyncio
+import sys
+import time
+from quart import Quart, Response, g, jsonify, render_template, request
+from quart_cors import cors
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+from async_auth_routes import async_auth_bp
+from audit_events import AsyncAuditLog
+from auth_scripts import AsyncAuthScripts
+from circuit_breaker import concurrency_limiters
+from password_hasher import PasswordHasher
+from mail_queue import AsyncMailQueue
+from main import load_config, check_config, check_redis
+from metrics import metrics
+from structured_logging import setup_logging
+from session_tokens import AsyncTokenService
+from user_lookup import lookup_config
+from user_store import user_store_backend
+from redis_factory import create_async_redis_client, is_cluster
+from redis_keys import key_builder
+from request_profiler import ADMIN_HEADER, RequestProfiler
+
+
+def create_async_app(config):
+    """asyncio模式的应用工厂，接口和返回的JSON与同步模式一致"""
+    setup_logging(config.get('logging', {}))
+    app = cors(Quart(__name__))
+    metrics.configure(config.get('metrics', {}))
+
+    redis_client = create_async_redis_client(config['redis'])
+    app.extensions['redis_client'] = redis_client
+    app.extensions['user_store'] = AsyncAuthScripts(redis_client, config.get('rate_limit', {}),
+                                                    config['redis'].get('id_block_size', 100),
+                                                    config.get('user_storage', {}).get('format', 'standard'),
+                                                    key_builder(config['redis']))
+    app.extensions['password_hasher'] = PasswordHasher(config.get('password', {}))
+    app.extensions['mail_queue'] = AsyncMailQueue(redis_client)
+    app.extensions['lookup_config'] = lookup_config(config.get('lookup'))
+    app.extensions['concurrency_limits'] = concurrency_limiters(config.get('concurrency_limits'))
+    audit_log = AsyncAuditLog(redis_client, config.get('audit'))
+    app.extensions['audit_log'] = audit_log
+    app.extensions['token_service'] = AsyncTokenService(config.get('tokens', {}), redis_client)
+    profiling_config = config.get('profiling', {})
+    profiler = RequestProfiler(profiling_config) if profiling_config.get('enabled') else None
+    app.extensions['profiler'] = profiler
+
+    app.register_blueprint(async_auth_bp)
+
+    @app.before_request
+    async def start_timer():
+        g.request_started = time.perf_counter()
+        if profiler is not None:
+            # 事件循环中多个请求交替执行，cProfile 无法区分，asyncio模式只记录慢请求
+            g.request_trace = profiler.begin(allow_profile=False)
+
+    @app.after_request
+    async def record_request(response):
+        started = getattr(g, 'request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            trace = g.pop('request_trace', None)
+            if trace is not None:
+                profiler.finish(trace, request.method, route, response.status_code)
+            metrics.inc('aurora_http_requests_total', route=route, status=response.status_code)
+            duration = time.perf_counter() - started
+            metrics.observe('aurora_http_request_duration_seconds', duration, route=route)
+            app.logger.info("请求完成", extra={
+                'event': 'http.request', 'route': route, 'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2)
+            })
+        return response
+
+    @app.route('/')
+    async def index():
+        return await render_template('index.html')
+
+    @app.route('/metrics')
+    async def metrics_endpoint():
+        """合并本进程的实时计数和其他进程写入的文件，其他worker的数据最多滞后 metrics.flush_interval 秒"""
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/debug/slow_requests')
+    async def slow_requests():
+        if profiler is None:
+            return jsonify({'success': False, 'message': '未开启请求分析'}), 404
+        if not profiler.is_admin(request.headers.get(ADMIN_HEADER)):
+            return jsonify({'success': False, 'message': '无权访问'}), 403
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({'success': True, 'data': profiler.worst(limit)})
+
+    @app.before_serving
+    async def start_audit_log():
+        audit_log.start()
+
+    @app.after_serving
+    async def close_redis():
+        await audit_log.close_async()
+        await redis_client.close()
+        if not is_cluster(redis_client):
+            await redis_client.connection_pool.disconnect()
+
+    return app
+
+
+def main():
+    config = load_config()
+    check_config(config)
+    if user_store_backend(config) != 'redis':
+        print("asyncio模式只支持 user_storage.backend 为 redis")
+        sys.exit(1)
+    check_redis(config)
+
+    app_config = config['app']
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = [f"{app_config.get('host', '0.0.0.0')}:{app_config.get('port', 5000)}"]
+    hypercorn_config.backlog = app_config.get('backlog', 1024)
+    asyncio.run(serve(create_async_app(config), hypercorn_config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+from quart import Blueprint, Response, request, current_app
+import functools
+from redis import RedisError
+import auth_handlers as handlers
+from metrics import metrics
+from auth_handlers import REDIS_ERRORS, generate_complex_password, generate_verification_code
+from user_lookup import iter_lookup_async
+
+# 请求解析、校验和响应构造在 auth_handlers 中，与 auth_routes 共用，这里只做异步的I/O调用
+async_auth_bp = Blueprint('async_auth', __name__)
+
+def get_mail_queue():
+    return current_app.extensions.get('mail_queue')
+
+def get_redis_client():
+    return current_app.extensions['redis_client']
+
+def get_user_store():
+    return current_app.extensions['user_store']
+
+def get_password_hasher():
+    return current_app.extensions['password_hasher']
+
+def get_token_service():
+    return current_app.extensions['token_service']
+
+def audit(event, **fields):
+    audit_log = current_app.extensions.get('audit_log')
+    if audit_log is not None:
+        audit_log.emit(event, ip=request.remote_addr, **fields)
+
+def limit_concurrency(name):
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            limiter = current_app.extensions['concurrency_limits'].get(name)
+            if limiter is None:
+                return await view(*args, **kwargs)
+            if not limiter.try_acquire():
+                return handlers.overloaded(name)
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                limiter.release()
+        return wrapper
+    return decorator
+
+
+@async_auth_bp.route('/send_verification_code', methods=['POST'])
+@limit_concurrency('send_verification_code')
+async def send_verification_code():
+    try:
+        mail_queue = get_mail_queue()
+        if mail_queue is None:
+            return handlers.failure('邮件服务未初始化', 500)
+
+        email, error = handlers.parse_send_code(await request.get_json(force=True, silent=True))
+        if error:
+            return error
+
+        # 限流、冷却期合并与验证码存储在同一个脚本中原子完成
+        try:
+            with metrics.stage('send_verification_code.script'):
+                status, result = await get_user_store().send_verification_code(
+                    email, request.remote_addr, generate_verification_code()
+                )
+        except RedisError as e:
+            return handlers.send_code_store_failed(e, email)
+
+        reply = handlers.send_code_limited(status, result, email, request.remote_addr, audit)
+        if reply:
+            return reply
+        with metrics.stage('send_verification_code.enqueue'):
+            # SMTP发送由独立的邮件worker完成，事件循环只负责入队
+            enqueued = await mail_queue.enqueue_verification(email, result)
+        return handlers.send_code_enqueued(enqueued, email, audit)
+
+    except Exception as e:
+        return handlers.send_code_error(e)
+
+@async_auth_bp.route('/login', methods=['POST'])
+@limit_concurrency('login')
+async def login():
+    try:
+        if not request.is_json:
+            return handlers.login_not_json(request.content_type)
+        data = await request.get_json(silent=True)
+        if not data or not isinstance(data, dict):
+            return handlers.login_bad_json(await request.get_data())
+
+        email, password, code, error = handlers.parse_login(data)
+        if error:
+            return error
+
+        user_store = get_user_store()
+        password_hasher = get_password_hasher()
+        token_service = get_token_service()
+
+        if code:
+            try:
+                username = handlers.username_from_email(email)
+                # 校验验证码、清理验证码以及新用户注册在同一个脚本中原子完成
+                with metrics.stage('login.code_script'):
+                    status, user_info = await user_store.login_with_code(email, code, username)
+
+                if status == 'needs_password':
+                    # 仅在确实需要注册时才计算初始密码的哈希
+                    system_password = generate_complex_password(12)
+                    with metrics.stage('login.hash'):
+                        password_hash = await password_hasher.hash_async(system_password)
+                    with metrics.stage('login.register_script'):
+                        status, user_info = await user_store.login_with_code(
+                            email, code, username, password_hash, password_hasher.scheme
+                        )
+
+                if status == 'registered':
+                    with metrics.stage('login.enqueue_welcome'):
+                        enqueued = await get_mail_queue().enqueue_welcome(email, system_password)
+                    return handlers.registered(enqueued, user_info, email, audit, token_service)
+                return handlers.code_login_result(status, user_info, email, audit, token_service)
+
+            except (RedisError, AttributeError, UnicodeEncodeError) as e:
+                return handlers.user_init_failed(e)
+
+        if password:
+            try:
+                with metrics.stage('login.get_credentials'):
+                    credentials = await user_store.get_credentials(email)
+            except RedisError as e:
+                return handlers.credentials_failed(e)
+
+            if credentials is None:
+                return handlers.password_login_failed('unknown_user', email, audit)
+
+            stored_hash = credentials['password'] or ''
+            with metrics.stage('login.verify'):
+                verified = await password_hasher.verify_async(password, stored_hash, email)
+            if not verified:
+                return handlers.password_login_failed('bad_password', email, audit)
+
+            if password_hasher.needs_rehash(stored_hash):
+                # 旧的MD5或参数过时的哈希在登录成功后透明升级
+                try:
+                    with metrics.stage('login.rehash'):
+                        await user_store.update_password(
+                            email, stored_hash, await password_hasher.hash_async(password), password_hasher.scheme
+                        )
+                except RedisError as e:
+                    handlers.rehash_failed(e, email)
+
+            return handlers.password_login_succeeded(credentials, email, audit, token_service)
+
+        return handlers.login_missing_credentials(data)
+
+    except Exception as e:
+        return handlers.login_error(e)
+
+@async_auth_bp.route('/change_password', methods=['POST'])
+async def change_password():
+    try:
+        email, old_password, new_password, error = handlers.parse_change_password(await request.get_json(silent=True))
+        if error:
+            return error
+
+        user_store = get_user_store()
+        password_hasher = get_password_hasher()
+        credentials = await user_store.get_credentials(email)
+        if credentials is None:
+            return handlers.change_password_failed('unknown_user', email, audit)
+
+        stored_password = credentials['password'] or ''
+        with metrics.stage('change_password.verify'):
+            verified = await password_hasher.verify_async(old_password, stored_password, email)
+        if not verified:
+            return handlers.change_password_failed('bad_password', email, audit)
+
+        with metrics.stage('change_password.hash'):
+            hashed_new_password = await password_hasher.hash_async(new_password)
+        if not await user_store.update_password(email, stored_password, hashed_new_password,
+                                                password_hasher.scheme):
+            return handlers.change_password_failed('conflict', email, audit)
+        return handlers.password_changed(credentials, email, audit)
+
+    except Exception as e:
+        return handlers.change_password_error(e)
+
+@async_auth_bp.route('/verify_token', methods=['POST'])
+async def verify_token():
+    token = handlers.get_request_token(request.headers.get('Authorization'),
+                                      await request.get_json(silent=True))
+    if not token:
+        return handlers.missing_token()
+
+    status, claims = await get_token_service().verify_async(token)
+    if status != 'valid':
+        return handlers.token_invalid(status)
+    return handlers.token_verified(claims)
+
+@async_auth_bp.route('/revoke_token', methods=['POST'])
+async def revoke_token():
+    token = handlers.get_request_token(request.headers.get('Authorization'),
+                                      await request.get_json(silent=True))
+    status, claims = await get_token_service().verify_async(token) if token else ('malformed', None)
+    if status != 'valid':
+        return handlers.token_invalid(status)
+    try:
+        await get_token_service().revoke_async(claims)
+    except REDIS_ERRORS as e:
+        return handlers.redis_unavailable(e)
+    return handlers.token_revoked()
+
+@async_auth_bp.route('/users/lookup', methods=['POST'])
+async def lookup_users():
+    config = current_app.extensions['lookup_config']
+    by, identifiers, stream, error = handlers.parse_lookup(config, request.headers.get('X-API-Key'),
+                                                           await request.get_json(silent=True))
+    if error:
+        return error
+
+    results = iter_lookup_async(get_user_store(), identifiers, by, config['batch_size'])
+    if stream:
+        async def generate():
+            async for query, user in results:
+                yield handlers.lookup_line(query, user).encode('utf-8')
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    try:
+        return handlers.lookup_results([item async for item in results])
+    except REDIS_ERRORS as e:
+        return handlers.redis_unavailable(e)
@@ -0,0 +1,166 @@
+import argparse
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from redis import RedisError
+from redis.exceptions import ResponseError
+from clear_account import load_redis_client
+from redis_keys import AUDIT_STREAM_KEY, audit_counts_key
+
+DEFAULT_GROUP = 'audit-aggregator'
+MINUTE_FORMAT = '%Y%m%d%H%M'
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def ensure_group(redis_client, group, from_start):
+    """创建消费组，已存在时沿用原有的消费进度"""
+    try:
+        redis_client.xgroup_create(AUDIT_STREAM_KEY, group, id='0' if from_start else '$', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def entry_minute(entry_id, fields):
+    """按事件产生时间归入UTC分钟，缺少 ts 字段时使用Stream ID中的毫秒时间"""
+    ts = fields.get('ts') or entry_id.split('-')[0]
+    return datetime.fromtimestamp(int(ts) / 1000, timezone.utc).strftime(MINUTE_FORMAT)
+
+
+def aggregate(entries):
+    """返回 {(分钟, 计数字段): 次数}，带 reason 的事件额外按 事件:原因 计数"""
+    counts = Counter()
+    for entry_id, fields in entries:
+        if not fields:
+            # 已被 MAXLEN 裁剪的待处理条目只剩ID，直接确认
+            continue
+        fields = {_to_str(k): _to_str(v) for k, v in fields.items()}
+        event = fields.get('event', 'unknown')
+        minute = entry_minute(entry_id, fields)
+        counts[(minute, event)] += 1
+        if fields.get('reason'):
+            counts[(minute, f"{event}:{fields['reason']}")] += 1
+    return counts
+
+
+def apply_batch(redis_client, group, entries, retention):
+    """计数和确认在同一个管道中提交；提交前进程退出时条目留在待处理列表中，重新处理可能重复计数"""
+    entries = [(_to_str(entry_id), fields) for entry_id, fields in entries]
+    counts = aggregate(entries)
+    pipe = redis_client.pipeline(transaction=False)
+    for (minute, field), count in counts.items():
+        pipe.hincrby(audit_counts_key(minute), field, count)
+    for minute in {minute for minute, _ in counts}:
+        pipe.expire(audit_counts_key(minute), retention)
+    pipe.xack(AUDIT_STREAM_KEY, group, *[entry_id for entry_id, _ in entries])
+    pipe.execute()
+    return len(entries)
+
+
+def _stream_entries(response):
+    # RESP2 返回 [[stream, entries]]，RESP3 返回 {stream: [entries]}
+    if isinstance(response, dict):
+        return [entry for streams in response.values() for entries in streams for entry in entries]
+    return [entry for _, entries in response or [] for entry in entries]
+
+
+def drain_pending(redis_client, group, consumer, count, retention):
+    """先处理本消费者上次退出时未确认的条目"""
+    total = 0
+    while True:
+        entries = _stream_entries(redis_client.xreadgroup(group, consumer, {AUDIT_STREAM_KEY: '0'}, count=count))
+        if not entries:
+            return total
+        total += apply_batch(redis_client, group, entries, retention)
+
+
+def claim_idle(redis_client, group, consumer, count, min_idle_ms, retention):
+    """接管其他消费者超过 min_idle_ms 仍未确认的条目，例如已经退出的实例"""
+    total = 0
+    start = '0-0'
+    while True:
+        response = redis_client.xautoclaim(AUDIT_STREAM_KEY, group, consumer, min_idle_ms,
+                                           start_id=start, count=count)
+        start, entries = _to_str(response[0]), response[1]
+        if entries:
+            total += apply_batch(redis_client, group, entries, retention)
+        if start == '0-0':
+            return total
+
+
+def run(redis_client, args):
+    ensure_group(redis_client, args.group, args.from_start)
+    retention = args.retention * 3600
+    processed = drain_pending(redis_client, args.group, args.consumer, args.count, retention)
+    print(f"已处理上次遗留的 {processed} 条事件", file=sys.stderr)
+
+    last_claim = 0.0
+    while True:
+        if args.claim_idle and time.monotonic() - last_claim >= args.claim_idle:
+            last_claim = time.monotonic()
+            claimed = claim_idle(redis_client, args.group, args.consumer, args.count,
+                                 args.claim_idle * 1000, retention)
+            if claimed:
+                print(f"接管了 {claimed} 条其他消费者未确认的事件", file=sys.stderr)
+        try:
+            response = redis_client.xreadgroup(args.group, args.consumer, {AUDIT_STREAM_KEY: '>'},
+                                               count=args.count, block=args.block)
+        except RedisError as e:
+            print(f"读取事件失败: {e}，稍后重试", file=sys.stderr)
+            time.sleep(1)
+            continue
+        entries = _stream_entries(response)
+        if entries:
+            apply_batch(redis_client, args.group, entries, retention)
+
+
+def report(redis_client, minutes):
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    keys = [(now - timedelta(minutes=offset)).strftime(MINUTE_FORMAT) for offset in range(minutes - 1, -1, -1)]
+    pipe = redis_client.pipeline(transaction=False)
+    for minute in keys:
+        pipe.hgetall(audit_counts_key(minute))
+    for minute, counts in zip(keys, pipe.execute()):
+        if not counts:
+            continue
+        counts = {_to_str(k): int(v) for k, v in counts.items()}
+        print(f"{minute[:8]} {minute[8:10]}:{minute[10:]} UTC")
+        for field in sorted(counts):
+            print(f"  {field:<40} {counts[field]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AuroraID 审计事件消费者，按分钟聚合事件计数')
+    parser.add_argument('--config', default='./config.yml', help='配置文件路径')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='以消费组方式持续读取事件并写入分钟计数')
+    run_parser.add_argument('--group', default=DEFAULT_GROUP, help='消费组名称')
+    run_parser.add_argument('--consumer', default='default', help='消费者标识，同一组内多个实例需各不相同')
+    run_parser.add_argument('--count', type=int, default=500, help='每次读取的最大条目数')
+    run_parser.add_argument('--block', type=int, default=2000, help='没有新事件时阻塞等待的毫秒数')
+    run_parser.add_argument('--from-start', action='store_true', help='新建消费组时从Stream开头读取，默认只读新事件')
+    run_parser.add_argument('--claim-idle', type=int, default=0,
+                            help='接管其他消费者超过指定秒数未确认的事件，0 表示不接管')
+    run_parser.add_argument('--retention', type=int, default=24 * 7, help='分钟计数保留的小时数')
+
+    report_parser = subparsers.add_parser('report', help='打印最近几分钟的事件计数')
+    report_parser.add_argument('--minutes', type=int, default=15)
+
+    args = parser.parse_args()
+    redis_client = load_redis_client(args.config)
+    if args.command == 'run':
+        try:
+            run(redis_client, args)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'report':
+        report(redis_client, args.minutes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import asyncio
+import atexit
+import hashlib
+import hmac
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import deque
+from metrics import metrics
+from redis_keys import AUDIT_STREAM_KEY
+from structured_logging import mask_email
+
+DEFAULT_AUDIT = {
+    'enabled': True,
+    # Stream的大致长度上限，XADD MAXLEN ~ 按整个宏节点裁剪，开销很小
+    'max_len': 1000000,
+    'flush_interval': 1.0,
+    'batch_size': 500,
+    # 缓冲区上限，Redis不可用时超出的事件被丢弃并计数，不阻塞请求
+    'buffer_size': 10000,
+    # 为空时邮箱只保留首字母和域名、IP只保留网段；配置后改为写入带密钥的哈希，同一用户或IP的事件仍可关联
+    'hash_key': ''
+}
+
+# 写入Stream之前需要脱敏的字段
+IDENTITY_FIELDS = ('email', 'ip')
+
+logger = logging.getLogger('aurora.audit')
+
+
+def audit_config(config):
+    merged = dict(DEFAULT_AUDIT)
+    merged.update(config or {})
+    return merged
+
+
+def mask_ip(ip):
+    """IPv4 保留 /24，IPv6 保留 /48"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return '***'
+    prefix = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+def _redact(hash_key, name, value):
+    if hash_key:
+        digest = hmac.new(hash_key.encode('utf-8'), f"{name}:{value}".encode('utf-8'), hashlib.sha256)
+        return digest.hexdigest()[:32]
+    return mask_email(value) if name == 'email' else mask_ip(value)
+
+
+def _entry(event, fields, hash_key=''):
+    entry = {'event': event, 'ts': int(time.time() * 1000)}
+    for name, value in fields.items():
+        if value is not None:
+            value = str(value)
+            entry[name] = _redact(hash_key, name, value) if name in IDENTITY_FIELDS else value
+    return entry
+
+
+class AuditLog:
+    """登录、注册等审计事件先追加到进程内缓冲区，请求线程不访问Redis
+
+    后台线程每隔 flush_interval 秒或缓冲区达到 batch_size 时，用一个管道批量 XADD 到限长的Stream；
+    进程被直接终止时最后一个间隔内的事件会丢失。邮箱和IP在进入缓冲区之前脱敏，Stream中不保存明文
+    """
+
+    def __init__(self, redis_client, config=None):
+        config = audit_config(config)
+        self.redis_client = redis_client
+        self.enabled = config['enabled']
+        self.max_len = config['max_len']
+        self.flush_interval = config['flush_interval']
+        self.batch_size = config['batch_size']
+        self.buffer_size = config['buffer_size']
+        self.hash_key = config['hash_key']
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher_pid = None
+        self._failing = False
+        atexit.register(self.close)
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        entry = _entry(event, fields, self.hash_key)
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                self._start_flusher()
+            if len(self._buffer) >= self.buffer_size:
+                entry = None
+            else:
+                self._buffer.append(entry)
+            size = len(self._buffer)
+        if entry is None:
+            metrics.inc('aurora_audit_events_total', result='dropped')
+            return
+        if size >= self.batch_size:
+            self._notify()
+
+    def _start_flusher(self):
+        # prefork 之后线程不会被继承，按pid判断是否需要在当前进程启动刷新线程
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _notify(self):
+        self._wakeup.set()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception:
+                self._report_failure()
+
+    def _take_batch(self):
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(len(self._buffer), self.batch_size))]
+
+    def _pipeline(self, batch):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for entry in batch:
+            pipe.xadd(AUDIT_STREAM_KEY, entry, maxlen=self.max_len, approximate=True)
+        return pipe
+
+    def _requeue(self, batch):
+        """写入失败的事件放回缓冲区头部，保持原有顺序，放不下的部分丢弃"""
+        with self._lock:
+            keep = batch[:max(self.buffer_size - len(self._buffer), 0)]
+            self._buffer.extendleft(reversed(keep))
+        if len(batch) > len(keep):
+            metrics.inc('aurora_audit_events_total', len(batch) - len(keep), result='dropped')
+
+    def _finish(self, batch, results):
+        failed = [entry for entry, result in zip(batch, results) if isinstance(result, Exception)]
+        if failed:
+            self._requeue(failed)
+        metrics.inc('aurora_audit_events_total', len(batch) - len(failed), result='flushed')
+        if failed:
+            raise next(result for result in results if isinstance(result, Exception))
+        if self._failing:
+            self._failing = False
+            logger.info("审计事件恢复写入", extra={'event': 'audit.recovered'})
+        return len(batch)
+
+    def _report_failure(self):
+        # Redis不可用期间每个间隔都会失败，只在开始失败时记录一次
+        if not self._failing:
+            self._failing = True
+            logger.warning("审计事件写入失败，保留在缓冲区稍后重试", exc_info=True,
+                           extra={'event': 'audit.flush_failed'})
+
+    def flush(self):
+        """写入一个批次，返回写入的事件数"""
+        batch = self._take_batch()
+        if not batch:
+            return 0
+        try:
+            results = self._pipeline(batch).execute(raise_on_error=False)
+        except Exception:
+            self._requeue(batch)
+            raise
+        return self._finish(batch, results)
+
+    def close(self):
+        try:
+            while self.flush():
+                pass
+        except Exception:
+            self._report_failure()
+
+
+class AsyncAuditLog(AuditLog):
+    """asyncio模式下由事件循环中的任务刷新，emit 与同步版本相同，不需要等待"""
+
+    def __init__(self, redis_client, config=None):
+        super().__init__(redis_client, config)
+        atexit.unregister(self.close)
+        self._async_wakeup = None
+        self._task = None
+
+    def _start_flusher(self):
+        pass
+
+    def _notify(self):
+        if self._async_wakeup is not None:
+            self._async_wakeup.set()
+
+    def start(self):
+        self._async_wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._flush_loop_async())
+
+    async def _flush_loop_async(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._async_wakeup.clear()
+            try:
+                while await self.flush_async() >= self.batch_size:
+                    pass
+            except Exception:
+                self._report_failure()
+
+    async def flush_async(self):
+        batch = self._take_batch()
+        if not batch:
+            return 0
+        try:
+            results = await self._pipeline(batch).execute(raise_on_error=False)
+        except Exception:
+            self._requeue(batch)
+            raise
+        return self._finish(batch, results)
+
+    async def close_async(self):
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            while await self.flush_async():
+                pass
+        except Exception:
+            self._report_failure()
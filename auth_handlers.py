@@ -0,0 +1,288 @@
+import json
+import logging
+import random
+import re
+import string
+import traceback
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from circuit_breaker import CircuitOpenError
+from metrics import metrics
+from user_lookup import is_authorized, parse_lookup_request
+
+# 同步（auth_routes）和异步（async_auth_routes）两套路由共用的请求解析、校验和响应构造
+# 这里的函数不访问请求对象和存储，返回 (响应体, 状态码) 或 (响应体, 状态码, 响应头)，Flask 和 Quart 都直接序列化为JSON
+# 路由只负责读取请求、调用存储/哈希/队列，并把结果交给这里的函数；audit 为路由提供的审计函数 audit(event, **fields)
+
+logger = logging.getLogger('aurora.auth_routes')
+
+REDIS_ERRORS = (RedisConnectionError, RedisTimeoutError)
+CODE_SENT = '验证码已发送到您的邮箱'
+
+
+def failure(message, status=200, headers=None, **fields):
+    body = dict({'success': False, 'message': message}, **fields)
+    return (body, status, headers) if headers else (body, status)
+
+
+def generate_complex_password(length=16):
+    characters = string.ascii_letters + string.digits + '!@#$%^&*'
+    return ''.join(random.choice(characters) for _ in range(length))
+
+
+def generate_verification_code(length=6):
+    return ''.join(random.choices(string.digits, k=length))
+
+
+def is_valid_email(email):
+    return re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', email)
+
+
+def with_token(token_service, user_info):
+    """登录成功时附加会话令牌，未配置签名密钥时原样返回"""
+    token, expires_at = token_service.issue(user_info['uuid'])
+    if token is None:
+        return user_info
+    return dict(user_info, token=token, expires_at=expires_at)
+
+
+def get_request_token(authorization, data):
+    authorization = authorization or ''
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):].strip()
+    return data.get('token') if isinstance(data, dict) else None
+
+
+def redis_unavailable(e):
+    if isinstance(e, CircuitOpenError):
+        # 熔断期间每个请求都会走到这里，不记录堆栈
+        logger.warning("Redis熔断中，请求被拒绝", extra={'event': 'redis.circuit_open'})
+    else:
+        logger.error(f"Redis连接异常: {str(e)}", exc_info=True)
+    return failure('认证服务暂时不可用', 503, error_code='REDIS_CONNECTION_FAILED')
+
+
+def overloaded(name):
+    metrics.inc('aurora_requests_shed_total', route=name)
+    return failure('服务繁忙，请稍后再试', 503, {'Retry-After': '1'}, error_code='OVERLOADED')
+
+
+# /send_verification_code
+
+def parse_send_code(data):
+    """返回 (邮箱, 错误响应)，两者恰有一个为 None"""
+    if not isinstance(data, dict):
+        return None, failure('请求体为空或不是有效的 JSON', 400)
+    email = data.get('email')
+    if not email:
+        return None, failure('邮箱地址不能为空', 400)
+    return email, None
+
+
+def send_code_store_failed(e, email):
+    if isinstance(e, REDIS_ERRORS):
+        return redis_unavailable(e)
+    logger.error("验证码存储失败", exc_info=True, extra={'event': 'send_code.store_failed', 'email': email})
+    return failure('验证码存储失败', 500)
+
+
+def send_code_limited(status, result, email, client_ip, audit):
+    """脚本返回限流或冷却时直接给出响应，返回 None 表示需要把验证码加入发信队列"""
+    if status == 'limited':
+        audit('code.limited', email=email)
+        logger.warning("发送验证码过于频繁", extra={'event': 'send_code.limited', 'email': email,
+                                                    'client_ip': client_ip})
+        return failure('请求过于频繁，请稍后再试', 429, {'Retry-After': str(result)})
+    if status == 'cooldown':
+        # 冷却期内已发送过验证码，不再重复发信
+        audit('code.cooldown', email=email)
+        return {'success': True, 'message': CODE_SENT}, 200
+    return None
+
+
+def send_code_enqueued(enqueued, email, audit):
+    if not enqueued:
+        return failure('验证码发送失败', 500)
+    audit('code.sent', email=email)
+    return {'success': True, 'message': CODE_SENT}, 200
+
+
+def send_code_error(e):
+    logger.error("处理发送验证码请求时发生未预期的错误", exc_info=True, extra={'event': 'send_code.error'})
+    return failure(f'服务器错误: {str(e)}', 500)
+
+
+# /login
+
+def login_not_json(content_type):
+    return failure('请求内容必须为JSON格式', 400, content_type=content_type)
+
+
+def login_bad_json(raw_data):
+    return failure('无法解析JSON数据', 400, raw_data=raw_data[:200].decode('utf-8', 'replace'))
+
+
+def _text(data, field):
+    value = data.get(field)
+    return value.strip() if isinstance(value, str) else ''
+
+
+def parse_login(data):
+    """返回 (邮箱, 密码, 验证码, 错误响应)，data 为已解析的非空JSON对象"""
+    email, password, code = _text(data, 'email'), _text(data, 'password'), _text(data, 'code')
+    if not email:
+        return None, None, None, failure('邮箱不能为空')
+    if not is_valid_email(email):
+        return None, None, None, failure('邮箱格式不正确')
+    return email, password, code, None
+
+
+def username_from_email(email):
+    return email.split('@')[0]
+
+
+def code_login_result(status, user_info, email, audit, token_service):
+    """验证码登录脚本的结果；注册成功（registered）需要先发送欢迎邮件，由 registered 处理"""
+    if status == 'code_invalidated':
+        audit('login.failed', email=email, method='code', reason=status)
+        return failure('验证码错误次数过多，请重新获取验证码', 429)
+    if status in ('no_code', 'bad_code'):
+        audit('login.failed', email=email, method='code', reason=status)
+        return failure('验证码错误', stored_code=status == 'bad_code')  # 仅用于调试
+    audit('login.succeeded', email=email, method='code', uuid=user_info['uuid'])
+    return {'success': True, 'message': '登录成功', 'data': with_token(token_service, user_info)}, 200
+
+
+def registered(enqueued, user_info, email, audit, token_service):
+    audit('user.registered', email=email, uuid=user_info['uuid'])
+    if enqueued:
+        logger.info("新用户注册，欢迎邮件已加入发送队列", extra={'event': 'login.registered', 'email': email})
+    else:
+        logger.error("新用户的欢迎邮件入队失败", extra={'event': 'login.registered', 'email': email})
+    return {
+        'success': True,
+        'message': '账户注册成功，初始密码已发送至您的邮箱',
+        'data': with_token(token_service, user_info)
+    }, 200
+
+
+def user_init_failed(e):
+    if isinstance(e, REDIS_ERRORS):
+        return redis_unavailable(e)
+    logger.error(f"用户数据初始化异常: {str(e)}", exc_info=True)
+    return failure('用户初始化失败', 500, error_code='USER_INITIALIZATION_FAILED')
+
+
+def credentials_failed(e):
+    if isinstance(e, REDIS_ERRORS):
+        return redis_unavailable(e)
+    logger.error(f"Redis操作异常: {str(e)}", exc_info=True)
+    return failure('内部服务器错误', 500, error_code='REDIS_OPERATION_FAILED')
+
+
+def password_login_failed(reason, email, audit):
+    """reason 为 unknown_user 或 bad_password"""
+    audit('login.failed', email=email, method='password', reason=reason)
+    if reason == 'unknown_user':
+        return failure('用户不存在')
+    return failure('密码错误', hash_match=False)
+
+
+def rehash_failed(e, email):
+    logger.warning("密码哈希升级失败", extra={'event': 'login.rehash_failed', 'email': email, 'error': str(e)})
+
+
+def password_login_succeeded(credentials, email, audit, token_service):
+    audit('login.succeeded', email=email, method='password', uuid=credentials['uuid'])
+    return {
+        'success': True,
+        'data': with_token(token_service, {'username': credentials['username'], 'uuid': credentials['uuid']})
+    }, 200
+
+
+def login_missing_credentials(data):
+    return failure('必须提供密码或验证码', provided_fields=list(data.keys()))
+
+
+def login_error(e):
+    logger.error(f"未处理的异常: {str(e)}", exc_info=True)
+    return failure('内部服务器错误', 500, error=str(e), traceback=traceback.format_exc())
+
+
+# /change_password
+
+CHANGE_PASSWORD_FAILURES = {
+    'unknown_user': ('用户不存在', 404),
+    'bad_password': ('旧密码错误', 400),
+    # 校验旧密码期间密码已被其他请求修改
+    'conflict': ('密码修改失败', 409)
+}
+
+
+def parse_change_password(data):
+    """返回 (邮箱, 旧密码, 新密码, 错误响应)"""
+    if not isinstance(data, dict) or not data:
+        return None, None, None, failure('请求数据无效', 400)
+    email, old_password, new_password = data.get('email'), data.get('old_password'), data.get('new_password')
+    if not email or not old_password or not new_password:
+        return None, None, None, failure('邮箱、旧密码和新密码不能为空', 400)
+    if not isinstance(email, str) or not is_valid_email(email):
+        return None, None, None, failure('邮箱格式不正确', 400)
+    return email, old_password, new_password, None
+
+
+def change_password_failed(reason, email, audit):
+    if reason == 'conflict':
+        logger.error("密码修改失败", extra={'event': 'change_password.conflict', 'email': email})
+    audit('password.change_failed', email=email, reason=reason)
+    return failure(*CHANGE_PASSWORD_FAILURES[reason])
+
+
+def password_changed(credentials, email, audit):
+    logger.info("密码修改成功", extra={'event': 'change_password.done', 'email': email})
+    audit('password.changed', email=email, uuid=credentials['uuid'])
+    return {'success': True, 'message': '密码修改成功'}, 200
+
+
+def change_password_error(e):
+    logger.error(f"修改密码时发生错误: {str(e)}", exc_info=True)
+    return failure('服务器内部错误', 500)
+
+
+# /verify_token 和 /revoke_token
+
+def missing_token():
+    return failure('缺少令牌', 400)
+
+
+def token_invalid(status):
+    return failure('令牌无效', 401, reason=status)
+
+
+def token_verified(claims):
+    return {'success': True, 'data': {'uuid': claims['uuid'], 'expires_at': claims['exp']}}, 200
+
+
+def token_revoked():
+    return {'success': True, 'message': '令牌已吊销'}, 200
+
+
+# /users/lookup
+
+def parse_lookup(config, api_key, data):
+    """返回 (查询类型, 查询值列表, 是否流式输出, 错误响应)"""
+    if not is_authorized(config, api_key):
+        return None, None, False, failure('无权访问', 403)
+    error, by, identifiers = parse_lookup_request(data, config)
+    if error:
+        return None, None, False, failure(error, 400)
+    # 大批量查询以NDJSON逐批输出，不在内存中拼接完整响应
+    stream = bool(data.get('stream')) or len(identifiers) > config['stream_threshold']
+    return by, identifiers, stream, None
+
+
+def lookup_line(query, user):
+    return json.dumps({'query': query, 'user': user}, ensure_ascii=False) + '\n'
+
+
+def lookup_results(results):
+    return {'success': True, 'data': [{'query': query, 'user': user} for query, user in results]}, 200
@@ -1,306 +1,230 @@
-from flask import Blueprint, request, jsonify, current_app
-from email_service import *
-import redis
-import hashlib
-import uuid
-import re
-from redis import ConnectionPool, RedisError
-import traceback
-import string
-import random
-import yaml
-
+from flask import Blueprint, Response, request, current_app, stream_with_context
+import functools
+from redis import RedisError
+import auth_handlers as handlers
+from metrics import metrics
+from auth_handlers import REDIS_ERRORS, generate_complex_password, generate_verification_code
+from user_lookup import iter_lookup
+
+# 请求解析、校验和响应构造在 auth_handlers 中，与 async_auth_routes 共用，这里只做同步的I/O调用
 auth_bp = Blueprint('auth', __name__)
 
-email_service = None
-
-def init_email_service(service):
-    global email_service
-    email_service = service
-
-with open('./config.yml', 'r', encoding='utf-8') as f:
-    config = yaml.safe_load(f)
-
-redis_config = config.get('redis', {})
-redis_pool = ConnectionPool(
-    host=redis_config.get('host', 'localhost'),
-    port=redis_config.get('port', 6379),
-    db=redis_config.get('db', 0),
-    username=redis_config.get('username'),
-    password=redis_config.get('password'),
-    decode_responses=redis_config.get('decode_responses', False)
-)
-redis_client = redis.Redis(connection_pool=redis_pool)
-
-def generate_complex_password(length=16):
-    characters = string.ascii_letters + string.digits + '!@#$%^&*'
-    return ''.join(random.choice(characters) for _ in range(length))
-
-def is_valid_email(email):
-    return re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', email)
+def get_mail_queue():
+    return current_app.extensions.get('mail_queue')
+
+def get_redis_client():
+    return current_app.extensions['redis_client']
+
+def get_user_store():
+    return current_app.extensions['user_store']
+
+def get_password_hasher():
+    return current_app.extensions['password_hasher']
+
+def get_token_service():
+    return current_app.extensions['token_service']
+
+def audit(event, **fields):
+    """审计事件只追加到进程内缓冲区，由后台批量写入Redis Stream，不增加请求耗时"""
+    audit_log = current_app.extensions.get('audit_log')
+    if audit_log is not None:
+        audit_log.emit(event, ip=request.remote_addr, **fields)
+
+def limit_concurrency(name):
+    """超过 concurrency_limits 中配置的并发数时立即返回503，不让请求排队占用worker"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions['concurrency_limits'].get(name)
+            if limiter is None:
+                return view(*args, **kwargs)
+            if not limiter.try_acquire():
+                return handlers.overloaded(name)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.release()
+        return wrapper
+    return decorator
 
 
 @auth_bp.route('/send_verification_code', methods=['POST'])
+@limit_concurrency('send_verification_code')
 def send_verification_code():
     try:
-        if email_service is None:
-            return jsonify({'success': False, 'message': '邮件服务未初始化'}), 500
-            
-        print("收到发送验证码请求")
-        data = request.get_json(force=True)
-        print(f"请求数据: {data}")
-        
-        if data is None:
-            return jsonify({'success': False, 'message': '请求体为空或不是有效的 JSON'}), 400
-            
-        email = data.get('email')
-        print(f"目标邮箱: {email}")
-        
-        if not email:
-            return jsonify({'success': False, 'message': '邮箱地址不能为空'}), 400
-        
-        code = email_service.generate_verification_code()
-        print(f"生成的验证码: {code}")
-        
-        if email_service.send_verification_email(email, code):
-            print("邮件发送成功，准备存储验证码")
-            if email_service.store_verification_code(email, code):
-                print("验证码存储成功")
-                return jsonify({'success': True, 'message': '验证码已发送到您的邮箱'}), 200
-            else:
-                print("验证码存储失败")
-                return jsonify({'success': False, 'message': '验证码存储失败'}), 500
-        else:
-            print("邮件发送失败")
-            return jsonify({'success': False, 'message': '验证码发送失败'}), 500
-            
+        mail_queue = get_mail_queue()
+        if mail_queue is None:
+            return handlers.failure('邮件服务未初始化', 500)
+
+        email, error = handlers.parse_send_code(request.get_json(force=True, silent=True))
+        if error:
+            return error
+
+        # 限流、冷却期合并与验证码存储在同一个脚本中原子完成
+        try:
+            with metrics.stage('send_verification_code.script'):
+                status, result = get_user_store().send_verification_code(
+                    email, request.remote_addr, generate_verification_code()
+                )
+        except RedisError as e:
+            return handlers.send_code_store_failed(e, email)
+
+        reply = handlers.send_code_limited(status, result, email, request.remote_addr, audit)
+        if reply:
+            return reply
+        with metrics.stage('send_verification_code.enqueue'):
+            enqueued = mail_queue.enqueue_verification(email, result)
+        return handlers.send_code_enqueued(enqueued, email, audit)
+
     except Exception as e:
-        print(f"处理发送验证码请求时发生未预期的错误: {e}")
-        traceback.print_exc()
-        return jsonify({'success': False, 'message': f'服务器错误: {str(e)}'}), 500
+        return handlers.send_code_error(e)
 
 @auth_bp.route('/login', methods=['POST'])
+@limit_concurrency('login')
 def login():
     try:
         if not request.is_json:
-            return jsonify({
-                'success': False, 
-                'message': '请求内容必须为JSON格式',
-                'content_type': request.content_type
-            }), 400
-
+            return handlers.login_not_json(request.content_type)
         data = request.get_json(silent=True)
-        if not data:
-            return jsonify({
-                'success': False, 
-                'message': '无法解析JSON数据',
-                'raw_data': request.data[:200] 
-            }), 400
-
-        email = data.get('email', '').strip()
-        password = data.get('password', '').strip()
-        code = data.get('code', '').strip()
-
-        if not email:
-            return jsonify({'success': False, 'message': '邮箱不能为空'})
-        if not is_valid_email(email):
-            return jsonify({'success': False, 'message': '邮箱格式不正确'})
-
-        user_key = f"user:{email}"
-        
-        try:
-            if not redis_client.ping():
-                raise RedisError(
-                    "Redis连接失败")
-                
-            user_data = redis_client.hgetall(user_key)
-            
-            if user_data:
-                decoded_data = {}
-                for k, v in user_data.items():
-                    try:
-                        decoded_data[k.decode('utf-8') if isinstance(k, bytes) else k] = \
-                            v.decode('utf-8') if isinstance(v, bytes) else v
-                    except (UnicodeDecodeError, AttributeError) as e:
-                        current_app.logger.warning(f"数据解码警告 ({k}): {str(e)}")
-                        decoded_data[k] = v 
-                user_data = decoded_data
-                
-        except (RedisError, ConnectionError) as e:
-            current_app.logger.error(f"Redis连接异常: {str(e)}", exc_info=True)
-            return jsonify({
-                'success': False, 
-                'message': '认证服务暂时不可用',
-                'error_code': 'REDIS_CONNECTION_FAILED'
-            }), 503
-        except Exception as e:
-            current_app.logger.error(f"Redis操作异常: {str(e)}", exc_info=True)
-            return jsonify({
-                'success': False, 
-                'message': '内部服务器错误',
-                'error_code': 'REDIS_OPERATION_FAILED'
-            }), 500
+        if not data or not isinstance(data, dict):
+            return handlers.login_bad_json(request.get_data())
+
+        email, password, code, error = handlers.parse_login(data)
+        if error:
+            return error
+
+        user_store = get_user_store()
+        password_hasher = get_password_hasher()
+        token_service = get_token_service()
 
         if code:
             try:
-                stored_code = redis_client.get(f"verification_code:{email}")
-                
-                if isinstance(stored_code, bytes):
-                    stored_code = stored_code.decode('utf-8')
-                if not stored_code or stored_code != code:
-                    return jsonify({
-                        'success': False, 
-                        'message': '验证码错误',
-                        'stored_code': stored_code is not None  # 仅用于调试
-                    })
-
-                if not user_data:
+                username = handlers.username_from_email(email)
+                # 校验验证码、清理验证码以及新用户注册在同一个脚本中原子完成
+                with metrics.stage('login.code_script'):
+                    status, user_info = user_store.login_with_code(email, code, username)
+
+                if status == 'needs_password':
+                    # 仅在确实需要注册时才计算初始密码的哈希
                     system_password = generate_complex_password(12)
+                    with metrics.stage('login.hash'):
+                        password_hash = password_hasher.hash(system_password)
+                    with metrics.stage('login.register_script'):
+                        status, user_info = user_store.login_with_code(
+                            email, code, username, password_hash, password_hasher.scheme
+                        )
+
+                if status == 'registered':
+                    with metrics.stage('login.enqueue_welcome'):
+                        enqueued = get_mail_queue().enqueue_welcome(email, system_password)
+                    return handlers.registered(enqueued, user_info, email, audit, token_service)
+                return handlers.code_login_result(status, user_info, email, audit, token_service)
+
+            except (RedisError, AttributeError, UnicodeEncodeError) as e:
+                return handlers.user_init_failed(e)
 
-                    email_service.send_welcome_email(email, system_password)
-                    current_app.logger.info(f"已为新用户 {email} 生成并发送初始密码")
-
-                    parts = email.split('@')
-                    if len(parts) < 2 or not parts[0]:
-                        return jsonify({
-                            'success': False, 
-                            'message': '邮箱格式不正确',
-                            'error_code': 'INVALID_EMAIL_FORMAT'
-                        }), 400
-
-                    username = parts[0]
-
-                    # 使用数字ID替代UUID，并按注册顺序递增
-                    # 获取当前最大用户ID并加1
-                    user_counter_key = "user_counter"
-                    user_id = redis_client.incr(user_counter_key)
-                    
-                    new_user_data = {
-                        'uuid': str(user_id),  # 使用纯数字ID
-                        'username': username,
-                        'password': hashlib.md5(system_password.encode()).hexdigest(),
-                        'password_type': 'system_generated'
-                    }
-
-                    if not redis_client.hmset(user_key, new_user_data):
-                        raise RedisError("用户数据写入失败")
-
-                    if not redis_client.delete(f"verification_code:{email}"):
-                        current_app.logger.warning(f"动态密码清理失败: {email}")
-
-                    return jsonify({
-                        'success': True,
-                        'message': '账户注册成功，初始密码已发送至您的邮箱',
-                        'data': {
-                            'username': username,
-                            'uuid': new_user_data['uuid']
-                        }
-                    }), 200
-                else:
-                    # 用户已存在，清理验证码并返回登录成功
-                    redis_client.delete(f"verification_code:{email}")
-                    return jsonify({
-                        'success': True,
-                        'message': '登录成功',
-                        'data': {
-                            'username': user_data.get('username'),
-                            'uuid': user_data.get('uuid')
-                        }
-                    })
-                    
-            except (RedisError, uuid.UUIDError, AttributeError, UnicodeEncodeError) as e:
-                current_app.logger.error(f"用户数据初始化异常: {str(e)}", exc_info=True)
-                return jsonify({
-                    'success': False, 
-                    'message': '用户初始化失败',
-                    'error_code': 'USER_INITIALIZATION_FAILED'
-                }), 500
-
-        # 密码验证逻辑
         if password:
-            if not user_data:
-                return jsonify({'success': False, 'message': '用户不存在'})
-                
-            hashed_input = hashlib.md5(password.encode('utf-8')).hexdigest()
-            stored_hash = user_data.get('password', '')
-            
-            if hashed_input != stored_hash:
-                return jsonify({
-                    'success': False, 
-                    'message': '密码错误',
-                    'hash_match': False
-                })
-
-            return jsonify({
-                'success': True,
-                'data': {
-                    'username': user_data.get('username'),
-                    'uuid': user_data.get('uuid')
-                }
-            })
-
-        return jsonify({
-            'success': False, 
-            'message': '必须提供密码或验证码',
-            'provided_fields': list(data.keys())
-        })
+            try:
+                with metrics.stage('login.get_credentials'):
+                    credentials = user_store.get_credentials(email)
+            except RedisError as e:
+                return handlers.credentials_failed(e)
+
+            if credentials is None:
+                return handlers.password_login_failed('unknown_user', email, audit)
+
+            stored_hash = credentials['password'] or ''
+            with metrics.stage('login.verify'):
+                verified = password_hasher.verify(password, stored_hash, email)
+            if not verified:
+                return handlers.password_login_failed('bad_password', email, audit)
+
+            if password_hasher.needs_rehash(stored_hash):
+                # 旧的MD5或参数过时的哈希在登录成功后透明升级
+                try:
+                    with metrics.stage('login.rehash'):
+                        user_store.update_password(
+                            email, stored_hash, password_hasher.hash(password), password_hasher.scheme
+                        )
+                except RedisError as e:
+                    handlers.rehash_failed(e, email)
+
+            return handlers.password_login_succeeded(credentials, email, audit, token_service)
+
+        return handlers.login_missing_credentials(data)
 
     except Exception as e:
-        current_app.logger.error(f"未处理的异常: {str(e)}", exc_info=True)
-        return jsonify({
-            'success': False, 
-            'message': '内部服务器错误',
-            'error': str(e),
-            'traceback': traceback.format_exc()
-        }), 500
+        return handlers.login_error(e)
 
 @auth_bp.route('/change_password', methods=['POST'])
 def change_password():
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'message': '请求数据无效'}), 400
-            
-        email = data.get('email')
-        old_password = data.get('old_password')
-        new_password = data.get('new_password')
-        
-        if not email or not old_password or not new_password:
-            return jsonify({'success': False, 'message': '邮箱、旧密码和新密码不能为空'}), 400
-            
-        if not is_valid_email(email):
-            return jsonify({'success': False, 'message': '邮箱格式不正确'}), 400
-            
-        user_key = f"user:{email}"
-        user_data = redis_client.hgetall(user_key)
-        
-        if not user_data:
-            return jsonify({'success': False, 'message': '用户不存在'}), 404
-
-        decoded_user_data = {}
-        for k, v in user_data.items():
-            try:
-                decoded_user_data[k.decode('utf-8') if isinstance(k, bytes) else k] = \
-                    v.decode('utf-8') if isinstance(v, bytes) else v
-            except (UnicodeDecodeError, AttributeError):
-                decoded_user_data[k] = v
-                
-        stored_password = decoded_user_data.get('password', '')
-        hashed_old_password = hashlib.md5(old_password.encode()).hexdigest()
-        
-        if stored_password != hashed_old_password:
-            return jsonify({'success': False, 'message': '旧密码错误'}), 400
-            
-        hashed_new_password = hashlib.md5(new_password.encode()).hexdigest()
-        result = redis_client.hset(user_key, 'password', hashed_new_password)
-        
-        if result:
-            current_app.logger.info(f"用户 {email} 密码修改成功")
-            return jsonify({'success': True, 'message': '密码修改成功'})
-        else:
-            current_app.logger.error(f"用户 {email} 密码修改失败")
-            return jsonify({'success': False, 'message': '密码修改失败'}), 500
-            
+        email, old_password, new_password, error = handlers.parse_change_password(request.get_json(silent=True))
+        if error:
+            return error
+
+        user_store = get_user_store()
+        password_hasher = get_password_hasher()
+        credentials = user_store.get_credentials(email)
+        if credentials is None:
+            return handlers.change_password_failed('unknown_user', email, audit)
+
+        stored_password = credentials['password'] or ''
+        with metrics.stage('change_password.verify'):
+            verified = password_hasher.verify(old_password, stored_password, email)
+        if not verified:
+            return handlers.change_password_failed('bad_password', email, audit)
+
+        with metrics.stage('change_password.hash'):
+            hashed_new_password = password_hasher.hash(new_password)
+        if not user_store.update_password(email, stored_password, hashed_new_password, password_hasher.scheme):
+            return handlers.change_password_failed('conflict', email, audit)
+        return handlers.password_changed(credentials, email, audit)
+
     except Exception as e:
-        current_app.logger.error(f"修改密码时发生错误: {str(e)}", exc_info=True)
-        return jsonify({'success': False, 'message': '服务器内部错误'}), 500
\ No newline at end of file
+        return handlers.change_password_error(e)
+
+@auth_bp.route('/verify_token', methods=['POST'])
+def verify_token():
+    """只校验签名和有效期，吊销列表来自进程内缓存，正常情况下不访问Redis"""
+    token = handlers.get_request_token(request.headers.get('Authorization'), request.get_json(silent=True))
+    if not token:
+        return handlers.missing_token()
+
+    status, claims = get_token_service().verify(token)
+    if status != 'valid':
+        return handlers.token_invalid(status)
+    return handlers.token_verified(claims)
+
+@auth_bp.route('/revoke_token', methods=['POST'])
+def revoke_token():
+    token = handlers.get_request_token(request.headers.get('Authorization'), request.get_json(silent=True))
+    status, claims = get_token_service().verify(token) if token else ('malformed', None)
+    if status != 'valid':
+        return handlers.token_invalid(status)
+    try:
+        get_token_service().revoke(claims)
+    except REDIS_ERRORS as e:
+        return handlers.redis_unavailable(e)
+    return handlers.token_revoked()
+
+@auth_bp.route('/users/lookup', methods=['POST'])
+def lookup_users():
+    """供内部服务批量查询用户，按邮箱或数字uuid查询，结果顺序与输入一致"""
+    config = current_app.extensions['lookup_config']
+    by, identifiers, stream, error = handlers.parse_lookup(config, request.headers.get('X-API-Key'),
+                                                           request.get_json(silent=True))
+    if error:
+        return error
+
+    results = iter_lookup(get_user_store(), identifiers, by, config['batch_size'])
+    if stream:
+        def generate():
+            for query, user in results:
+                yield handlers.lookup_line(query, user)
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    try:
+        return handlers.lookup_results(results)
+    except REDIS_ERRORS as e:
+        return handlers.redis_unavailable(e)
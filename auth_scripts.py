@@ -0,0 +1,423 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from redis import RedisError
+from redis_factory import is_cluster
+from redis_keys import USER_COUNTER_KEY, USER_UUID_PREFIX, KeyBuilder, user_uuid_key
+from user_codec import RECORD_FIELDS, decode_record, default_username, pack_password, pack_type
+from user_lookup import lookup_by_email, lookup_by_email_async, lookup_by_uuid, lookup_by_uuid_async
+
+logger = logging.getLogger('aurora.auth')
+
+# 集群模式下脚本只访问同一用户的key，这些key共用邮箱哈希标签，位于同一个槽
+# KEYS[1] 用户哈希  KEYS[2] 验证码  KEYS[3] 验证码错误次数  KEYS[4] 用户ID计数器（仅非集群模式）
+# ARGV[1] 验证码  ARGV[2] 用户名  ARGV[3] 初始密码哈希  ARGV[4] 密码类型  ARGV[5] 验证码最多错误次数
+# ARGV[6] 新用户ID，为空时在脚本中 INCR KEYS[4]，ID按注册顺序递增；集群模式下计数器与用户不在同一个槽，由调用方按块预留
+# ARGV[7] 存储格式，compact 时密码和类型已由调用方编码，用户名为空表示与邮箱前缀相同
+# ARGV[8] uuid索引key前缀，非空时在脚本中同时写入 uuid -> 邮箱 索引，注册和索引原子完成；
+# 索引key由新ID决定，无法预先放入 KEYS，只用于不校验槽的单节点和哨兵模式。集群模式下索引与用户不在同一个槽，
+# 传入空串，由调用方在脚本返回后单独 SET，写入失败时需通过 user_tool.py reindex 补建
+# 初始密码哈希为空且用户不存在时返回 needs_password 并保留验证码，
+# 由调用方计算哈希后再次调用，已有用户登录无需计算KDF
+LOGIN_WITH_CODE = """
+local stored = redis.call('GET', KEYS[2])
+if not stored then
+    return {'no_code'}
+end
+if stored ~= ARGV[1] then
+    local attempts = redis.call('INCR', KEYS[3])
+    if attempts == 1 then
+        redis.call('EXPIRE', KEYS[3], math.max(redis.call('TTL', KEYS[2]), 1))
+    end
+    if attempts >= tonumber(ARGV[5]) then
+        redis.call('DEL', KEYS[2], KEYS[3])
+        return {'code_invalidated'}
+    end
+    return {'bad_code'}
+end
+
+local user = redis.call('HMGET', KEYS[1], 'i', 'n', 'uuid', 'username')
+if user[1] or user[3] then
+    redis.call('DEL', KEYS[2], KEYS[3])
+    return {'login', user[1] or user[3], user[2] or user[4] or ''}
+end
+if ARGV[3] == '' then
+    return {'needs_password'}
+end
+
+redis.call('DEL', KEYS[2], KEYS[3])
+local user_id = ARGV[6]
+if user_id == '' then
+    user_id = tostring(redis.call('INCR', KEYS[4]))
+end
+if ARGV[7] == 'compact' then
+    redis.call('HSET', KEYS[1], 'i', user_id, 'p', ARGV[3], 't', ARGV[4])
+    if ARGV[2] ~= '' then
+        redis.call('HSET', KEYS[1], 'n', ARGV[2])
+    end
+else
+    redis.call('HSET', KEYS[1],
+        'uuid', user_id,
+        'username', ARGV[2],
+        'password', ARGV[3],
+        'password_type', ARGV[4])
+end
+if ARGV[8] ~= '' then
+    redis.call('SET', ARGV[8] .. user_id, ARGV[9])
+end
+return {'registered', user_id, ARGV[2]}
+"""
+
+# KEYS[1] 滑动窗口  ARGV[1] 当前毫秒时间  ARGV[2] 窗口毫秒  ARGV[3] 上限  ARGV[4] 窗口成员
+# 未超限时占用一个名额，返回 {'ok'}；超限时返回 {'limited', 重试毫秒数}
+RESERVE_SLOT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return {'limited', tostring(tonumber(oldest[2]) + window - now)}
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+return {'ok'}
+"""
+
+# KEYS[1] 验证码  KEYS[2] 发送冷却标记  KEYS[3] 验证码错误次数  KEYS[4] 邮箱滑动窗口
+# ARGV[1] 当前毫秒时间  ARGV[2] 窗口毫秒  ARGV[3] 邮箱上限  ARGV[4] 窗口成员
+# ARGV[5] 新验证码  ARGV[6] 验证码有效秒数  ARGV[7] 冷却毫秒
+# 冷却期内的重复请求直接返回 cooldown，不再发信；验证码仍有效时沿用原验证码
+# IP窗口与邮箱不在同一个槽，由调用方先通过 RESERVE_SLOT 占用名额，未发送时再归还
+SEND_VERIFICATION_CODE = """
+local cooldown = redis.call('PTTL', KEYS[2])
+if cooldown > 0 then
+    return {'cooldown', tostring(cooldown)}
+end
+
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now - window)
+if redis.call('ZCARD', KEYS[4]) >= tonumber(ARGV[3]) then
+    local oldest = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+    return {'limited', tostring(tonumber(oldest[2]) + window - now)}
+end
+redis.call('ZADD', KEYS[4], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[4], window)
+
+local code = redis.call('GET', KEYS[1])
+if not code then
+    code = ARGV[5]
+    redis.call('DEL', KEYS[3])
+end
+redis.call('SET', KEYS[1], code, 'EX', ARGV[6])
+if tonumber(ARGV[7]) > 0 then
+    redis.call('SET', KEYS[2], '1', 'PX', ARGV[7])
+end
+return {'send', code}
+"""
+
+# KEYS[1] 用户哈希  ARGV[1] 期望的旧密码哈希  ARGV[2] 期望的旧密码哈希（compact 编码，standard 格式下为空）
+# ARGV[3] 新密码哈希  ARGV[4] 密码类型  ARGV[5] 存储格式
+# 仅当密码未被并发修改时写入，用于修改密码和登录时的哈希升级；写入时同时删除另一种格式的密码字段
+# 记录已有 compact 字段而 ARGV[2] 为空时返回 -1，由调用方打包旧哈希后重试
+NEEDS_PACKED_HASH = -1
+UPDATE_PASSWORD = """
+local current = redis.call('HGET', KEYS[1], 'p')
+local expected = ARGV[2]
+if not current then
+    current = redis.call('HGET', KEYS[1], 'password')
+    expected = ARGV[1]
+elseif expected == '' and ARGV[1] ~= '' then
+    return -1
+end
+if current ~= expected then
+    return 0
+end
+if ARGV[5] == 'compact' then
+    redis.call('HDEL', KEYS[1], 'password', 'password_type')
+    redis.call('HSET', KEYS[1], 'p', ARGV[3], 't', ARGV[4])
+else
+    redis.call('HDEL', KEYS[1], 'p', 't')
+    redis.call('HSET', KEYS[1], 'password', ARGV[3], 'password_type', ARGV[4])
+end
+return 1
+"""
+
+DEFAULT_RATE_LIMIT = {
+    'window': 3600,
+    'email_limit': 5,
+    'ip_limit': 20,
+    'cooldown': 60,
+    'code_ttl': 300,
+    'max_code_attempts': 5
+}
+
+DEFAULT_ID_BLOCK_SIZE = 100
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _rate_limit_config(rate_limit_config):
+    config = dict(DEFAULT_RATE_LIMIT)
+    config.update(rate_limit_config or {})
+    return config
+
+
+def _login_with_code_args(keys, email, code, username, password_hash, password_type, user_id, limits, user_format):
+    """user_id 为 None 时（非集群模式）由脚本INCR计数器分配，并在脚本中写入uuid索引"""
+    if user_format == 'compact':
+        password_hash = pack_password(password_hash) if password_hash else ''
+        password_type = pack_type(password_type)
+        if username == default_username(email):
+            username = ''
+    script_keys = [keys.user_key(email), keys.verification_code_key(email), keys.verification_attempts_key(email)]
+    index_prefix = ''
+    if user_id is None:
+        script_keys.append(USER_COUNTER_KEY)
+        user_id = ''
+        index_prefix = USER_UUID_PREFIX
+    return {
+        'keys': script_keys,
+        'args': [code, username, password_hash, password_type, limits['max_code_attempts'], user_id, user_format,
+                 index_prefix, email]
+    }
+
+
+def _reserve_ip_args(keys, client_ip, member, now, limits):
+    return {
+        'keys': [keys.send_limit_ip_key(client_ip)],
+        'args': [now, int(limits['window'] * 1000), limits['ip_limit'], member]
+    }
+
+
+def _send_verification_code_args(keys, email, new_code, member, now, limits):
+    return {
+        'keys': [keys.verification_code_key(email), keys.verification_cooldown_key(email),
+                 keys.verification_attempts_key(email), keys.send_limit_email_key(email)],
+        'args': [now, int(limits['window'] * 1000), limits['email_limit'], member, new_code,
+                 limits['code_ttl'], int(limits['cooldown'] * 1000)]
+    }
+
+
+def _unpack_send(result):
+    status, value = (_to_str(v) for v in result)
+    if status == 'send':
+        return status, value
+    # cooldown / limited 返回剩余毫秒数，换算为向上取整的秒数
+    return status, max(1, -(-int(value) // 1000))
+
+
+def _update_password_args(keys, email, old_hash, new_hash, password_type, user_format, pack_old=False):
+    # standard 格式只在记录已被迁移为 compact 字段、脚本返回 NEEDS_PACKED_HASH 时才打包旧哈希重试
+    packed_old = pack_password(old_hash) if pack_old or user_format == 'compact' else ''
+    if user_format == 'compact':
+        new_hash, password_type = pack_password(new_hash), pack_type(password_type)
+    return {'keys': [keys.user_key(email)],
+            'args': [old_hash, packed_old, new_hash, password_type, user_format]}
+
+
+def _unpack(email, result):
+    values = [_to_str(v) for v in result]
+    status = values[0]
+    if len(values) < 3:
+        return status, None
+    return status, {'uuid': values[1], 'username': values[2] or default_username(email)}
+
+
+class IdAllocator:
+    """集群模式下按块从 user_counter 预留用户ID，每块只需一次INCRBY，且不要求计数器与用户数据位于同一个槽
+
+    ID仍然全局唯一，但多个worker交替分配，不再严格按注册先后递增；进程退出或预留后未注册时ID被跳过
+    """
+
+    def __init__(self, redis_client, block_size=DEFAULT_ID_BLOCK_SIZE):
+        self.redis_client = redis_client
+        self.block_size = block_size
+        self._next = 1
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if self._next > self._last:
+                self._last = self.redis_client.incrby(USER_COUNTER_KEY, self.block_size)
+                self._next = self._last - self.block_size + 1
+            user_id = self._next
+            self._next += 1
+        return str(user_id)
+
+
+class AsyncIdAllocator(IdAllocator):
+
+    def __init__(self, redis_client, block_size=DEFAULT_ID_BLOCK_SIZE):
+        super().__init__(redis_client, block_size)
+        self._lock = asyncio.Lock()
+
+    async def allocate(self):
+        async with self._lock:
+            if self._next > self._last:
+                self._last = await self.redis_client.incrby(USER_COUNTER_KEY, self.block_size)
+                self._next = self._last - self.block_size + 1
+            user_id = self._next
+            self._next += 1
+        return str(user_id)
+
+
+class AuthScripts:
+    """注册到Redis的登录脚本，通过EVALSHA调用，脚本缓存丢失时自动回退到EVAL"""
+
+    def __init__(self, redis_client, rate_limit_config=None, user_cache=None, id_block_size=DEFAULT_ID_BLOCK_SIZE,
+                 user_format='standard', keys=None):
+        self.redis_client = redis_client
+        self.limits = _rate_limit_config(rate_limit_config)
+        self.user_cache = user_cache
+        self.user_format = user_format
+        # 未指定key布局时只按客户端类型判断，单节点迁移到带标签的key后应传入 key_builder(redis配置)
+        self.keys = keys or KeyBuilder(is_cluster(redis_client))
+        # 非集群模式下ID由注册脚本INCR分配
+        self.ids = IdAllocator(redis_client, id_block_size) if is_cluster(redis_client) else None
+        self._login_with_code = redis_client.register_script(LOGIN_WITH_CODE)
+        self._update_password = redis_client.register_script(UPDATE_PASSWORD)
+        self._reserve_slot = redis_client.register_script(RESERVE_SLOT)
+        self._send_verification_code = redis_client.register_script(SEND_VERIFICATION_CODE)
+
+    def login_with_code(self, email, code, username, password_hash='', password_type=''):
+        """返回 (状态, 用户信息)，状态为 no_code / bad_code / code_invalidated / needs_password / login / registered"""
+        user_id = self.ids.allocate() if password_hash and self.ids is not None else None
+        result = self._login_with_code(
+            **_login_with_code_args(self.keys, email, code, username, password_hash, password_type, user_id, self.limits,
+                                    self.user_format)
+        )
+        status, user_info = _unpack(email, result)
+        if status == 'registered':
+            if self.user_cache is not None:
+                self.user_cache.invalidate(email)
+            if self.ids is not None:
+                self._write_index(user_info['uuid'], email)
+        return status, user_info
+
+    def _write_index(self, user_id, email):
+        # 仅集群模式：索引key与用户不在同一个槽，无法在注册脚本中写入
+        try:
+            self.redis_client.set(user_uuid_key(user_id), email)
+        except RedisError:
+            # 索引可通过 user_tool.py reindex 补建，不影响本次注册
+            logger.warning("uuid索引写入失败", exc_info=True, extra={'event': 'index.failed', 'email': email})
+
+    def send_verification_code(self, email, client_ip, new_code):
+        """限流并存储验证码，返回 (send, 验证码) / (cooldown, 剩余秒数) / (limited, 重试秒数)"""
+        member = uuid.uuid4().hex
+        now = int(time.time() * 1000)
+        reserved = self._reserve_slot(**_reserve_ip_args(self.keys, client_ip, member, now, self.limits))
+        if _to_str(reserved[0]) == 'limited':
+            return _unpack_send(reserved)
+
+        result = self._send_verification_code(
+            **_send_verification_code_args(self.keys, email, new_code, member, now, self.limits)
+        )
+        status, value = _unpack_send(result)
+        if status != 'send':
+            # 本次没有发信，归还占用的IP名额
+            self.redis_client.zrem(self.keys.send_limit_ip_key(client_ip), member)
+        return status, value
+
+    def allocate_id(self):
+        if self.ids is not None:
+            return self.ids.allocate()
+        return str(self.redis_client.incr(USER_COUNTER_KEY))
+
+    def lookup_users(self, identifiers, by):
+        """一个管道批量查询，uuid 先通过索引换出邮箱"""
+        lookup = lookup_by_uuid if by == 'uuid' else lookup_by_email
+        return lookup(self.redis_client, self.keys, identifiers)
+
+    def _load_credentials(self, email):
+        return decode_record(email, self.redis_client.hmget(self.keys.user_key(email), RECORD_FIELDS))
+
+    def get_credentials(self, email):
+        """一次HMGET读取密码校验所需字段，用户不存在时返回 None，启用用户缓存时优先读取缓存"""
+        if self.user_cache is not None:
+            return self.user_cache.get(email, self._load_credentials)
+        return self._load_credentials(email)
+
+    def update_password(self, email, old_hash, new_hash, password_type):
+        try:
+            result = self._update_password(**_update_password_args(self.keys, email, old_hash, new_hash,
+                                                                   password_type, self.user_format))
+            if result == NEEDS_PACKED_HASH:
+                result = self._update_password(**_update_password_args(self.keys, email, old_hash, new_hash,
+                                                                       password_type, self.user_format, True))
+            return result == 1
+        finally:
+            # 失效通知是异步到达的，本进程的写入立即失效，保证随后的读取看到新密码
+            if self.user_cache is not None:
+                self.user_cache.invalidate(email)
+
+
+class AsyncAuthScripts:
+    """AuthScripts 的 redis.asyncio 版本"""
+
+    def __init__(self, redis_client, rate_limit_config=None, id_block_size=DEFAULT_ID_BLOCK_SIZE,
+                 user_format='standard', keys=None):
+        self.redis_client = redis_client
+        self.limits = _rate_limit_config(rate_limit_config)
+        self.user_format = user_format
+        self.keys = keys or KeyBuilder(is_cluster(redis_client))
+        self.ids = AsyncIdAllocator(redis_client, id_block_size) if is_cluster(redis_client) else None
+        self._login_with_code = redis_client.register_script(LOGIN_WITH_CODE)
+        self._update_password = redis_client.register_script(UPDATE_PASSWORD)
+        self._reserve_slot = redis_client.register_script(RESERVE_SLOT)
+        self._send_verification_code = redis_client.register_script(SEND_VERIFICATION_CODE)
+
+    async def login_with_code(self, email, code, username, password_hash='', password_type=''):
+        user_id = await self.ids.allocate() if password_hash and self.ids is not None else None
+        result = await self._login_with_code(
+            **_login_with_code_args(self.keys, email, code, username, password_hash, password_type, user_id, self.limits,
+                                    self.user_format)
+        )
+        status, user_info = _unpack(email, result)
+        if status == 'registered' and self.ids is not None:
+            try:
+                await self.redis_client.set(user_uuid_key(user_info['uuid']), email)
+            except RedisError:
+                logger.warning("uuid索引写入失败", exc_info=True, extra={'event': 'index.failed', 'email': email})
+        return status, user_info
+
+    async def send_verification_code(self, email, client_ip, new_code):
+        member = uuid.uuid4().hex
+        now = int(time.time() * 1000)
+        reserved = await self._reserve_slot(**_reserve_ip_args(self.keys, client_ip, member, now, self.limits))
+        if _to_str(reserved[0]) == 'limited':
+            return _unpack_send(reserved)
+
+        result = await self._send_verification_code(
+            **_send_verification_code_args(self.keys, email, new_code, member, now, self.limits)
+        )
+        status, value = _unpack_send(result)
+        if status != 'send':
+            await self.redis_client.zrem(self.keys.send_limit_ip_key(client_ip), member)
+        return status, value
+
+    async def allocate_id(self):
+        if self.ids is not None:
+            return await self.ids.allocate()
+        return str(await self.redis_client.incr(USER_COUNTER_KEY))
+
+    async def lookup_users(self, identifiers, by):
+        lookup = lookup_by_uuid_async if by == 'uuid' else lookup_by_email_async
+        return await lookup(self.redis_client, self.keys, identifiers)
+
+    async def get_credentials(self, email):
+        return decode_record(email, await self.redis_client.hmget(self.keys.user_key(email), RECORD_FIELDS))
+
+    async def update_password(self, email, old_hash, new_hash, password_type):
+        result = await self._update_password(**_update_password_args(self.keys, email, old_hash, new_hash,
+                                                                      password_type, self.user_format))
+        if result == NEEDS_PACKED_HASH:
+            result = await self._update_password(**_update_password_args(self.keys, email, old_hash, new_hash,
+                                                                          password_type, self.user_format, True))
+        return result == 1
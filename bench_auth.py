@@ -0,0 +1,356 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import redis
+import yaml
+from mail_queue import MAIL_QUEUE_KEY
+from password_hasher import PasswordHasher, hash_password
+from redis_keys import key_builder
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_DOMAIN = "bench.invalid"
+BENCH_PASSWORD = "bench-password"
+BENCH_CODE = "123456"
+DEFAULT_MIX = "code_login=3,password_login=5,register=1,change_password=1"
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """最小的SMTP服务端，接受认证和邮件后直接丢弃"""
+
+    def handle(self):
+        self.server.count('sessions')
+        self.reply(b"220 bench-sink ESMTP")
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    in_data = False
+                    self.server.count('messages')
+                    self.reply(b"250 OK")
+                continue
+
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply(b"250-bench-sink\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME")
+            elif command == b"AUTH":
+                self.reply(b"235 Authentication successful")
+            elif command == b"DATA":
+                in_data = True
+                self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+            elif command == b"QUIT":
+                self.reply(b"221 Bye")
+                return
+            else:
+                self.reply(b"250 OK")
+
+    def reply(self, data):
+        self.wfile.write(data + b"\r\n")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, SMTPSinkHandler)
+        self.counters = {'sessions': 0, 'messages': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(check, timeout, message):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(message)
+
+
+def start_redis(port, workdir):
+    redis_server = shutil.which('redis-server')
+    if redis_server is None:
+        raise RuntimeError("未找到 redis-server，请安装或使用 --redis-port 指定已有实例")
+    process = subprocess.Popen(
+        [redis_server, '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', workdir],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    client = redis.Redis(port=port)
+    wait_until(client.ping, 10, "redis-server 启动超时")
+    return process
+
+
+def total_commands(redis_client):
+    return sum(stat['calls'] for stat in redis_client.info('commandstats').values())
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def build_plan(mix, total):
+    weight_sum = sum(mix.values())
+    plan = []
+    for name, weight in mix.items():
+        plan.extend([name] * int(round(total * weight / weight_sum)))
+    random.shuffle(plan)
+    return plan
+
+
+def seed(redis_client, keys, plan, password_hash, password_type):
+    """为每个请求预先准备用户和验证码，使压测期间的Redis命令全部来自被测服务"""
+    jobs = []
+    counters = {}
+    pipe = redis_client.pipeline(transaction=False)
+    for index, op in enumerate(plan):
+        counters[op] = counters.get(op, 0) + 1
+        email = f"{op}-{counters[op]}@{BENCH_DOMAIN}"
+        if op in ('code_login', 'password_login', 'change_password'):
+            pipe.hset(keys.user_key(email), mapping={
+                'uuid': str(1000000 + index),
+                'username': email.split('@')[0],
+                'password': password_hash,
+                'password_type': password_type
+            })
+        if op in ('code_login', 'register'):
+            pipe.setex(keys.verification_code_key(email), 3600, BENCH_CODE)
+        jobs.append((op, email))
+        if len(pipe) >= 1000:
+            pipe.execute()
+    pipe.execute()
+    return jobs
+
+
+def request_body(op, email):
+    if op == 'send_code':
+        return '/send_verification_code', {'email': email}
+    if op in ('code_login', 'register'):
+        return '/login', {'email': email, 'code': BENCH_CODE}
+    if op == 'password_login':
+        return '/login', {'email': email, 'password': BENCH_PASSWORD}
+    return '/change_password', {'email': email, 'old_password': BENCH_PASSWORD, 'new_password': BENCH_PASSWORD}
+
+
+class Client(threading.local):
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+
+def run_load(port, jobs, concurrency):
+    client = Client(port)
+    results = []
+    lock = threading.Lock()
+
+    def run(job):
+        op, email = job
+        path, body = request_body(op, email)
+        payload = json.dumps(body)
+        start = time.perf_counter()
+        try:
+            client.connection.request('POST', path, payload, {'Content-Type': 'application/json'})
+            response = client.connection.getresponse()
+            data = json.loads(response.read())
+            ok = response.status == 200 and data.get('success') is True
+        except Exception:
+            client.connection.close()
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            results.append((op, elapsed, ok))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, jobs))
+    return results, time.perf_counter() - started
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(results, duration):
+    ops = {}
+    for op in sorted({op for op, _, _ in results}):
+        latencies = sorted(elapsed for name, elapsed, _ in results if name == op)
+        errors = sum(1 for name, _, ok in results if name == op and not ok)
+        ops[op] = {
+            'count': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / duration,
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99)
+        }
+    return ops
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(result, baseline_path, threshold):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    print(f"\n与基线 {baseline.get('commit')} 对比:")
+    for op, stats in result['ops'].items():
+        base = baseline.get('ops', {}).get(op)
+        if not base:
+            continue
+        throughput_change = stats['throughput'] / base['throughput'] - 1
+        p99_change = stats['p99_ms'] / base['p99_ms'] - 1 if base['p99_ms'] else 0
+        print(f"  {op:<16} 吞吐 {throughput_change:+7.1%}  p99 {p99_change:+7.1%}")
+        if throughput_change < -threshold or p99_change > threshold:
+            regressions.append(op)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='认证接口压测：启动本地Redis、SMTP黑洞和应用，输出可对比的JSON结果')
+    parser.add_argument('-n', '--requests', type=int, default=5000, help='总请求数')
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='请求混合比例，可选 code_login/password_login/register/change_password/send_code')
+    parser.add_argument('--workers', type=int, default=2, help='应用worker进程数')
+    parser.add_argument('--redis-port', type=int, help='使用已启动的Redis实例（会清空其中的db 15）')
+    parser.add_argument('--scrypt-n', type=int, default=16384)
+    parser.add_argument('--output', help='结果JSON路径，默认写入 bench_results/')
+    parser.add_argument('--compare', help='与之前的结果JSON对比')
+    parser.add_argument('--threshold', type=float, default=0.1, help='判定为性能回退的变化比例')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='aurora-bench-')
+    processes = []
+    sink = None
+    try:
+        redis_port = args.redis_port or free_port()
+        if args.redis_port is None:
+            processes.append(start_redis(redis_port, workdir))
+        redis_client = redis.Redis(port=redis_port, db=15)
+        redis_client.flushdb()
+
+        sink = SMTPSink(('127.0.0.1', free_port()))
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+        app_port = free_port()
+        config = {
+            'redis': {'host': '127.0.0.1', 'port': redis_port, 'db': 15, 'decode_responses': True},
+            'smtp': {'server': '127.0.0.1', 'port': sink.server_address[1], 'username': 'bench@bench.invalid',
+                     'password': 'bench', 'starttls': False},
+            'app': {'host': '127.0.0.1', 'port': app_port, 'workers': args.workers},
+            'password': {'scheme': 'scrypt', 'scrypt_n': args.scrypt_n},
+            'rate_limit': {'email_limit': 1000000, 'ip_limit': 1000000, 'cooldown': 0}
+        }
+        config_path = os.path.join(workdir, 'config.yml')
+        with open(config_path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(config, f)
+
+        hasher = PasswordHasher(config['password'])
+        password_hash = hash_password(BENCH_PASSWORD, hasher.scheme, hasher.params)
+        plan = build_plan(parse_mix(args.mix), args.requests)
+        jobs = seed(redis_client, key_builder(config['redis']), plan, password_hash, hasher.scheme)
+
+        processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py')], cwd=workdir))
+        wait_until(lambda: socket.create_connection(('127.0.0.1', app_port), timeout=1).close() or True,
+                   30, "应用启动超时")
+
+        # 预热：建立连接池并加载Lua脚本
+        run_load(app_port, [('password_login', jobs[0][1])] * args.workers * 4, args.workers)
+
+        commands_before = total_commands(redis_client)
+        results, duration = run_load(app_port, jobs, args.concurrency)
+        # INFO 本身计入一次
+        redis_commands = total_commands(redis_client) - commands_before - 1
+
+        # 压测结束后再启动邮件worker，避免其轮询命令计入每请求的Redis命令数
+        processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'mail_worker.py'),
+                                           '--config', config_path], cwd=workdir))
+        wait_until(lambda: redis_client.llen(MAIL_QUEUE_KEY) == 0, 120, "邮件队列未能在超时时间内清空")
+        time.sleep(1)
+
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'settings': {
+                'requests': len(jobs),
+                'concurrency': args.concurrency,
+                'mix': args.mix,
+                'workers': args.workers,
+                'scrypt_n': args.scrypt_n
+            },
+            'duration_s': duration,
+            'throughput': len(results) / duration,
+            'errors': sum(1 for _, _, ok in results if not ok),
+            'redis_commands_per_request': redis_commands / len(results),
+            'smtp_sessions_per_request': sink.counters['sessions'] / len(results),
+            'smtp_messages': sink.counters['messages'],
+            'ops': summarize(results, duration)
+        }
+
+        print(f"总计 {len(results)} 个请求，{result['throughput']:.1f} 请求/秒，错误 {result['errors']}")
+        print(f"每请求Redis命令 {result['redis_commands_per_request']:.2f}，"
+              f"每请求SMTP会话 {result['smtp_sessions_per_request']:.4f}")
+        for op, stats in result['ops'].items():
+            print(f"  {op:<16} {stats['count']:6d} 次  {stats['throughput']:8.1f}/秒  "
+                  f"p50 {stats['p50_ms']:7.2f}ms  p95 {stats['p95_ms']:7.2f}ms  p99 {stats['p99_ms']:7.2f}ms  "
+                  f"错误 {stats['errors']}")
+
+        output = args.output
+        if output is None:
+            os.makedirs(os.path.join(ROOT, 'bench_results'), exist_ok=True)
+            output = os.path.join(ROOT, 'bench_results', f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json")
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {output}")
+
+        if args.compare and compare(result, args.compare, args.threshold):
+            sys.exit(1)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if sink is not None:
+            sink.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
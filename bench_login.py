@@ -0,0 +1,131 @@
+import argparse
+import hashlib
+import statistics
+import time
+import redis
+from auth_scripts import AuthScripts
+from redis_keys import USER_COUNTER_KEY, KeyBuilder
+
+BENCH_DOMAIN = "bench.invalid"
+
+
+class CountingConnection(redis.Connection):
+    """统计发往服务器的请求次数，管道和脚本都只算一次往返"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def legacy_code_login(redis_client, email, code, password_hash):
+    """旧版 /login 验证码路径的命令序列"""
+    redis_client.ping()
+    user_data = redis_client.hgetall(f"user:{email}")
+    stored_code = redis_client.get(f"verification_code:{email}")
+    if stored_code is None or stored_code.decode() != code:
+        return
+    if not user_data:
+        user_id = redis_client.incr("user_counter")
+        redis_client.hset(f"user:{email}", mapping={
+            'uuid': str(user_id),
+            'username': email.split('@')[0],
+            'password': password_hash,
+            'password_type': 'system_generated'
+        })
+    redis_client.delete(f"verification_code:{email}")
+
+
+def legacy_password_login(redis_client, email, password_hash):
+    redis_client.ping()
+    user_data = redis_client.hgetall(f"user:{email}")
+    return user_data.get(b'password') == password_hash.encode()
+
+
+def script_code_login(scripts, redis_client, email, code, password_hash):
+    scripts.login_with_code(email, code, email.split('@')[0], password_hash)
+
+
+def script_password_login(scripts, redis_client, email, password_hash):
+    credentials = scripts.get_credentials(email)
+    return credentials is not None and credentials['password'] == password_hash
+
+
+def run_case(redis_client, name, count, prepare, action):
+    latencies = []
+    round_trips = 0
+    for i in range(count):
+        email = f"bench{i}@{BENCH_DOMAIN}"
+        prepare(email)
+        before = CountingConnection.round_trips
+        start = time.perf_counter()
+        action(email)
+        latencies.append((time.perf_counter() - start) * 1000)
+        round_trips += CountingConnection.round_trips - before
+
+    latencies.sort()
+    print(f"{name:<24} 每次请求往返次数 {round_trips / count:5.2f}  "
+          f"p50 {statistics.median(latencies):.3f}ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.3f}ms")
+
+
+def cleanup(redis_client, keys, count):
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(count):
+        email = f"bench{i}@{BENCH_DOMAIN}"
+        pipe.delete(f"user:{email}", f"verification_code:{email}")
+        pipe.delete(keys.user_key(email), keys.verification_code_key(email))
+    pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比旧版登录流程与Lua脚本登录的Redis往返次数和延迟')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help='基准测试使用的数据库，会写入测试数据')
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool(host=args.host, port=args.port, db=args.db,
+                                connection_class=CountingConnection)
+    redis_client = redis.Redis(connection_pool=pool)
+    # 对比带哈希标签的新key和旧版流程使用的 user:email 格式
+    keys = KeyBuilder(hash_tags=True)
+    scripts = AuthScripts(redis_client, keys=keys)
+    code = '123456'
+    password_hash = hashlib.md5(b'bench-password').hexdigest()
+    counter = redis_client.get(USER_COUNTER_KEY)
+
+    def set_code(email):
+        # 旧版流程使用迁移前不带哈希标签的key
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(f"verification_code:{email}", 300, code)
+        pipe.setex(keys.verification_code_key(email), 300, code)
+        pipe.execute()
+
+    def no_op(email):
+        pass
+
+    try:
+        for label, action in (
+            ('旧版', lambda email: legacy_code_login(redis_client, email, code, password_hash)),
+            ('Lua脚本', lambda email: script_code_login(scripts, redis_client, email, code, password_hash)),
+        ):
+            cleanup(redis_client, keys, args.count)
+            run_case(redis_client, f"{label} 注册", args.count, set_code, action)
+            run_case(redis_client, f"{label} 验证码登录", args.count, set_code, action)
+
+        run_case(redis_client, "旧版 密码登录", args.count, no_op,
+                 lambda email: legacy_password_login(redis_client, email, password_hash))
+        run_case(redis_client, "Lua脚本 密码登录", args.count, no_op,
+                 lambda email: script_password_login(scripts, redis_client, email, password_hash))
+    finally:
+        cleanup(redis_client, keys, args.count)
+        if counter is None:
+            redis_client.delete(USER_COUNTER_KEY)
+        else:
+            redis_client.set(USER_COUNTER_KEY, counter)
+
+
+if __name__ == '__main__':
+    main()
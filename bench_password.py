@@ -0,0 +1,56 @@
+import argparse
+import os
+import time
+from password_hasher import PasswordHasher, verify_password
+
+COST_SETTINGS = (
+    {'scheme': 'scrypt', 'scrypt_n': 2 ** 14, 'scrypt_r': 8, 'scrypt_p': 1},
+    {'scheme': 'scrypt', 'scrypt_n': 2 ** 15, 'scrypt_r': 8, 'scrypt_p': 1},
+    {'scheme': 'scrypt', 'scrypt_n': 2 ** 16, 'scrypt_r': 8, 'scrypt_p': 1},
+    {'scheme': 'pbkdf2_sha256', 'pbkdf2_iterations': 210000},
+    {'scheme': 'pbkdf2_sha256', 'pbkdf2_iterations': 600000},
+)
+
+
+def describe(setting):
+    if setting['scheme'] == 'scrypt':
+        return f"scrypt n=2^{setting['scrypt_n'].bit_length() - 1} r={setting['scrypt_r']} p={setting['scrypt_p']}"
+    return f"pbkdf2_sha256 iterations={setting['pbkdf2_iterations']}"
+
+
+def measure(setting, pool_size, duration):
+    hasher = PasswordHasher(dict(setting, pool_size=pool_size))
+    encoded = hasher.hash('bench-password')
+    # 预热进程池，避免把子进程启动时间计入结果
+    [f.result() for f in [hasher._get_executor().submit(pow, 1, 1) for _ in range(pool_size)]]
+
+    executor = hasher._get_executor()
+    done = 0
+    start = time.perf_counter()
+    pending = [executor.submit(verify_password, 'bench-password', encoded) for _ in range(pool_size * 2)]
+    while pending:
+        future = pending.pop(0)
+        assert future.result()
+        done += 1
+        if time.perf_counter() - start < duration:
+            pending.append(executor.submit(verify_password, 'bench-password', encoded))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    return done / elapsed, elapsed / done * pool_size * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量不同密码哈希参数下每个核心每秒可完成的登录校验次数')
+    parser.add_argument('--pool-size', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--duration', type=float, default=5.0, help='每组参数的测量时长（秒）')
+    args = parser.parse_args()
+
+    print(f"进程池大小 {args.pool_size}")
+    for setting in COST_SETTINGS:
+        per_second, latency = measure(setting, args.pool_size, args.duration)
+        print(f"{describe(setting):<36} 总计 {per_second:8.1f} 次/秒  "
+              f"每核 {per_second / args.pool_size:7.1f} 次/秒  单次 {latency:6.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
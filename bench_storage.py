@@ -0,0 +1,158 @@
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from redis_keys import key_builder, user_uuid_key
+from user_store import USER_STORE_BACKENDS, MemoryUserStore, SQLiteUserStore, create_user_store
+
+BENCH_DOMAIN = "bench.invalid"
+
+# 吞吐测量使用的限流参数，邮箱和IP上限按测量的用户数放宽
+BASE_LIMITS = {
+    'window': 60,
+    'email_limit': 100,
+    'ip_limit': 1000,
+    'cooldown': 0,
+    'code_ttl': 30,
+    'max_code_attempts': 3
+}
+
+
+class Backend:
+    """按名称创建存储实例，记录用到的邮箱和IP以便测量结束后清理Redis中的数据"""
+
+    def __init__(self, name, config_path):
+        self.name = name
+        self.run_id = uuid.uuid4().hex[:8]
+        self.emails = []
+        self.client_ips = []
+        self.user_ids = []
+        self.stores = []
+        self.redis_client = None
+        self.directory = None
+        if name == 'redis':
+            from clear_account import load_config
+            from redis_factory import create_redis_client
+            self.config = load_config(config_path)
+            self.redis_client = create_redis_client(self.config['redis'])
+            self.redis_client.ping()
+        elif name == 'sqlite':
+            self.directory = tempfile.mkdtemp(prefix='aurora-store-')
+
+    def create(self, **overrides):
+        limits = dict(BASE_LIMITS, **overrides)
+        if self.name == 'memory':
+            store = MemoryUserStore(limits)
+        elif self.name == 'sqlite':
+            store = SQLiteUserStore(os.path.join(self.directory, f"{len(self.stores)}.db"), limits)
+        else:
+            store = create_user_store(dict(self.config, rate_limit=limits), self.redis_client)
+        self.stores.append(store)
+        return store
+
+    def email(self, label):
+        email = f"{label}.{len(self.emails)}.{self.run_id}@{BENCH_DOMAIN}"
+        self.emails.append(email)
+        return email
+
+    def client_ip(self):
+        client_ip = f"test-{self.run_id}-{len(self.client_ips)}"
+        self.client_ips.append(client_ip)
+        return client_ip
+
+    def cleanup(self):
+        for store in self.stores:
+            if isinstance(store, SQLiteUserStore):
+                store.close()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        if self.redis_client is None:
+            return
+        keys = key_builder(self.config['redis'])
+        pipe = self.redis_client.pipeline(transaction=False)
+        for email in self.emails:
+            for key in (keys.user_key(email), keys.verification_code_key(email), keys.verification_cooldown_key(email),
+                        keys.verification_attempts_key(email), keys.send_limit_email_key(email)):
+                pipe.delete(key)
+        for client_ip in self.client_ips:
+            pipe.delete(keys.send_limit_ip_key(client_ip))
+        for user_id in self.user_ids:
+            pipe.delete(user_uuid_key(user_id))
+        pipe.execute()
+
+
+def measure(name, count, threads, action):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        local = []
+        for i in range(offset, count, threads):
+            start = time.perf_counter()
+            action(i)
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"  {name:<20} {count / elapsed:9.0f} 次/秒  p50 {statistics.median(latencies):.3f}ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.3f}ms")
+
+
+def run_performance(backend, count, threads):
+    store = backend.create(email_limit=count, ip_limit=count * 4)
+    emails = [backend.email('perf') for _ in range(count)]
+    client_ip = backend.client_ip()
+    codes = {}
+
+    def send(i):
+        codes[i] = store.send_verification_code(emails[i], client_ip, '%06d' % i)[1]
+
+    def register_user(i):
+        status, user_info = store.login_with_code(emails[i], codes[i], 'perf', 'hash', 'scrypt')
+        backend.user_ids.append(user_info['uuid'])
+
+    measure('send_code', count, threads, send)
+    measure('register', count, threads, register_user)
+    measure('get_credentials', count, threads, lambda i: store.get_credentials(emails[i]))
+    measure('lookup(100)', max(1, count // 100), threads,
+            lambda i: store.lookup_users(emails[i * 100:(i + 1) * 100], 'email'))
+
+
+def main():
+    # 各后端行为一致性由 tests/test_user_store.py 覆盖，这里只测量吞吐和延迟
+    parser = argparse.ArgumentParser(description='测量各存储后端的吞吐和延迟')
+    parser.add_argument('--backends', default=','.join(USER_STORE_BACKENDS),
+                        help='逗号分隔的后端列表，redis 需要 --config 中的Redis可用')
+    parser.add_argument('--config', default='./config.yml', help='redis 后端使用的配置文件')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='吞吐测量的用户数')
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    for name in args.backends.split(','):
+        try:
+            backend = Backend(name, args.config)
+        except Exception as e:
+            print(f"[{name}] 跳过: {e}")
+            continue
+        try:
+            print(f"[{name}] 吞吐（{args.threads} 线程）")
+            run_performance(backend, args.count, args.threads)
+        finally:
+            backend.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from metrics import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_BREAKER = {
+    'enabled': True,
+    # 连续失败多少次后断开
+    'failure_threshold': 5,
+    # 断开后多少秒放行一个探测请求
+    'reset_timeout': 5
+}
+
+# 每个worker进程内各路由同时处理的请求上限，0 表示不限制
+DEFAULT_CONCURRENCY_LIMITS = {
+    'send_verification_code': 32,
+    'login': 64
+}
+
+logger = logging.getLogger('aurora.circuit_breaker')
+
+
+class CircuitOpenError(Exception):
+    """依赖处于断开状态，请求未发出即失败"""
+
+
+class CircuitBreaker:
+    """按依赖划分的熔断器，连续失败达到阈值后断开，断开期间直接拒绝，超时后半开放行一个探测请求
+
+    探测成功则闭合，失败则重新断开；探测请求长时间没有结果时允许下一个探测，避免卡在半开状态
+    """
+
+    def __init__(self, name, breaker_config=None, error_class=CircuitOpenError):
+        self.name = name
+        self.error_class = error_class
+        self._lock = threading.Lock()
+        self.configure(breaker_config)
+
+    def configure(self, breaker_config=None):
+        config = dict(DEFAULT_BREAKER)
+        config.update(breaker_config or {})
+        with self._lock:
+            self.enabled = config['enabled']
+            self.failure_threshold = config['failure_threshold']
+            self.reset_timeout = config['reset_timeout']
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = 0.0
+            self.probe_started = None
+
+    def retry_after(self):
+        """断开状态下距离下一次探测的秒数，可以放行时返回 0"""
+        with self._lock:
+            if not self.enabled or self.state == CLOSED:
+                return 0
+            now = time.monotonic()
+            if self.state == OPEN:
+                return max(0.0, self.opened_at + self.reset_timeout - now)
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                return self.reset_timeout - (now - self.probe_started)
+            return 0
+
+    def before_call(self):
+        """允许调用时返回，否则抛出 CircuitOpenError"""
+        if not self.enabled or self.state == CLOSED:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and (self.probe_started is None
+                                            or now - self.probe_started >= self.reset_timeout):
+                self.probe_started = now
+                return
+            if self.state == CLOSED:
+                return
+        metrics.inc('aurora_circuit_rejected_total', dependency=self.name)
+        raise self.error_class(f"{self.name} 熔断中")
+
+    def record_success(self):
+        if not self.enabled or (self.state == CLOSED and not self.failures):
+            return
+        with self._lock:
+            # 断开之前已发出的请求陆续返回不代表已恢复，只由半开状态下的探测结果决定是否闭合
+            if self.state == OPEN:
+                return
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        self.state = state
+        self.probe_started = None
+        metrics.inc('aurora_circuit_transitions_total', dependency=self.name, state=state)
+        log = logger.warning if state == OPEN else logger.info
+        log("熔断器状态变化", extra={'event': 'circuit.' + state, 'dependency': self.name,
+                                  'failures': self.failures})
+
+
+class ConcurrencyLimiter:
+    """非阻塞的并发上限，超出时立即拒绝而不是排队等待，limit 为 0 时不限制"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.limit and self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def concurrency_limiters(limits_config):
+    limits = dict(DEFAULT_CONCURRENCY_LIMITS)
+    limits.update(limits_config or {})
+    return {name: ConcurrencyLimiter(limit) for name, limit in limits.items()}
@@ -1,55 +1,164 @@
-import redis
+import argparse
+import time
 import yaml
-from redis import ConnectionPool, RedisError
+from redis import RedisError
+from redis_factory import create_redis_client, primary_clients
+from redis_keys import USER_COUNTER_KEY
 
-def clear_all_accounts():
-    try:
-        with open('./config.yml', 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-
-        redis_config = config.get('redis', {})
-        redis_pool = ConnectionPool(
-            host=redis_config.get('host', 'localhost'),
-            port=redis_config.get('port', 6379),
-            db=redis_config.get('db', 0),
-            username=redis_config.get('username'),
-            password=redis_config.get('password'),
-            decode_responses=redis_config.get('decode_responses', False)
-        )
-        redis_client = redis.Redis(connection_pool=redis_pool)
+ACCOUNT_PATTERNS = [
+    "user:*",
+    "verification_code:*",
+    "verification_cooldown:*",
+    "verification_attempts:*",
+    "rate_limit:send:*",
+    "user_uuid:*"
+]
+
+
+def load_config(config_path):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f)
+
+
+def load_redis_client(config_path):
+    return create_redis_client(load_config(config_path).get('redis', {}))
+
+
+def iter_node_batches(node_client, pattern, scan_count, batch_size):
+    """在单个节点上使用SCAN逐批遍历key，任何时刻只在内存中保留一个批次"""
+    batch = []
+    for key in node_client.scan_iter(match=pattern, count=scan_count):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_batches(redis_client, pattern, scan_count, batch_size):
+    """依次扫描每个主节点，集群模式下覆盖全部槽"""
+    for node_client in primary_clients(redis_client):
+        yield from iter_node_batches(node_client, pattern, scan_count, batch_size)
+
+
+def filter_idle(redis_client, keys, min_idle):
+    """按 OBJECT IDLETIME 过滤出超过指定空闲秒数的key"""
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.object('idletime', key)
+    idle_times = pipe.execute(raise_on_error=False)
+    return [key for key, idle in zip(keys, idle_times)
+            if isinstance(idle, int) and idle >= min_idle]
+
+
+def unlink_batch(redis_client, keys):
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.unlink(key)
+    return sum(r for r in pipe.execute() if isinstance(r, int))
+
+
+class Throttle:
+    """限制每秒处理的key数量，避免维护任务占满Redis"""
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.started = time.monotonic()
+        self.processed = 0
 
+    def wait(self, count):
+        self.processed += count
+        if not self.max_rate:
+            return
+        expected = self.processed / self.max_rate
+        elapsed = time.monotonic() - self.started
+        if expected > elapsed:
+            time.sleep(expected - elapsed)
+
+
+def clear_keys(redis_client, patterns, scan_count=1000, batch_size=500, min_idle=None,
+               dry_run=False, max_rate=None, progress_interval=5.0):
+    matched = 0
+    deleted = 0
+    throttle = Throttle(max_rate)
+    last_report = time.monotonic()
+    started = last_report
+
+    for pattern in patterns:
+        for node_client in primary_clients(redis_client):
+            # 每个批次的key都来自同一节点，直接使用该节点的连接执行管道
+            for batch in iter_node_batches(node_client, pattern, scan_count, batch_size):
+                if min_idle is not None:
+                    batch = filter_idle(node_client, batch, min_idle)
+                matched += len(batch)
+                if batch and not dry_run:
+                    deleted += unlink_batch(node_client, batch)
+                throttle.wait(len(batch))
+
+                now = time.monotonic()
+                if now - last_report >= progress_interval:
+                    rate = matched / max(now - started, 1e-6)
+                    print(f"[{pattern}] 已匹配 {matched} 个key，已删除 {deleted} 个，{rate:.0f} key/秒")
+                    last_report = now
+
+    return matched, deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AuroraID 账户数据维护工具（SCAN + 批量UNLINK，不阻塞Redis）')
+    parser.add_argument('--config', default='./config.yml', help='配置文件路径')
+    parser.add_argument('--pattern', action='append', dest='patterns',
+                        help='要清理的key模式，可重复指定，默认清理全部账户相关数据')
+    parser.add_argument('--min-idle', type=int, help='只清理空闲时间超过该秒数的key（OBJECT IDLETIME）')
+    parser.add_argument('--scan-count', type=int, default=1000, help='每次SCAN的COUNT参数')
+    parser.add_argument('--batch-size', type=int, default=500, help='每个UNLINK管道包含的key数量')
+    parser.add_argument('--max-rate', type=int, help='每秒最多处理的key数量')
+    parser.add_argument('--dry-run', action='store_true', help='只统计匹配数量，不删除')
+    parser.add_argument('--yes', action='store_true', help='跳过确认提示')
+    args = parser.parse_args()
+
+    patterns = args.patterns or ACCOUNT_PATTERNS
+    clear_all = args.patterns is None and args.min_idle is None
+
+    if not args.dry_run and not args.yes:
+        confirmation = input(f"确定要清除匹配 {', '.join(patterns)} 的数据吗？此操作不可恢复！(输入 'YES' 确认): ")
+        if confirmation != 'YES':
+            print("操作已取消")
+            return
+
+    try:
+        redis_client = load_redis_client(args.config)
         redis_client.ping()
         print("Redis连接成功")
-        
-        user_keys = redis_client.keys("user:*")
-        verification_keys = redis_client.keys("verification_code:*")
-        
-        print(f"找到 {len(user_keys)} 个用户账户")
-        print(f"找到 {len(verification_keys)} 个验证码记录")
-        
-        if user_keys:
-            redis_client.delete(*user_keys)
-            print("用户账户已删除")
-            
-        if verification_keys:
-            redis_client.delete(*verification_keys)
-            print("验证码记录已删除")
-
-        redis_client.delete("user_counter")
-        print("用户计数器已重置")
-        
-        print("所有账户数据已清除完成")
-        
+
+        matched, deleted = clear_keys(
+            redis_client,
+            patterns,
+            scan_count=args.scan_count,
+            batch_size=args.batch_size,
+            min_idle=args.min_idle,
+            dry_run=args.dry_run,
+            max_rate=args.max_rate
+        )
+
+        if args.dry_run:
+            print(f"共匹配 {matched} 个key（未删除）")
+            return
+
+        print(f"共匹配 {matched} 个key，已删除 {deleted} 个")
+        if clear_all:
+            redis_client.delete(USER_COUNTER_KEY)
+            print("用户计数器已重置")
+        print("清理完成")
+
     except RedisError as e:
         print(f"Redis错误: {str(e)}")
     except FileNotFoundError:
-        print("配置文件 config.yml 未找到")
+        print(f"配置文件 {args.config} 未找到")
     except Exception as e:
         print(f"发生错误: {str(e)}")
 
+
 if __name__ == "__main__":
-    confirmation = input("确定要清除所有账户数据吗？此操作不可恢复！(输入 'YES' 确认): ")
-    if confirmation == 'YES':
-        clear_all_accounts()
-    else:
-        print("操作已取消")
\ No newline at end of file
+    main()
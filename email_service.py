@@ -3,9 +3,213 @@ import random
 import ssl
 import string
 import os
-import traceback
-from email.mime.text import MIMEText
+import logging
+import threading
+import time
+import base64
+from collections import deque
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from metrics import metrics
+
+logger = logging.getLogger('aurora.email')
+
+def is_smtp_unhealthy(error):
+    """连接、握手和认证失败计入熔断，收件人被拒等单封邮件的错误说明服务器本身正常"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                          smtplib.SMTPAuthenticationError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def create_ssl_context():
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= 0x4
+    context.options |= 0x8
+    context.options |= 0x10
+    return context
+
+
+class SMTPConnectionPool:
+    """复用已认证的SMTP会话，每个会话只进行一次TLS握手和登录"""
+
+    def __init__(self, server, port, username, password, max_size=4, idle_timeout=60, timeout=30,
+                 starttls=True, breaker_config=None):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.starttls = starttls
+        self.ssl_context = create_ssl_context()
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.breaker = CircuitBreaker('smtp', breaker_config)
+
+    def _connect(self):
+        logger.debug("连接到SMTP服务器", extra={'event': 'smtp.connect', 'server': self.server, 'port': self.port})
+        metrics.inc('aurora_smtp_sessions_total')
+        with metrics.timer('aurora_smtp_duration_seconds', stage='connect'):
+            server = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                with metrics.timer('aurora_smtp_duration_seconds', stage='starttls'):
+                    server.starttls(context=self.ssl_context)
+            with metrics.timer('aurora_smtp_duration_seconds', stage='login'):
+                server.login(self.username, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        return server
+
+    def _close(self, server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _is_alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _take_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                server, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self.idle_timeout or not self._is_alive(server):
+                self._close(server)
+                continue
+            return server
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        server = None
+        try:
+            server = self._take_idle() or self._connect()
+            yield server
+        except Exception:
+            if server is not None:
+                self._close(server)
+                server = None
+            raise
+        finally:
+            if server is not None:
+                with self._lock:
+                    self._idle.append((server, time.monotonic()))
+            self._slots.release()
+
+    def send(self, msg):
+        """熔断期间直接抛出 CircuitOpenError，不再等待连接超时"""
+        self.breaker.before_call()
+        try:
+            self._send(msg)
+        except Exception as e:
+            if is_smtp_unhealthy(e):
+                self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    def _send(self, msg):
+        try:
+            with self.connection() as server:
+                with metrics.timer('aurora_smtp_duration_seconds', stage='send'):
+                    server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # 池中连接可能在NOOP检查之后被服务器断开，使用新连接重试一次
+            logger.warning("SMTP连接已断开，重新连接后重试", extra={'event': 'smtp.reconnect'})
+            with self.connection() as server:
+                server.send_message(msg)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for server, _ in idle:
+            self._close(server)
+
+
+class EmailTemplate:
+    """缓存邮件模板，按占位符拆分为前后两段并预先完成base64编码，文件修改后自动重新加载"""
+
+    # base64每行76个字符，对应57个原始字节，按此对齐可以直接拼接预编码的行
+    LINE_BYTES = 57
+
+    def __init__(self, path, placeholder, check_interval=1.0):
+        self.path = path
+        self.placeholder = placeholder
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._state = None
+        self._checked_at = 0.0
+
+    def _load(self, mtime):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            html = f.read()
+
+        segments = [segment.encode('utf-8') for segment in html.split(self.placeholder)]
+        if len(segments) != 2:
+            # 占位符不是恰好出现一次时不做拆分，发送时整体编码
+            return {'mtime': mtime, 'html': html}
+
+        prefix, suffix = segments
+        cut = len(prefix) - len(prefix) % self.LINE_BYTES
+        return {
+            'mtime': mtime,
+            'prefix_encoded': base64.encodebytes(prefix[:cut]),
+            'prefix_tail': prefix[cut:],
+            'suffix': suffix,
+            'suffix_encoded': {}
+        }
+
+    def _current(self):
+        state = self._state
+        now = time.monotonic()
+        if state is not None and now - self._checked_at < self.check_interval:
+            return state
+
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if self._state is None or self._state['mtime'] != mtime:
+                self._state = self._load(mtime)
+            self._checked_at = now
+            return self._state
+
+    def render(self, value):
+        """返回替换占位符后HTML正文的base64编码"""
+        state = self._current()
+        if 'html' in state:
+            return base64.encodebytes(state['html'].replace(self.placeholder, value).encode('utf-8'))
+
+        middle = state['prefix_tail'] + value.encode('utf-8')
+        suffix = state['suffix']
+        split = min((-len(middle)) % self.LINE_BYTES, len(suffix))
+        middle += suffix[:split]
+
+        suffix_encoded = state['suffix_encoded'].get(split)
+        if suffix_encoded is None:
+            suffix_encoded = base64.encodebytes(suffix[split:])
+            state['suffix_encoded'][split] = suffix_encoded
+
+        return state['prefix_encoded'] + base64.encodebytes(middle) + suffix_encoded
+
+    def build_part(self, value):
+        part = MIMENonMultipart('text', 'html', charset='utf-8')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(self.render(value).decode('ascii'))
+        return part
+
 
 class EmailVerificationService:
     def __init__(self, smtp_config, redis_client):
@@ -15,8 +219,25 @@ class EmailVerificationService:
         self.password = smtp_config['password']
         self.template_path = os.path.join(os.path.dirname(__file__), './templates/email_template.html')
         self.welcome_template_path = os.path.join(os.path.dirname(__file__), './templates/welcome_template.html')
+        self.verification_template = EmailTemplate(self.template_path, '{code}')
+        self.welcome_template = EmailTemplate(self.welcome_template_path, '{password}')
         self.redis_client = redis_client
+        self.smtp_pool = SMTPConnectionPool(
+            self.smtp_server,
+            self.smtp_port,
+            self.username,
+            self.password,
+            max_size=smtp_config.get('pool_size', 4),
+            idle_timeout=smtp_config.get('idle_timeout', 60),
+            timeout=smtp_config.get('timeout', 30),
+            starttls=smtp_config.get('starttls', True),
+            breaker_config=smtp_config.get('circuit_breaker')
+        )
     
+    def retry_after(self):
+        """SMTP熔断期间返回距离下一次探测的秒数，发信worker据此暂停取任务"""
+        return self.smtp_pool.breaker.retry_after()
+
     def generate_verification_code(self, length=6):
         return ''.join(random.choices(string.digits, k=length))
 
@@ -27,80 +248,30 @@ class EmailVerificationService:
             msg['To'] = to_email
             msg['Subject'] = "AuroraID 动态密码"
 
-            with open(self.template_path, 'r', encoding='utf-8') as f:
-                html_template = f.read()
-
-            html_body = html_template.replace('{code}', code)
-
-            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-
-            context = ssl.create_default_context()
-            context.minimum_version = ssl.TLSVersion.TLSv1_2
-            context.options |= 0x4
-            context.options |= 0x8
-            context.options |= 0x10
-
-            print(f"连接到SMTP服务器: {self.smtp_server}:{self.smtp_port}")
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.set_debuglevel(1) 
-            print("启动TLS加密")
-            server.starttls(context=context)
-            print(f"尝试使用用户名 {self.username} 进行身份验证")
-            server.login(self.username, self.password)
-            print("发送邮件")
-            server.send_message(msg)
-            print("关闭SMTP连接")
-            server.quit()
+            with metrics.stage('send_verification_email.render'):
+                msg.attach(self.verification_template.build_part(code))
+
+            with metrics.stage('send_verification_email.smtp'):
+                self.smtp_pool.send(msg)
             
-            print("邮件发送成功")
+            logger.info("邮件发送成功", extra={'event': 'mail.sent', 'kind': 'verification', 'email': to_email})
             return True
-        except smtplib.SMTPAuthenticationError as e:
-            print(f"SMTP认证失败: {e}")
-            traceback.print_exc()
+        except CircuitOpenError:
+            logger.warning("SMTP熔断中，稍后重试", extra={'event': 'mail.failed', 'kind': 'verification', 'email': to_email})
             return False
-        except smtplib.SMTPException as e:
-            print(f"SMTP错误: {e}")
-            traceback.print_exc()
+        except smtplib.SMTPAuthenticationError:
+            logger.exception("SMTP认证失败", extra={'event': 'mail.failed', 'kind': 'verification', 'email': to_email})
             return False
-        except FileNotFoundError as e:
-            print(f"找不到HTML模板文件: {e}")
-            traceback.print_exc()
+        except smtplib.SMTPException:
+            logger.exception("SMTP错误", extra={'event': 'mail.failed', 'kind': 'verification', 'email': to_email})
             return False
-        except Exception as e:
-            print(f"发送邮件失败: {e}")
-            traceback.print_exc()
+        except FileNotFoundError:
+            logger.exception("找不到HTML模板文件", extra={'event': 'mail.failed', 'kind': 'verification', 'email': to_email})
             return False
-    
-    def store_verification_code(self, email, code, expire_time=300):
-        try:
-            key = f"verification_code:{email}"
-            self.redis_client.setex(key, expire_time, code)
-            print(f"验证码 {code} 已存储到Redis，key为 {key}")
-            return True
-        except Exception as e:
-            print(f"存储验证码到Redis失败: {e}")
-            traceback.print_exc()
+        except Exception:
+            logger.exception("发送邮件失败", extra={'event': 'mail.failed', 'kind': 'verification', 'email': to_email})
             return False
     
-    def verify_code(self, email, code):
-        try:
-            key = f"verification_code:{email}"
-            stored_code = self.redis_client.get(key)
-            print(f"从Redis获取key {key} 的值: {stored_code}")
-            
-            if not stored_code:
-                return False, "验证码已过期或不存在"
-            
-            if stored_code == code:
-                self.redis_client.delete(key)
-                return True, "验证成功"
-            else:
-                return False, "验证码错误"
-        except Exception as e:
-            print(f"验证验证码时出错: {e}")
-            traceback.print_exc()
-            return False, "服务器内部错误"
-        
     def send_welcome_email(self, to_email, password):
         try:
             msg = MIMEMultipart()
@@ -108,46 +279,24 @@ class EmailVerificationService:
             msg['To'] = to_email
             msg['Subject'] = "感谢您注册 AuroraID ！"
 
-            with open(self.welcome_template_path, 'r', encoding='utf-8') as f:
-                welcomehtml_template = f.read()
-
-            html_body = welcomehtml_template.replace('{password}', password)
-
-            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-
-            context = ssl.create_default_context()
-            context.minimum_version = ssl.TLSVersion.TLSv1_2
-            context.options |= 0x4
-            context.options |= 0x8
-            context.options |= 0x10
-
-            print(f"连接到SMTP服务器: {self.smtp_server}:{self.smtp_port}")
-            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-            server.set_debuglevel(1) 
-            print("启动TLS加密")
-            server.starttls(context=context)
-            print(f"尝试使用用户名 {self.username} 进行身份验证")
-            server.login(self.username, self.password)
-            print("发送邮件")
-            server.send_message(msg)
-            print("关闭SMTP连接")
-            server.quit()
+            msg.attach(self.welcome_template.build_part(password))
+
+            self.smtp_pool.send(msg)
             
-            print("邮件发送成功")
+            logger.info("邮件发送成功", extra={'event': 'mail.sent', 'kind': 'welcome', 'email': to_email})
             return True
-        except smtplib.SMTPAuthenticationError as e:
-            print(f"SMTP认证失败: {e}")
-            traceback.print_exc()
+        except CircuitOpenError:
+            logger.warning("SMTP熔断中，稍后重试", extra={'event': 'mail.failed', 'kind': 'welcome', 'email': to_email})
             return False
-        except smtplib.SMTPException as e:
-            print(f"SMTP错误: {e}")
-            traceback.print_exc()
+        except smtplib.SMTPAuthenticationError:
+            logger.exception("SMTP认证失败", extra={'event': 'mail.failed', 'kind': 'welcome', 'email': to_email})
             return False
-        except FileNotFoundError as e:
-            print(f"找不到HTML模板文件: {e}")
-            traceback.print_exc()
+        except smtplib.SMTPException:
+            logger.exception("SMTP错误", extra={'event': 'mail.failed', 'kind': 'welcome', 'email': to_email})
             return False
-        except Exception as e:
-            print(f"发送邮件失败: {e}")
-            traceback.print_exc()
+        except FileNotFoundError:
+            logger.exception("找不到HTML模板文件", extra={'event': 'mail.failed', 'kind': 'welcome', 'email': to_email})
+            return False
+        except Exception:
+            logger.exception("发送邮件失败", extra={'event': 'mail.failed', 'kind': 'welcome', 'email': to_email})
             return False
\ No newline at end of file
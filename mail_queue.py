@@ -0,0 +1,241 @@
+import json
+import time
+import random
+import logging
+
+# 队列相关的key共用 {mail_queue} 哈希标签，集群模式下 BRPOPLPUSH 和重试脚本不会跨槽
+MAIL_QUEUE_KEY = "{mail_queue}"
+MAIL_PROCESSING_KEY = "{mail_queue}:processing"
+MAIL_DELAYED_KEY = "{mail_queue}:delayed"
+MAIL_DEAD_KEY = "{mail_queue}:dead"
+
+# KEYS[1] 处理中列表  KEYS[2] 死信列表或延迟重试集合  ARGV[1] 原任务  ARGV[2] 新任务
+# ARGV[3] 重试时间，为空时转入死信  ARGV[4] 死信列表保留的最大条数
+# 代替 MULTI 事务，集群模式下同样原子执行
+RESCHEDULE = """
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+if ARGV[3] == '' then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+    redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[4]) - 1)
+else
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+end
+return 1
+"""
+
+logger = logging.getLogger('aurora.mail_queue')
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _encode_job(kind, to_email, payload):
+    job = {
+        'kind': kind,
+        'to': to_email,
+        'payload': payload,
+        'attempts': 0,
+        'created_at': time.time()
+    }
+    return json.dumps(job, ensure_ascii=False)
+
+
+# 各类邮件载荷中必需的字段，验证码和初始密码只在发送前保留，任务过期或转入死信时丢弃
+PAYLOAD_FIELDS = {'verification': 'code', 'welcome': 'password'}
+
+
+def is_valid_job(job):
+    if not isinstance(job, dict) or not isinstance(job.get('to'), str):
+        return False
+    field = PAYLOAD_FIELDS.get(job.get('kind'))
+    payload = job.get('payload')
+    return field is not None and isinstance(payload, dict) and isinstance(payload.get(field), str)
+
+
+def _dead_entry(job, reason):
+    """死信只保留排查所需的元数据，去掉验证码和初始密码"""
+    entry = {'reason': reason, 'dead_at': time.time()}
+    if isinstance(job, dict):
+        for field in ('kind', 'to', 'attempts', 'created_at'):
+            if field in job:
+                entry[field] = job[field]
+    return json.dumps(entry, ensure_ascii=False)
+
+
+class MailQueue:
+    """基于Redis列表的持久化发信队列，请求线程只负责入队"""
+
+    def __init__(self, redis_client, queue_config=None, worker_id='default', code_ttl=300):
+        queue_config = queue_config or {}
+        self.redis_client = redis_client
+        self.max_attempts = queue_config.get('max_attempts', 5)
+        self.base_delay = queue_config.get('base_delay', 2)
+        self.max_delay = queue_config.get('max_delay', 300)
+        self.dead_max_len = max(1, queue_config.get('dead_max_len', 1000))
+        # 超过验证码有效期的验证码邮件不再发送；欢迎邮件超过 welcome_ttl 后转入死信，队列中不再保留初始密码
+        self.code_ttl = code_ttl
+        self.welcome_ttl = queue_config.get('welcome_ttl', 3600)
+        self.processing_key = f"{MAIL_PROCESSING_KEY}:{worker_id}"
+        self._reschedule = redis_client.register_script(RESCHEDULE)
+
+    def enqueue(self, kind, to_email, payload):
+        try:
+            self.redis_client.lpush(MAIL_QUEUE_KEY, _encode_job(kind, to_email, payload))
+            return True
+        except Exception:
+            logger.exception("邮件入队失败", extra={'event': 'mail.enqueue_failed', 'kind': kind, 'email': to_email})
+            return False
+
+    def enqueue_verification(self, to_email, code):
+        return self.enqueue('verification', to_email, {'code': code})
+
+    def enqueue_welcome(self, to_email, password):
+        return self.enqueue('welcome', to_email, {'password': password})
+
+    def recover_processing(self):
+        """将上次异常退出时未确认的任务放回队列"""
+        recovered = 0
+        while self.redis_client.rpoplpush(self.processing_key, MAIL_QUEUE_KEY) is not None:
+            recovered += 1
+        return recovered
+
+    def promote_due(self):
+        """将到期的重试任务移回主队列"""
+        due = self.redis_client.zrangebyscore(MAIL_DELAYED_KEY, 0, time.time(), start=0, num=100)
+        for raw in due:
+            # 多个worker并发时只有成功ZREM的一方负责入队
+            if self.redis_client.zrem(MAIL_DELAYED_KEY, raw):
+                self.redis_client.lpush(MAIL_QUEUE_KEY, raw)
+        return len(due)
+
+    def fetch(self, timeout=2):
+        raw = self.redis_client.brpoplpush(MAIL_QUEUE_KEY, self.processing_key, timeout)
+        return _to_str(raw) if raw is not None else None
+
+    def ack(self, raw):
+        self.redis_client.lrem(self.processing_key, 1, raw)
+
+    def is_expired(self, job, at=None):
+        ttl = self.code_ttl if job.get('kind') == 'verification' else self.welcome_ttl
+        return (at if at is not None else time.time()) - job.get('created_at', 0) > ttl
+
+    def expire(self, raw, job):
+        """过期的验证码邮件直接丢弃，用户可以重新获取；欢迎邮件转入死信以便排查"""
+        if job.get('kind') == 'verification':
+            logger.warning("验证码已过期，不再发送", extra={'event': 'mail.expired', 'email': job['to'],
+                                                       'attempts': job.get('attempts', 0)})
+            self.ack(raw)
+            return
+        logger.error("邮件超过有效期仍未发送，已转入死信队列",
+                     extra={'event': 'mail.dead', 'kind': job.get('kind'), 'email': job.get('to')})
+        self.dead(raw, job, 'expired')
+
+    def dead(self, raw, job, reason):
+        self._reschedule(keys=[self.processing_key, MAIL_DEAD_KEY],
+                         args=[raw, _dead_entry(job, reason), '', self.dead_max_len])
+
+    def retry(self, raw, job):
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] >= self.max_attempts:
+            self.dead(raw, job, 'max_attempts')
+            logger.error("邮件多次发送失败，已转入死信队列",
+                         extra={'event': 'mail.dead', 'kind': job.get('kind'), 'email': job.get('to')})
+            return False
+
+        delay = min(self.max_delay, self.base_delay * (2 ** (job['attempts'] - 1)))
+        delay = delay * (0.5 + random.random() / 2)
+        if self.is_expired(job, time.time() + delay):
+            # 重试时已经过期，不再把验证码或密码写入延迟队列
+            self.expire(raw, job)
+            return False
+        self._reschedule(keys=[self.processing_key, MAIL_DELAYED_KEY],
+                         args=[raw, json.dumps(job, ensure_ascii=False), time.time() + delay, self.dead_max_len])
+        logger.warning("邮件发送失败，稍后重试", extra={
+            'event': 'mail.retry', 'kind': job.get('kind'), 'attempts': job['attempts'], 'delay': round(delay, 1)
+        })
+        return True
+
+
+class AsyncMailQueue:
+    """供asyncio模式使用的入队端，与 MailQueue 共用同一个队列和worker"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    async def enqueue(self, kind, to_email, payload):
+        try:
+            await self.redis_client.lpush(MAIL_QUEUE_KEY, _encode_job(kind, to_email, payload))
+            return True
+        except Exception:
+            logger.exception("邮件入队失败", extra={'event': 'mail.enqueue_failed', 'kind': kind, 'email': to_email})
+            return False
+
+    async def enqueue_verification(self, to_email, code):
+        return await self.enqueue('verification', to_email, {'code': code})
+
+    async def enqueue_welcome(self, to_email, password):
+        return await self.enqueue('welcome', to_email, {'password': password})
+
+
+def deliver(email_service, job):
+    """job 已通过 is_valid_job 校验"""
+    kind = job['kind']
+    payload = job['payload']
+    if kind == 'verification':
+        return email_service.send_verification_email(job['to'], payload['code'])
+    return email_service.send_welcome_email(job['to'], payload['password'])
+
+
+def process_job(mail_queue, email_service, raw):
+    """处理一个已取出的任务，无论结果如何任务都会离开处理中列表，返回 sent / retry / dead / expired / invalid"""
+    try:
+        job = json.loads(raw)
+    except ValueError:
+        job = None
+    if not is_valid_job(job):
+        # 任务内容包含验证码或初始密码，只记录长度
+        logger.error("无效的邮件任务，已转入死信队列", extra={'event': 'mail.bad_job', 'size': len(raw)})
+        mail_queue.dead(raw, job, 'invalid')
+        return 'invalid'
+    if mail_queue.is_expired(job):
+        mail_queue.expire(raw, job)
+        return 'expired'
+
+    try:
+        delivered = deliver(email_service, job)
+    except Exception:
+        logger.exception("发送邮件时出错", extra={'event': 'mail.deliver_error', 'kind': job['kind'],
+                                                 'email': job['to']})
+        delivered = False
+    if delivered:
+        mail_queue.ack(raw)
+        return 'sent'
+    if mail_queue.retry(raw, job):
+        return 'retry'
+    return 'dead'
+
+
+def run_worker(mail_queue, email_service, poll_timeout=2):
+    recovered = mail_queue.recover_processing()
+    if recovered:
+        logger.info("已恢复未完成的邮件任务", extra={'event': 'mail.recovered', 'count': recovered})
+
+    logger.info("邮件队列worker已启动", extra={'event': 'mail.worker_started'})
+    while True:
+        try:
+            # SMTP熔断期间任务留在队列中，不消耗重试次数
+            wait = email_service.retry_after()
+            if wait:
+                time.sleep(min(wait, poll_timeout))
+                continue
+            mail_queue.promote_due()
+            raw = mail_queue.fetch(poll_timeout)
+            if raw is not None:
+                process_job(mail_queue, email_service, raw)
+        except KeyboardInterrupt:
+            logger.info("邮件队列worker已停止", extra={'event': 'mail.worker_stopped'})
+            break
+        except Exception:
+            logger.exception("邮件队列处理异常", extra={'event': 'mail.worker_error'})
+            time.sleep(1)
@@ -0,0 +1,42 @@
+import argparse
+import sys
+import yaml
+from email_service import EmailVerificationService
+from mail_queue import MailQueue, run_worker
+from metrics import metrics
+from structured_logging import setup_logging
+from redis_factory import create_redis_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AuroraID 邮件发送worker')
+    parser.add_argument('--config', default='./config.yml', help='配置文件路径')
+    parser.add_argument('--worker-id', default='default', help='worker标识，多个worker需各不相同')
+    args = parser.parse_args()
+
+    try:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+    except FileNotFoundError:
+        print(f"配置文件 {args.config} 未找到")
+        sys.exit(1)
+
+    try:
+        redis_client = create_redis_client(config['redis'])
+        redis_client.ping()
+    except Exception as e:
+        print(f"无法连接到Redis: {e}")
+        sys.exit(1)
+
+    setup_logging(config.get('logging', {}))
+    # 与Web进程使用同一目录时，SMTP耗时会出现在 /metrics 的汇总结果中
+    metrics.configure(config.get('metrics', {}))
+    queue_config = config.get('mail_queue', {})
+    email_service = EmailVerificationService(config['smtp'], redis_client)
+    mail_queue = MailQueue(redis_client, queue_config, worker_id=args.worker_id,
+                           code_ttl=config.get('rate_limit', {}).get('code_ttl', 300))
+    run_worker(mail_queue, email_service, poll_timeout=queue_config.get('poll_timeout', 2))
+
+
+if __name__ == '__main__':
+    main()
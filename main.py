@@ -1,11 +1,25 @@
 import yaml
 import os
+import secrets
 import sys
-from flask import Flask, render_template
-import redis
+import time
+from flask import Flask, Response, g, jsonify, render_template, request
 from flask_cors import CORS
 from email_service import EmailVerificationService
+from audit_events import AuditLog
 from auth_routes import auth_bp
+from circuit_breaker import concurrency_limiters
+from redis_factory import close_redis_client, create_redis_client
+from request_profiler import ADMIN_HEADER, DEFAULT_PROFILING, PROFILE_HEADER, RequestProfiler
+from password_hasher import PasswordHasher
+from mail_queue import MailQueue
+from metrics import clear_directory, metrics
+from structured_logging import setup_logging
+from session_tokens import TokenService
+from user_cache import UserCache
+from user_codec import FORMATS
+from user_lookup import lookup_config
+from user_store import USER_STORE_BACKENDS, create_user_store, user_store_backend
 def create_default_config():
     """创建默认配置文件"""
     default_config = {
@@ -13,20 +27,151 @@ def create_default_config():
             'server': 'smtp.example.com',
             'port': 587,
             'username': 'your-email@example.com',
-            'password': 'your-password'
+            'password': 'your-password',
+            'pool_size': 4,
+            'idle_timeout': 60,
+            'timeout': 30,
+            # 连续失败达到阈值后发信worker暂停取任务，reset_timeout 秒后用一封邮件探测
+            'circuit_breaker': {
+                'enabled': True,
+                'failure_threshold': 5,
+                'reset_timeout': 30
+            }
         },
         'redis': {
+            # standalone / sentinel / cluster
+            # 集群模式下用户相关的key带邮箱哈希标签（user:{email}）；单节点迁移到集群时，停服后执行
+            # user_tool.py migrate-keys，再切换为 cluster 或设置 hash_tags: true
+            'mode': 'standalone',
             'host（不要携带http和https！）': 'localhost',
             'port': 6379,
             'db': 0,
             'username': 'default',
             'password': '',
-            'decode_responses': True
+            'decode_responses': True,
+            'max_connections': 50,
+            'pool_timeout': 5,
+            'socket_timeout': 5,
+            'socket_connect_timeout': 2,
+            'socket_keepalive': True,
+            'health_check_interval': 30,
+            # 集群模式下每个worker一次从 user_counter 预留的用户ID数量，其他模式在注册脚本中逐个INCR
+            'id_block_size': 100,
+            # 连续的连接或超时错误达到阈值后直接返回503，reset_timeout 秒后放行一个探测请求
+            'circuit_breaker': {
+                'enabled': True,
+                'failure_threshold': 5,
+                'reset_timeout': 5
+            },
+            'sentinel': {
+                'service_name': 'mymaster',
+                'nodes': [{'host': 'localhost', 'port': 26379}],
+                'password': ''
+            },
+            'cluster': {
+                'nodes': [{'host': 'localhost', 'port': 7000}],
+                'read_from_replicas': False
+            }
+        },
+        'password': {
+            'scheme': 'scrypt',
+            'scrypt_n': 16384,
+            'scrypt_r': 8,
+            'scrypt_p': 1,
+            'pbkdf2_iterations': 600000,
+            # 每个worker的哈希进程数，0 表示 CPU核数 // worker数，至少为1
+            'pool_size': 0
+        },
+        'rate_limit': {
+            'window': 3600,
+            'email_limit': 5,
+            'ip_limit': 20,
+            'cooldown': 60,
+            'code_ttl': 300,
+            'max_code_attempts': 5
+        },
+        'mail_queue': {
+            'max_attempts': 5,
+            'base_delay': 2,
+            'max_delay': 300,
+            'poll_timeout': 2,
+            # 死信只保留收件人、类型和失败原因，超出条数时丢弃最旧的
+            'dead_max_len': 1000,
+            # 欢迎邮件中的初始密码在队列中最多保留的秒数，超过后不再发送并转入死信
+            'welcome_ttl': 3600
+        },
+        'metrics': {
+            'directory': './metrics_data',
+            'flush_interval': 1
+        },
+        'audit': {
+            # 登录、注册、修改密码等事件写入Redis Stream audit_events，由 audit_consumer.py 按分钟聚合
+            'enabled': True,
+            'max_len': 1000000,
+            'flush_interval': 1.0,
+            'batch_size': 500,
+            'buffer_size': 10000,
+            # 邮箱和IP写入Stream前脱敏；配置该密钥后改为写入带密钥的哈希，便于按用户或IP关联事件
+            'hash_key': ''
+        },
+        'profiling': {
+            # 开启后记录每个请求的阶段耗时和Redis命令，超过 slow_threshold_ms 的请求可通过 /debug/slow_requests 查看
+            # 抽样或带 X-Profile-Token 请求头的请求在 cProfile 下执行，统计写入 directory，可用 snakeviz 等工具查看
+            'enabled': False,
+            'sample_rate': 0.0,
+            'admin_token': '',
+            'directory': './profiles',
+            'max_files': 200,
+            'slow_threshold_ms': 500,
+            'slow_capacity': 50,
+            'max_commands': 100
+        },
+        'concurrency_limits': {
+            # 每个worker进程内同时处理的请求数上限，超出时立即返回503，0 表示不限制
+            'send_verification_code': 32,
+            'login': 64
+        },
+        'user_storage': {
+            # redis / memory / sqlite，memory 只在单个进程内有效，prefork 多worker时请使用 sqlite 或 redis
+            # 邮件队列和令牌吊销列表始终使用Redis
+            'backend': 'redis',
+            'sqlite_path': './aurora.db',
+            # standard / compact，仅对Redis后端有效，compact 使用短字段名和二进制密码哈希，要求 redis.decode_responses 为 false
+            # 已有数据可通过 user_tool.py compact 在线迁移，读取时两种格式均可识别
+            'format': 'standard'
+        },
+        'user_cache': {
+            'enabled': False,
+            'max_size': 10000,
+            'ttl': 60
+        },
+        'lookup': {
+            # 批量查询接口要求请求头 X-API-Key 与之一致，为空时接口对所有请求返回403
+            'api_key': '',
+            'batch_size': 500,
+            'max_items': 10000,
+            'stream_threshold': 1000
+        },
+        'tokens': {
+            # 为 true 时 active_key 缺少密钥会拒绝启动；未设置时缺少密钥只记录警告，登录响应不含令牌
+            'enabled': True,
+            # 轮换时新增密钥并切换 active_key，旧密钥保留到其签发的令牌全部过期
+            'active_key': 'k1',
+            'keys': {'k1': secrets.token_urlsafe(32)},
+            'ttl': 3600,
+            'revocation_refresh': 5
+        },
+        'logging': {
+            'level': 'INFO',
+            'loggers': {'werkzeug': 'WARNING'},
+            'sampling': {'http.request': 0.01},
+            'queue_size': 10000
         },
         'app': {
             'host': '0.0.0.0',
             'port': 5002,
-            'debug': False
+            'debug': False,
+            'workers': 0
         }
     }
     
@@ -49,41 +194,148 @@ def load_config():
         print(f"读取配置文件时出错: {e}")
         sys.exit(1)
 
-app = Flask(__name__)
-CORS(app)
+def check_config(config):
+    """检查配置文件是否包含必要的配置项，缺失时退出程序"""
+    required_sections = ['redis', 'smtp', 'app']
+    missing_sections = [section for section in required_sections if section not in config]
+
+    if missing_sections:
+        print(f"配置文件缺少必要配置项: {', '.join(missing_sections)}")
+        sys.exit(1)
+
+    if user_store_backend(config) not in USER_STORE_BACKENDS:
+        print(f"user_storage.backend 必须为 {' / '.join(USER_STORE_BACKENDS)} 之一")
+        sys.exit(1)
+
+    user_format = config.get('user_storage', {}).get('format', 'standard')
+    if user_format not in FORMATS:
+        print(f"user_storage.format 必须为 {' / '.join(FORMATS)} 之一")
+        sys.exit(1)
+    if user_format == 'compact' and config['redis'].get('decode_responses'):
+        # compact 记录中的二进制字段无法解码为字符串
+        print("user_storage.format 为 compact 时 redis.decode_responses 必须为 false")
+        sys.exit(1)
+
+    tokens_config = config.get('tokens') or {}
+    if tokens_config.get('enabled') and not (tokens_config.get('keys') or {}).get(tokens_config.get('active_key')):
+        print("tokens.enabled 为 true 时必须在 tokens.keys 中配置 active_key 对应的签名密钥")
+        sys.exit(1)
+
+    sample_rate = config.get('profiling', {}).get('sample_rate', 0.0)
+    if not 0 <= sample_rate <= 1:
+        print("profiling.sample_rate 必须在 0 到 1 之间")
+        sys.exit(1)
+
+def check_redis(config):
+    """启动前确认Redis可用，使用临时连接，不影响之后创建的连接池"""
+    try:
+        redis_client = create_redis_client(config['redis'])
+        redis_client.ping()
+        close_redis_client(redis_client)
+    except Exception as e:
+        print(f"无法连接到Redis: {e}")
+        sys.exit(1)
+
+def create_app(config, workers=1):
+    """根据已解析的配置创建应用，Redis连接池在此处创建，prefork模式下应在fork之后调用
 
-config = load_config()
+    workers 为同一台机器上的worker进程数，用于划分密码哈希进程池的默认大小
+    """
+    setup_logging(config.get('logging', {}))
+    app = Flask(__name__)
+    CORS(app)
+    metrics.configure(config.get('metrics', {}))
 
-required_sections = ['redis', 'smtp', 'app']
-missing_sections = [section for section in required_sections if section not in config]
+    redis_client = create_redis_client(config['redis'])
+    app.extensions['redis_client'] = redis_client
+    user_cache_config = config.get('user_cache', {})
+    user_cache = None
+    if user_cache_config.get('enabled') and user_store_backend(config) == 'redis':
+        user_cache = UserCache(redis_client, user_cache_config)
+    app.extensions['user_cache'] = user_cache
+    app.extensions['user_store'] = create_user_store(config, redis_client, user_cache)
+    app.extensions['password_hasher'] = PasswordHasher(config.get('password', {}), workers)
+    app.extensions['email_service'] = EmailVerificationService(config['smtp'], redis_client)
+    app.extensions['mail_queue'] = MailQueue(redis_client, config.get('mail_queue', {}))
+    app.extensions['lookup_config'] = lookup_config(config.get('lookup'))
+    app.extensions['concurrency_limits'] = concurrency_limiters(config.get('concurrency_limits'))
+    app.extensions['audit_log'] = AuditLog(redis_client, config.get('audit'))
+    app.extensions['token_service'] = TokenService(config.get('tokens', {}), redis_client)
+    profiling_config = config.get('profiling', {})
+    # 未开启时不创建，请求钩子中只多一次判断
+    profiler = RequestProfiler(profiling_config) if profiling_config.get('enabled') else None
+    app.extensions['profiler'] = profiler
+    if not app.extensions['token_service'].enabled:
+        app.logger.warning("未配置令牌签名密钥，登录响应中不包含会话令牌", extra={'event': 'tokens.disabled'})
 
-if missing_sections:
-    print(f"配置文件缺少必要配置项: {', '.join(missing_sections)}")
-    sys.exit(1)
+    app.register_blueprint(auth_bp)
 
-REDIS_CONFIG = config['redis']
-try:
-    redis_client = redis.Redis(**REDIS_CONFIG)
-    redis_client.ping()
-except Exception as e:
-    print(f"无法连接到Redis: {e}")
-    sys.exit(1)
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        if profiler is not None:
+            g.request_trace = profiler.begin(request.headers.get(PROFILE_HEADER))
 
-SMTP_CONFIG = config['smtp']
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            # 使用路由规则而不是实际路径作为标签，避免标签数量无限增长
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            trace = g.pop('request_trace', None)
+            if trace is not None:
+                profiler.finish(trace, request.method, route, response.status_code)
+            metrics.inc('aurora_http_requests_total', route=route, status=response.status_code)
+            duration = time.perf_counter() - started
+            metrics.observe('aurora_http_request_duration_seconds', duration, route=route)
+            app.logger.info("请求完成", extra={
+                'event': 'http.request', 'route': route, 'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2)
+            })
+        return response
 
-email_service = EmailVerificationService(SMTP_CONFIG, redis_client)
-from auth_routes import init_email_service
-init_email_service(email_service)
+    @app.route('/')
+    def index():
+        return render_template('index.html')
 
-app.register_blueprint(auth_bp)
-@app.route('/')
-def index():
-    return render_template('index.html')
+    @app.teardown_request
+    def discard_trace(exc):
+        trace = g.pop('request_trace', None)
+        if trace is not None:
+            profiler.discard(trace)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """合并本进程的实时计数和其他进程写入的文件，其他worker的数据最多滞后 metrics.flush_interval 秒"""
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/debug/slow_requests')
+    def slow_requests():
+        """各worker最近的慢请求，按耗时从高到低排列"""
+        if profiler is None:
+            return jsonify({'success': False, 'message': '未开启请求分析'}), 404
+        if not profiler.is_admin(request.headers.get(ADMIN_HEADER)):
+            return jsonify({'success': False, 'message': '无权访问'}), 403
+        limit = request.args.get('limit', 20, type=int)
+        return jsonify({'success': True, 'data': profiler.worst(limit)})
+
+    return app
 
 if __name__ == '__main__':
+    config = load_config()
+    check_config(config)
+    check_redis(config)
+    # 与 serve.py 相同，启动前清理上一次运行留下的计数文件，否则 /metrics 会重复累加已退出进程的数据
+    clear_directory(config.get('metrics', {}).get('directory'))
+    profiling_config = config.get('profiling', {})
+    if profiling_config.get('enabled'):
+        # 只清理慢请求记录，目录中的其他文件（例如 cProfile 统计）不受影响
+        clear_directory(profiling_config.get('directory', DEFAULT_PROFILING['directory']), 'slow-*.json')
+
+    app = create_app(config)
     app_config = config['app']
     app.run(
         host=app_config.get('host', '0.0.0.0'),
         port=app_config.get('port', 5000),
         debug=app_config.get('debug', False)
-    )
\ No newline at end of file
+    )
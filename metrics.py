@@ -0,0 +1,293 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from request_profiler import current_trace
+
+# 已退出worker的计数由主进程合并到该文件
+AGGREGATE_FILE = 'aggregate.json'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'aurora_http_requests_total': ('counter', '按路由和状态码统计的请求数'),
+    'aurora_http_request_duration_seconds': ('histogram', '按路由统计的请求耗时'),
+    'aurora_stage_duration_seconds': ('histogram', '请求内部各阶段耗时'),
+    'aurora_redis_round_trips_total': ('counter', '发往Redis的请求次数，管道和脚本计为一次'),
+    'aurora_redis_errors_total': ('counter', 'Redis请求失败次数'),
+    'aurora_smtp_duration_seconds': ('histogram', 'SMTP连接、握手、登录和发送耗时'),
+    'aurora_smtp_sessions_total': ('counter', '新建的SMTP会话数'),
+    'aurora_log_dropped_total': ('counter', '日志队列已满时丢弃的日志条数'),
+    'aurora_token_verifications_total': ('counter', '按结果统计的令牌校验次数'),
+    'aurora_user_cache_total': ('counter', '用户记录缓存的命中与未命中次数'),
+    'aurora_circuit_transitions_total': ('counter', '按依赖统计的熔断器状态变化次数'),
+    'aurora_circuit_rejected_total': ('counter', '熔断期间直接拒绝的调用次数'),
+    'aurora_requests_shed_total': ('counter', '超过并发上限被拒绝的请求数'),
+    'aurora_audit_events_total': ('counter', '审计事件写入Stream或因缓冲区已满被丢弃的数量'),
+}
+
+
+class _Shard:
+    __slots__ = ('lock', 'counters', 'histograms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+
+class Metrics:
+    """按线程id分散到多个分片，各分片独立加锁，线程间几乎没有锁竞争；导出时再合并各分片以及各worker进程的数据"""
+
+    SHARDS = 16
+
+    def __init__(self):
+        self.directory = None
+        self.flush_interval = 1.0
+        self._shards = [_Shard() for _ in range(self.SHARDS)]
+        self._flusher = None
+        self._flusher_pid = None
+
+    def configure(self, metrics_config=None):
+        metrics_config = metrics_config or {}
+        self.directory = metrics_config.get('directory')
+        self.flush_interval = metrics_config.get('flush_interval', 1.0)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        if self._flusher is None or not self._flusher.is_alive():
+            # 配置之前已有计数（例如启动检查时的Redis请求），下次计数时按新配置启动刷新线程
+            self._flusher_pid = None
+
+    def reset(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.counters.clear()
+                shard.histograms.clear()
+
+    def _shard(self):
+        if self._flusher_pid != os.getpid():
+            self._ensure_flusher()
+        return self._shards[threading.get_ident() % self.SHARDS]
+
+    def inc(self, name, value=1, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        with shard.lock:
+            shard.counters[key] = shard.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        index = len(DEFAULT_BUCKETS)
+        for position, bound in enumerate(DEFAULT_BUCKETS):
+            if seconds <= bound:
+                index = position
+                break
+        with shard.lock:
+            values = shard.histograms.get(key)
+            if values is None:
+                # 各桶计数（最后一个为超出全部上界），之后两项为总和与总数
+                values = shard.histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 3)
+            values[index] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('aurora_stage_duration_seconds', seconds, stage=stage)
+            trace = current_trace.get()
+            if trace is not None:
+                # 开启请求分析时同时记入当前请求，慢请求记录中可以看到各阶段耗时
+                trace.add_stage(stage, seconds)
+
+    def snapshot(self):
+        """合并当前进程所有线程的数据"""
+        counters = {}
+        histograms = {}
+        for shard in self._shards:
+            with shard.lock:
+                shard_counters = list(shard.counters.items())
+                shard_histograms = [(key, list(values)) for key, values in shard.histograms.items()]
+            for key, value in shard_counters:
+                counters[key] = counters.get(key, 0) + value
+            for key, values in shard_histograms:
+                merged = histograms.setdefault(key, [0] * len(values))
+                for index, value in enumerate(values):
+                    merged[index] += value
+        return counters, histograms
+
+    def _ensure_flusher(self):
+        # prefork 之后线程不会被继承，按pid判断是否需要在当前进程重新启动刷新线程
+        with self._shards[0].lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        if self.directory:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self):
+        if not self.directory:
+            return
+        counters, histograms = self.snapshot()
+        _write_file(os.path.join(self.directory, f"{os.getpid()}.json"), _dump(counters, histograms))
+
+    def collect(self):
+        """合并所有worker进程的数据，当前进程使用实时数据，其他进程使用其最近一次写入的文件
+
+        其他worker的数据最多滞后 flush_interval；已退出worker的计数由主进程并入 aggregate.json，
+        因此计数在worker重启前后单调递增，不会因旧文件残留而重复累加
+        """
+        counters, histograms = self.snapshot()
+        if not self.directory:
+            return counters, histograms
+
+        own_file = f"{os.getpid()}.json"
+        aggregate = _read_file(os.path.join(self.directory, AGGREGATE_FILE))
+        # 主进程先写出包含已退出worker数据的汇总文件再删除其文件，两步之间读到的旧文件不能重复计入
+        skipped = {own_file, AGGREGATE_FILE} | {f"{pid}.json" for pid in aggregate.get('retired', [])}
+        _merge(counters, histograms, aggregate)
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if os.path.basename(path) not in skipped:
+                _merge(counters, histograms, _read_file(path))
+        return counters, histograms
+
+    def retire(self, pid):
+        """worker退出后由主进程调用，把它最后写入的计数并入汇总文件并删除其文件"""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"{pid}.json")
+        data = _read_file(path)
+        if not data:
+            return
+        aggregate_path = os.path.join(self.directory, AGGREGATE_FILE)
+        counters, histograms = {}, {}
+        _merge(counters, histograms, _read_file(aggregate_path))
+        _merge(counters, histograms, data)
+        _write_file(aggregate_path, _dump(counters, histograms, retired=[pid]))
+        os.remove(path)
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        counters, histograms = self.collect()
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in HELP:
+                metric_type, text = HELP[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS, values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _dump(counters, histograms, **extra):
+    return dict({
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, values] for (name, labels), values in histograms.items()]
+    }, **extra)
+
+
+def _read_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _merge(counters, histograms, data):
+    for name, labels, value in data.get('counters', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in data.get('histograms', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        merged = histograms.setdefault(key, [0] * len(values))
+        for index, value in enumerate(values):
+            merged[index] += value
+
+
+def _pid_alive(name):
+    # 文件名为 {pid}.json 或 slow-{pid}.json
+    try:
+        pid = int(os.path.splitext(name)[0].rsplit('-', 1)[-1])
+    except ValueError:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_directory(directory, pattern='*.json'):
+    """服务启动前清理上一次运行遗留的、文件名匹配 pattern 的数据文件
+
+    先启动的进程（例如 mail_worker.py）可能已在同一目录写入计数，文件名对应的进程仍在运行时保留
+    """
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, pattern)):
+        if not _pid_alive(os.path.basename(path)):
+            os.remove(path)
+
+
+metrics = Metrics()
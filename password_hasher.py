@@ -0,0 +1,187 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+SCHEMES = ('scrypt', 'pbkdf2_sha256')
+
+logger = logging.getLogger('aurora.password')
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4), validate=True)
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+
+def is_legacy_md5(encoded):
+    return len(encoded) == 32 and '$' not in encoded
+
+
+def hash_password(password, scheme, params):
+    """生成自描述的哈希字符串，格式为 算法$参数...$盐$哈希"""
+    salt = os.urandom(16)
+    if scheme == 'scrypt':
+        n, r, p = params['scrypt_n'], params['scrypt_r'], params['scrypt_p']
+        digest = _scrypt(password, salt, n, r, p)
+        return f"scrypt${n}${r}${p}${_b64encode(salt)}${_b64encode(digest)}"
+    if scheme == 'pbkdf2_sha256':
+        iterations = params['pbkdf2_iterations']
+        digest = _pbkdf2(password, salt, iterations)
+        return f"pbkdf2_sha256${iterations}${_b64encode(salt)}${_b64encode(digest)}"
+    raise ValueError(f"不支持的密码哈希算法: {scheme}")
+
+
+class CorruptHashError(ValueError):
+    """存储的哈希前缀正确但参数、盐或摘要无法解析"""
+
+
+def _verify(password, encoded):
+    if is_legacy_md5(encoded):
+        return hmac.compare_digest(hashlib.md5(password.encode('utf-8')).hexdigest().encode('ascii'),
+                                   encoded.encode('utf-8'))
+
+    parts = encoded.split('$')
+    try:
+        if parts[0] == 'scrypt' and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            digest = _scrypt(password, _b64decode(parts[4]), n, r, p)
+            return hmac.compare_digest(digest, _b64decode(parts[5]))
+        if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+            digest = _pbkdf2(password, _b64decode(parts[2]), int(parts[1]))
+            return hmac.compare_digest(digest, _b64decode(parts[3]))
+    except (ValueError, OverflowError) as e:
+        # 非整数的参数、非法的base64（binascii.Error 是 ValueError 的子类）或 hashlib 拒绝的参数
+        raise CorruptHashError(f"{parts[0]}: {e}") from None
+    return False
+
+
+def _log_corrupt(error, email):
+    # 只记录算法和原因，不记录哈希本身
+    logger.error("存储的密码哈希已损坏，按密码错误处理", extra={'event': 'password.corrupt_hash', 'email': email,
+                                                             'reason': str(error)})
+
+
+def verify_password(password, encoded, email=None):
+    """损坏的哈希记录错误日志并返回 False，不向调用方抛出异常"""
+    try:
+        return _verify(password, encoded)
+    except CorruptHashError as e:
+        _log_corrupt(e, email)
+        return False
+
+
+class PasswordHasher:
+    """在进程池中执行密码哈希，避免KDF计算占用请求线程和GIL"""
+
+    def __init__(self, password_config=None, workers=1):
+        password_config = password_config or {}
+        self.scheme = password_config.get('scheme', 'scrypt')
+        if self.scheme not in SCHEMES:
+            raise ValueError(f"不支持的密码哈希算法: {self.scheme}")
+        self.params = {
+            'scrypt_n': password_config.get('scrypt_n', 16384),
+            'scrypt_r': password_config.get('scrypt_r', 8),
+            'scrypt_p': password_config.get('scrypt_p', 1),
+            'pbkdf2_iterations': password_config.get('pbkdf2_iterations', 600000)
+        }
+        # 未配置时由同一台机器上的各worker平分CPU，避免prefork下进程总数达到 worker数 × 核数
+        self.pool_size = password_config.get('pool_size') or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # 进程池在首次使用时创建，prefork模式下每个worker各自持有，不会跨fork共享
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.pool_size,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+        return self._executor
+
+    def _reset_executor(self, broken):
+        # 子进程被杀死后进程池不再可用，只替换出错的那个，其他线程可能已经换上了新的
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        executor = self._get_executor()
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            return self._get_executor().submit(fn, *args).result()
+
+    async def _run_async(self, fn, *args):
+        executor = self._get_executor()
+        try:
+            return await asyncio.wrap_future(executor.submit(fn, *args))
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            return await asyncio.wrap_future(self._get_executor().submit(fn, *args))
+
+    def needs_rehash(self, encoded):
+        if is_legacy_md5(encoded):
+            return True
+        parts = encoded.split('$')
+        if parts[0] != self.scheme:
+            return True
+        if self.scheme == 'scrypt':
+            return parts[1:4] != [str(self.params['scrypt_n']), str(self.params['scrypt_r']),
+                                  str(self.params['scrypt_p'])]
+        return parts[1] != str(self.params['pbkdf2_iterations'])
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.scheme, self.params)
+
+    def verify(self, password, encoded, email=None):
+        """email 只用于记录损坏的哈希"""
+        if not encoded:
+            return False
+        if is_legacy_md5(encoded):
+            return verify_password(password, encoded, email)
+        try:
+            return self._run(_verify, password, encoded)
+        except CorruptHashError as e:
+            _log_corrupt(e, email)
+            return False
+
+    async def hash_async(self, password):
+        return await self._run_async(hash_password, password, self.scheme, self.params)
+
+    async def verify_async(self, password, encoded, email=None):
+        if not encoded:
+            return False
+        if is_legacy_md5(encoded):
+            return verify_password(password, encoded, email)
+        try:
+            return await self._run_async(_verify, password, encoded)
+        except CorruptHashError as e:
+            _log_corrupt(e, email)
+            return False
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,310 @@
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.sentinel
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from metrics import metrics
+from request_profiler import current_trace
+
+# 只有连接和超时错误说明Redis不健康，WRONGTYPE、NOSCRIPT等错误回复不计入熔断
+_UNHEALTHY_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class RedisCircuitOpenError(CircuitOpenError, redis.exceptions.ConnectionError):
+    """继承 ConnectionError，已有的连接异常处理会直接返回503"""
+
+
+# 连接类在模块级定义，熔断器同样每个进程一个，由 create_redis_client 根据配置设置
+redis_breaker = CircuitBreaker('redis', error_class=RedisCircuitOpenError)
+
+
+def _trace_round_trip():
+    trace = current_trace.get()
+    if trace is not None:
+        trace.round_trips += 1
+
+
+def _trace_commands(commands):
+    trace = current_trace.get()
+    if trace is not None:
+        for args in commands:
+            trace.add_command(args[0])
+
+
+def _record_error(e):
+    metrics.inc('aurora_redis_errors_total')
+    if isinstance(e, _UNHEALTHY_ERRORS):
+        redis_breaker.record_failure()
+
+
+class _InstrumentedMixin:
+    """统计Redis往返次数和错误，管道与脚本都只发送一次，计为一次往返
+
+    check_health 为 False 的是连接内部的 AUTH / SELECT / 健康检查PING，不经过熔断判断；
+    连接池在发送命令前先建立连接，熔断期间在 connect 中直接失败，不等待 socket_connect_timeout。
+    每条命令只判断一次：已通过判断的命令在发送过程中建立连接，或连接建立后发送的第一条命令不再判断，
+    否则半开状态下的探测请求会被自己拒绝
+    """
+
+    # 异步集群客户端发送命令时 check_health 总是 False，需要对全部命令做熔断判断
+    gate_unchecked = False
+    _admitted = False
+    _admit_next = False
+
+    def connect(self):
+        if self._sock or self._admitted:
+            return super().connect()
+        redis_breaker.before_call()
+        # 连接池建立连接后紧接着发送命令，本次判断同时用于这条命令
+        self._admit_next = True
+        self._admitted = True
+        try:
+            return super().connect()
+        except Exception as e:
+            self._admit_next = False
+            _record_error(e)
+            raise
+        finally:
+            self._admitted = False
+
+    def send_command(self, *args, **kwargs):
+        _trace_commands([args])
+        return super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        # 管道中的命令不经过 send_command
+        commands = list(commands)
+        _trace_commands(commands)
+        return super().pack_commands(commands)
+
+    def send_packed_command(self, command, check_health=True):
+        admitted = self._admitted
+        if not admitted:
+            if not self._admit_next and (check_health or self.gate_unchecked):
+                redis_breaker.before_call()
+            self._admit_next = False
+        metrics.inc('aurora_redis_round_trips_total')
+        _trace_round_trip()
+        if admitted:
+            # 外层的命令或连接过程负责熔断判断和错误统计
+            return super().send_packed_command(command, check_health)
+        self._admitted = True
+        try:
+            return super().send_packed_command(command, check_health)
+        except Exception as e:
+            _record_error(e)
+            raise
+        finally:
+            self._admitted = False
+
+    def read_response(self, *args, **kwargs):
+        try:
+            response = super().read_response(*args, **kwargs)
+        except Exception as e:
+            _record_error(e)
+            raise
+        redis_breaker.record_success()
+        return response
+
+
+class _AsyncInstrumentedMixin:
+
+    gate_unchecked = False
+    _admitted = False
+    _admit_next = False
+
+    async def connect(self):
+        if self.is_connected or self._admitted:
+            return await super().connect()
+        redis_breaker.before_call()
+        # 连接池建立连接后紧接着发送命令，本次判断同时用于这条命令
+        self._admit_next = True
+        self._admitted = True
+        try:
+            return await super().connect()
+        except Exception as e:
+            self._admit_next = False
+            _record_error(e)
+            raise
+        finally:
+            self._admitted = False
+
+    async def send_command(self, *args, **kwargs):
+        _trace_commands([args])
+        return await super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        _trace_commands(commands)
+        return super().pack_commands(commands)
+
+    async def send_packed_command(self, command, check_health=True):
+        admitted = self._admitted
+        if not admitted:
+            if not self._admit_next and (check_health or self.gate_unchecked):
+                redis_breaker.before_call()
+            self._admit_next = False
+        metrics.inc('aurora_redis_round_trips_total')
+        _trace_round_trip()
+        if admitted:
+            # 外层的命令或连接过程负责熔断判断和错误统计
+            return await super().send_packed_command(command, check_health)
+        self._admitted = True
+        try:
+            return await super().send_packed_command(command, check_health)
+        except Exception as e:
+            _record_error(e)
+            raise
+        finally:
+            self._admitted = False
+
+    async def read_response(self, *args, **kwargs):
+        try:
+            response = await super().read_response(*args, **kwargs)
+        except Exception as e:
+            _record_error(e)
+            raise
+        redis_breaker.record_success()
+        return response
+
+
+class InstrumentedConnection(_InstrumentedMixin, redis.Connection):
+    pass
+
+
+class InstrumentedSentinelConnection(_InstrumentedMixin, redis.sentinel.SentinelManagedConnection):
+    pass
+
+
+class AsyncInstrumentedConnection(_AsyncInstrumentedMixin, redis.asyncio.Connection):
+    pass
+
+
+class AsyncInstrumentedSentinelConnection(_AsyncInstrumentedMixin, redis.asyncio.sentinel.SentinelManagedConnection):
+    pass
+
+
+class AsyncInstrumentedClusterConnection(AsyncInstrumentedConnection):
+    gate_unchecked = True
+
+
+def _connection_kwargs(redis_config):
+    return dict(
+        username=redis_config.get('username'),
+        password=redis_config.get('password'),
+        decode_responses=redis_config.get('decode_responses', False),
+        socket_timeout=redis_config.get('socket_timeout', 5),
+        socket_connect_timeout=redis_config.get('socket_connect_timeout', 2),
+        socket_keepalive=redis_config.get('socket_keepalive', True),
+        health_check_interval=redis_config.get('health_check_interval', 30),
+        retry_on_timeout=redis_config.get('retry_on_timeout', False)
+    )
+
+
+def _pool_kwargs(redis_config):
+    return dict(
+        host=redis_config.get('host', 'localhost'),
+        port=redis_config.get('port', 6379),
+        db=redis_config.get('db', 0),
+        max_connections=redis_config.get('max_connections', 50),
+        timeout=redis_config.get('pool_timeout', 5),
+        **_connection_kwargs(redis_config)
+    )
+
+
+def _sentinel_args(redis_config):
+    sentinel_config = redis_config.get('sentinel', {})
+    sentinels = [(node['host'], node['port']) for node in sentinel_config.get('nodes', [])]
+    sentinel_kwargs = {
+        'password': sentinel_config.get('password'),
+        'socket_timeout': redis_config.get('socket_timeout', 5)
+    }
+    return sentinels, sentinel_kwargs, sentinel_config.get('service_name', 'mymaster')
+
+
+def _cluster_kwargs(redis_config):
+    cluster_config = redis_config.get('cluster', {})
+    nodes = cluster_config.get('nodes') or [{'host': redis_config.get('host', 'localhost'),
+                                             'port': redis_config.get('port', 6379)}]
+    return nodes, dict(
+        max_connections=redis_config.get('max_connections', 50),
+        read_from_replicas=cluster_config.get('read_from_replicas', False),
+        **_connection_kwargs(redis_config)
+    )
+
+
+def redis_mode(redis_config):
+    """standalone / sentinel / cluster，默认单节点"""
+    return redis_config.get('mode', 'standalone')
+
+
+def create_redis_client(redis_config):
+    """根据配置创建共享的Redis客户端，连接池满时等待空闲连接而不是直接报错"""
+    redis_breaker.configure(redis_config.get('circuit_breaker'))
+    mode = redis_mode(redis_config)
+    if mode == 'sentinel':
+        sentinels, sentinel_kwargs, service_name = _sentinel_args(redis_config)
+        sentinel = redis.sentinel.Sentinel(sentinels, sentinel_kwargs=sentinel_kwargs)
+        # 主节点切换后连接池会通过哨兵重新解析主节点地址
+        return sentinel.master_for(service_name, connection_class=InstrumentedSentinelConnection,
+                                   db=redis_config.get('db', 0),
+                                   max_connections=redis_config.get('max_connections', 50),
+                                   **_connection_kwargs(redis_config))
+    if mode == 'cluster':
+        nodes, kwargs = _cluster_kwargs(redis_config)
+        return redis.cluster.RedisCluster(
+            startup_nodes=[redis.cluster.ClusterNode(node['host'], node['port']) for node in nodes],
+            connection_class=InstrumentedConnection,
+            **kwargs
+        )
+    pool = redis.BlockingConnectionPool(connection_class=InstrumentedConnection, **_pool_kwargs(redis_config))
+    return redis.Redis(connection_pool=pool)
+
+
+def create_async_redis_client(redis_config):
+    """创建供asyncio模式使用的共享Redis客户端，参数与同步客户端一致"""
+    redis_breaker.configure(redis_config.get('circuit_breaker'))
+    mode = redis_mode(redis_config)
+    if mode == 'sentinel':
+        sentinels, sentinel_kwargs, service_name = _sentinel_args(redis_config)
+        sentinel = redis.asyncio.sentinel.Sentinel(sentinels, sentinel_kwargs=sentinel_kwargs)
+        return sentinel.master_for(service_name, connection_class=AsyncInstrumentedSentinelConnection,
+                                   db=redis_config.get('db', 0),
+                                   max_connections=redis_config.get('max_connections', 50),
+                                   **_connection_kwargs(redis_config))
+    if mode == 'cluster':
+        nodes, kwargs = _cluster_kwargs(redis_config)
+        # 异步集群客户端不支持 retry_on_timeout，超时重试由 connection_error_retry_attempts 控制
+        kwargs.pop('retry_on_timeout')
+        client = redis.asyncio.cluster.RedisCluster(
+            startup_nodes=[redis.asyncio.cluster.ClusterNode(node['host'], node['port']) for node in nodes],
+            **kwargs
+        )
+        # 异步集群客户端不接受 connection_class 参数，节点在首次请求时才按 connection_kwargs 创建
+        client.connection_kwargs['connection_class'] = AsyncInstrumentedClusterConnection
+        for node in client.nodes_manager.startup_nodes.values():
+            node.connection_class = AsyncInstrumentedClusterConnection
+        return client
+    pool = redis.asyncio.BlockingConnectionPool(connection_class=AsyncInstrumentedConnection,
+                                                **_pool_kwargs(redis_config))
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+def is_cluster(redis_client):
+    return isinstance(redis_client, (redis.cluster.RedisCluster, redis.asyncio.cluster.RedisCluster))
+
+
+def primary_clients(redis_client):
+    """返回每个主节点对应的客户端，用于SCAN等需要逐个节点执行的操作；非集群模式下只有一个"""
+    if isinstance(redis_client, redis.cluster.RedisCluster):
+        return [node.redis_connection for node in redis_client.get_primaries()]
+    return [redis_client]
+
+
+def close_redis_client(redis_client):
+    if isinstance(redis_client, redis.cluster.RedisCluster):
+        redis_client.close()
+    else:
+        redis_client.connection_pool.disconnect()
@@ -0,0 +1,58 @@
+# 集群模式下同一用户的key都以邮箱作为哈希标签，落在同一个槽，单用户的多key脚本无需跨槽
+# 单节点和哨兵模式默认沿用原有的 user:email 格式；key布局由调用方根据配置创建 KeyBuilder 显式传入
+USER_PREFIX = "user:"
+USER_UUID_PREFIX = "user_uuid:"
+USER_COUNTER_KEY = "user_counter"
+AUDIT_STREAM_KEY = "audit_events"
+AUDIT_COUNTS_PREFIX = "audit_counts:"
+
+
+class KeyBuilder:
+    """生成单个用户相关的key，hash_tags 为 True 时用 {邮箱} 或 {IP} 作为哈希标签"""
+
+    def __init__(self, hash_tags=False):
+        self.hash_tags = bool(hash_tags)
+
+    def _tag(self, value):
+        return f"{{{value}}}" if self.hash_tags else value
+
+    def user_key(self, email):
+        return f"{USER_PREFIX}{self._tag(email)}"
+
+    def verification_code_key(self, email):
+        return f"verification_code:{self._tag(email)}"
+
+    def verification_cooldown_key(self, email):
+        return f"verification_cooldown:{self._tag(email)}"
+
+    def verification_attempts_key(self, email):
+        return f"verification_attempts:{self._tag(email)}"
+
+    def send_limit_email_key(self, email):
+        return f"rate_limit:send:email:{self._tag(email)}"
+
+    def send_limit_ip_key(self, client_ip):
+        return f"rate_limit:send:ip:{self._tag(client_ip)}"
+
+
+def key_builder(redis_config):
+    """集群模式默认使用带哈希标签的key；单节点执行 migrate-keys 之后需设置 redis.hash_tags 为 true"""
+    redis_config = redis_config or {}
+    return KeyBuilder(redis_config.get('hash_tags', redis_config.get('mode', 'standalone') == 'cluster'))
+
+
+def user_uuid_key(user_id):
+    return f"{USER_UUID_PREFIX}{user_id}"
+
+
+def email_from_user_key(key):
+    """从 user:{email} 中取出邮箱，兼容迁移前的 user:email 格式"""
+    email = key[len(USER_PREFIX):]
+    if email.startswith('{') and email.endswith('}'):
+        return email[1:-1]
+    return email
+
+
+def audit_counts_key(minute):
+    """minute 为UTC时间的 YYYYmmddHHMM"""
+    return f"{AUDIT_COUNTS_PREFIX}{minute}"
@@ -0,0 +1,196 @@
+import cProfile
+import glob
+import hmac
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+DEFAULT_PROFILING = {
+    'enabled': False,
+    # 按比例抽样用 cProfile 分析的请求，0 表示只分析带 X-Profile-Token 请求头的请求
+    'sample_rate': 0.0,
+    # 非空时请求头 X-Profile-Token 与之一致的请求总是被分析，/debug/slow_requests 也需要 X-Admin-Token 与之一致
+    'admin_token': '',
+    'directory': './profiles',
+    # 目录中最多保留的 .prof 文件数，超出时删除最旧的
+    'max_files': 200,
+    'slow_threshold_ms': 500,
+    # 每个worker保留的最近慢请求数
+    'slow_capacity': 50,
+    # 每个请求最多记录的Redis命令数
+    'max_commands': 100
+}
+
+PROFILE_HEADER = 'X-Profile-Token'
+ADMIN_HEADER = 'X-Admin-Token'
+
+# 当前请求的追踪记录，未开启时始终为 None，metrics.stage 和Redis连接据此决定是否记录
+current_trace = ContextVar('aurora_request_trace', default=None)
+
+
+class RequestTrace:
+    __slots__ = ('started', 'stages', 'commands', 'dropped_commands', 'round_trips', 'max_commands', 'profile')
+
+    def __init__(self, max_commands):
+        self.started = time.perf_counter()
+        self.stages = []
+        self.commands = []
+        self.dropped_commands = 0
+        self.round_trips = 0
+        self.max_commands = max_commands
+        self.profile = None
+
+    def add_stage(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def add_command(self, name):
+        if len(self.commands) >= self.max_commands:
+            self.dropped_commands += 1
+            return
+        self.commands.append(name.decode('utf-8', 'replace') if isinstance(name, bytes) else str(name))
+
+
+def profiling_config(config):
+    merged = dict(DEFAULT_PROFILING)
+    merged.update(config or {})
+    return merged
+
+
+def _route_slug(route):
+    return route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'
+
+
+class RequestProfiler:
+    """开启后每个请求记录各阶段耗时和Redis命令，超过阈值的请求保留在内存中供管理接口查询
+
+    被抽中的请求在 cProfile 下执行并把统计写入目录；cProfile 同一时刻只分析一个请求，其余请求照常处理不分析。
+    各worker的慢请求每秒写入目录中的 slow-{pid}.json，管理接口合并全部worker的数据
+    """
+
+    def __init__(self, config=None):
+        config = profiling_config(config)
+        self.sample_rate = config['sample_rate']
+        self.admin_token = config['admin_token']
+        self.directory = config['directory']
+        self.max_files = config['max_files']
+        self.slow_threshold = config['slow_threshold_ms'] / 1000
+        self.max_commands = config['max_commands']
+        self._slow = deque(maxlen=config['slow_capacity'])
+        self._slow_lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self._dirty = False
+        self._writer_pid = None
+        self._sequence = itertools.count()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def is_admin(self, token):
+        # 按字节比较，compare_digest 不接受含非ASCII字符的str
+        return bool(self.admin_token) and hmac.compare_digest((token or '').encode('utf-8'),
+                                                              str(self.admin_token).encode('utf-8'))
+
+    def begin(self, profile_token=None, allow_profile=True):
+        trace = RequestTrace(self.max_commands)
+        if allow_profile and (self.is_admin(profile_token)
+                              or (self.sample_rate and random.random() < self.sample_rate)):
+            if self._profile_lock.acquire(blocking=False):
+                trace.profile = cProfile.Profile()
+                trace.profile.enable()
+        current_trace.set(trace)
+        return trace
+
+    def discard(self, trace):
+        """请求异常中止、没有走到 finish 时释放 cProfile"""
+        current_trace.set(None)
+        if trace.profile is not None:
+            trace.profile.disable()
+            trace.profile = None
+            self._profile_lock.release()
+
+    def finish(self, trace, method, route, status):
+        duration = time.perf_counter() - trace.started
+        current_trace.set(None)
+        profile_file = None
+        if trace.profile is not None:
+            trace.profile.disable()
+            try:
+                profile_file = self._dump(trace.profile, route, duration)
+            finally:
+                trace.profile = None
+                self._profile_lock.release()
+        if duration < self.slow_threshold and profile_file is None:
+            return
+        record = {
+            'time': round(time.time(), 3),
+            'pid': os.getpid(),
+            'method': method,
+            'route': route,
+            'status': status,
+            'duration_ms': round(duration * 1000, 2),
+            'stages': [{'stage': stage, 'ms': round(seconds * 1000, 2)} for stage, seconds in trace.stages],
+            'redis_round_trips': trace.round_trips,
+            'redis_commands': trace.commands,
+            'redis_commands_dropped': trace.dropped_commands,
+            'profile': profile_file
+        }
+        with self._slow_lock:
+            if self._writer_pid != os.getpid():
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._write_loop, daemon=True).start()
+            self._slow.append(record)
+            self._dirty = True
+
+    def _dump(self, profile, route, duration):
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._sequence)}-"
+                f"{_route_slug(route)}-{int(duration * 1000)}ms.prof")
+        profile.dump_stats(os.path.join(self.directory, name))
+        files = glob.glob(os.path.join(self.directory, '*.prof'))
+        if len(files) > self.max_files:
+            files.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+            for path in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # 其他worker可能已经删除了同一个文件
+                    pass
+        return name
+
+    def _write_loop(self):
+        while True:
+            time.sleep(1)
+            try:
+                self._write()
+            except OSError:
+                pass
+
+    def _write(self):
+        with self._slow_lock:
+            if not self._dirty:
+                return
+            records = list(self._slow)
+            self._dirty = False
+        path = os.path.join(self.directory, f"slow-{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def worst(self, limit):
+        """合并各worker最近的慢请求，按耗时从高到低返回"""
+        with self._slow_lock:
+            records = list(self._slow)
+        own_file = os.path.join(self.directory, f"slow-{os.getpid()}.json")
+        for path in glob.glob(os.path.join(self.directory, 'slow-*.json')):
+            if path == own_file:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    records.extend(json.load(f))
+            except (OSError, ValueError):
+                continue
+        records.sort(key=lambda record: record['duration_ms'], reverse=True)
+        return records[:limit]
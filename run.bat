@@ -1,2 +1,3 @@
 pip install -r requirements.txt
+start python mail_worker.py
 python main.py
\ No newline at end of file
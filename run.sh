@@ -1,2 +1,3 @@
 sudo pip3 install -r requirements.txt
-sudo python3 main.py
\ No newline at end of file
+sudo python3 mail_worker.py &
+sudo python3 serve.py
\ No newline at end of file
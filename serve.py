@@ -0,0 +1,164 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from werkzeug.serving import make_server
+from main import load_config, check_config, check_redis, create_app
+from metrics import clear_directory, metrics
+from request_profiler import DEFAULT_PROFILING
+from structured_logging import setup_logging, shutdown_logging
+from user_store import user_store_backend
+
+logger = logging.getLogger('aurora.serve')
+
+
+def worker_main(config, sock, workers):
+    """worker进程入口：fork之后才创建应用和连接池，进程间不共享任何连接
+
+    收到 SIGTERM 后停止接受新连接，写出审计缓冲区、计数和日志队列再退出；
+    终端中的 Ctrl+C 同时发给整个进程组，worker忽略 SIGINT，由主进程转发 SIGTERM
+    """
+    # 在安装自己的处理函数之前，不能沿用从主进程继承的处理函数
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 丢弃从主进程继承的计数，避免每个worker重复上报
+    metrics.reset()
+    app = create_app(config, workers)
+    app_config = config['app']
+    server = make_server(
+        app_config.get('host', '0.0.0.0'),
+        app_config.get('port', 5000),
+        app,
+        threaded=app_config.get('threaded', True),
+        fd=sock.fileno()
+    )
+
+    def stop(signum, frame):
+        # shutdown 会等待 serve_forever 返回，不能在运行 serve_forever 的主线程中直接调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    logger.info("worker已启动", extra={'event': 'serve.worker_started'})
+    try:
+        server.serve_forever()
+    finally:
+        shutdown_worker(app)
+
+
+def shutdown_worker(app):
+    """spawn_worker 以 os._exit 退出，不会执行 atexit 注册的清理，在这里显式写出缓冲的数据"""
+    logger.info("worker正在停止", extra={'event': 'serve.worker_stopping'})
+    try:
+        app.extensions['audit_log'].close()
+        app.extensions['password_hasher'].shutdown()
+        metrics.flush()
+    except Exception:
+        logger.exception("worker停止时清理失败", extra={'event': 'serve.worker_cleanup_failed'})
+    finally:
+        shutdown_logging()
+
+
+def spawn_worker(config, sock, workers):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            worker_main(config, sock, workers)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def run_prefork(config, workers):
+    app_config = config['app']
+    host = app_config.get('host', '0.0.0.0')
+    port = app_config.get('port', 5000)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(app_config.get('backlog', 1024))
+    sock.set_inheritable(True)
+
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # 主进程不处理请求，只在回收worker时把它的计数文件并入汇总文件
+    metrics.configure(config.get('metrics', {}))
+
+    logger.info("主进程开始监听", extra={'event': 'serve.master_started', 'host': host, 'port': port,
+                                          'workers': workers})
+    for _ in range(workers):
+        pid = spawn_worker(config, sock, workers)
+        children[pid] = time.monotonic()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+
+        started_at = children.pop(pid, None)
+        if started_at is None:
+            continue
+        try:
+            metrics.retire(pid)
+        except OSError:
+            logger.exception("合并worker计数失败", extra={'event': 'serve.metrics_retire_failed', 'worker_pid': pid})
+        if stopping:
+            continue
+
+        logger.warning("worker已退出，重新启动", extra={'event': 'serve.worker_exited', 'worker_pid': pid,
+                                                      'status': status})
+        # 避免启动即崩溃的worker被无限快速重启
+        if time.monotonic() - started_at < 1:
+            time.sleep(1)
+        new_pid = spawn_worker(config, sock, workers)
+        children[new_pid] = time.monotonic()
+
+    sock.close()
+    logger.info("所有worker已停止", extra={'event': 'serve.stopped'})
+
+
+def main():
+    config = load_config()
+    check_config(config)
+    check_redis(config)
+    # 每个worker把自己的计数写入该目录，启动前清理上一次运行留下的文件
+    clear_directory(config.get('metrics', {}).get('directory'))
+    profiling_config = config.get('profiling', {})
+    if profiling_config.get('enabled'):
+        # 只清理各worker的慢请求记录，cProfile 统计文件按 max_files 轮换
+        clear_directory(profiling_config.get('directory', DEFAULT_PROFILING['directory']), 'slow-*.json')
+    setup_logging(config.get('logging', {}))
+
+    workers = config['app'].get('workers') or os.cpu_count() or 1
+    if not hasattr(os, 'fork'):
+        logger.warning("当前平台不支持fork，使用单进程模式运行", extra={'event': 'serve.no_fork'})
+        app = create_app(config)
+        app.run(host=config['app'].get('host', '0.0.0.0'), port=config['app'].get('port', 5000))
+        return
+
+    if workers > 1 and user_store_backend(config) == 'memory':
+        # 每个worker各有一份数据，验证码和用户在worker之间不可见
+        logger.warning("memory 存储后端不在worker之间共享，多worker部署请使用 sqlite 或 redis",
+                       extra={'event': 'serve.memory_store'})
+    run_prefork(config, workers)
+
+
+if __name__ == '__main__':
+    main()
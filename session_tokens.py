@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from metrics import metrics
+
+REVOKED_TOKENS_KEY = "revoked_tokens"
+
+DEFAULT_TOKENS = {
+    # 未设置时按是否配置了 active_key 的密钥决定；为 true 时缺少密钥由 main.check_config 拒绝启动
+    'enabled': None,
+    'ttl': 3600,
+    'revocation_refresh': 5
+}
+
+# 令牌格式: kid.uid.iat.exp.jti.sig，sig 为前五段的 HMAC-SHA256（base64url，无填充）
+# 下游服务只需持有密钥即可本地校验，无需访问Redis
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _sign(secret, body):
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def issue_token(user_id, key_id, secret, ttl, now=None):
+    """签发令牌，返回 (令牌, 过期时间戳)"""
+    issued_at = int(now if now is not None else time.time())
+    expires_at = issued_at + int(ttl)
+    jti = os.urandom(8).hex()
+    body = f"{key_id}.{user_id}.{issued_at}.{expires_at}.{jti}"
+    return f"{body}.{_sign(secret, body)}", expires_at
+
+
+def verify_token(token, keys, now=None):
+    """纯本地校验，返回 (状态, 声明)，状态为 valid / malformed / unknown_key / bad_signature / expired"""
+    if not isinstance(token, str) or not token.isascii():
+        # 签发的令牌只含ASCII字符，compare_digest 遇到非ASCII的str会抛出 TypeError
+        return 'malformed', None
+    parts = token.split('.')
+    if len(parts) != 6:
+        return 'malformed', None
+    key_id, user_id, issued_at, expires_at, jti, signature = parts
+    if not (issued_at.isdigit() and expires_at.isdigit()):
+        return 'malformed', None
+
+    secret = keys.get(key_id)
+    if secret is None:
+        return 'unknown_key', None
+    if not hmac.compare_digest(signature, _sign(secret, token[:-len(signature) - 1])):
+        return 'bad_signature', None
+
+    claims = {'uuid': user_id, 'iat': int(issued_at), 'exp': int(expires_at), 'kid': key_id, 'jti': jti}
+    if claims['exp'] <= (now if now is not None else time.time()):
+        return 'expired', claims
+    return 'valid', claims
+
+
+class RevocationCache:
+    """进程内缓存吊销列表，每隔 refresh_interval 秒最多从Redis拉取一次"""
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.revoked = frozenset()
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def claim_refresh(self, now):
+        # 只有一个线程负责刷新，其他线程在刷新期间继续使用旧数据
+        with self._lock:
+            if self.loaded_at is not None and now - self.loaded_at < self.refresh_interval:
+                return False
+            self.loaded_at = now
+            return True
+
+    def update(self, members):
+        self.revoked = frozenset(_to_str(member) for member in members)
+
+    def add(self, jti):
+        self.revoked = self.revoked | {jti}
+
+
+def _token_config(token_config):
+    config = dict(DEFAULT_TOKENS)
+    config.update(token_config or {})
+    return config
+
+
+class TokenService:
+    """签发和校验会话令牌，keys 中保留旧密钥以便轮换期间已签发的令牌仍然有效"""
+
+    def __init__(self, token_config, redis_client):
+        config = _token_config(token_config)
+        self.keys = dict(config.get('keys') or {})
+        self.active_key = config.get('active_key')
+        self.switched_off = config['enabled'] is False
+        self.ttl = config['ttl']
+        self.redis_client = redis_client
+        self.revocations = RevocationCache(config['revocation_refresh'])
+
+    @property
+    def enabled(self):
+        return not self.switched_off and bool(self.keys.get(self.active_key))
+
+    def issue(self, user_id):
+        if not self.enabled:
+            return None, None
+        return issue_token(user_id, self.active_key, self.keys[self.active_key], self.ttl)
+
+    def _refresh_revocations(self, now):
+        if not self.revocations.claim_refresh(now):
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zremrangebyscore(REVOKED_TOKENS_KEY, '-inf', now)
+        pipe.zrange(REVOKED_TOKENS_KEY, 0, -1)
+        self.revocations.update(pipe.execute()[1])
+
+    def verify(self, token):
+        now = time.time()
+        status, claims = verify_token(token, self.keys, now)
+        if status == 'valid':
+            try:
+                self._refresh_revocations(now)
+            except Exception:
+                # Redis不可用时沿用上一次的吊销列表
+                pass
+            if claims['jti'] in self.revocations.revoked:
+                status = 'revoked'
+        metrics.inc('aurora_token_verifications_total', status=status)
+        return status, claims
+
+    def revoke(self, claims):
+        """吊销单个令牌，记录保留到令牌过期为止"""
+        self.redis_client.zadd(REVOKED_TOKENS_KEY, {claims['jti']: claims['exp']})
+        self.revocations.add(claims['jti'])
+
+
+class AsyncTokenService(TokenService):
+    """TokenService 的 redis.asyncio 版本，签发和签名校验与同步版本相同"""
+
+    async def _refresh_revocations_async(self, now):
+        if not self.revocations.claim_refresh(now):
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zremrangebyscore(REVOKED_TOKENS_KEY, '-inf', now)
+        pipe.zrange(REVOKED_TOKENS_KEY, 0, -1)
+        self.revocations.update((await pipe.execute())[1])
+
+    async def verify_async(self, token):
+        now = time.time()
+        status, claims = verify_token(token, self.keys, now)
+        if status == 'valid':
+            try:
+                await self._refresh_revocations_async(now)
+            except Exception:
+                pass
+            if claims['jti'] in self.revocations.revoked:
+                status = 'revoked'
+        metrics.inc('aurora_token_verifications_total', status=status)
+        return status, claims
+
+    async def revoke_async(self, claims):
+        await self.redis_client.zadd(REVOKED_TOKENS_KEY, {claims['jti']: claims['exp']})
+        self.revocations.add(claims['jti'])
@@ -0,0 +1,145 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from metrics import metrics
+
+# 这些字段无论出现在哪条日志里都只输出掩码
+SECRET_FIELDS = frozenset({
+    'password', 'old_password', 'new_password', 'system_password', 'password_hash',
+    'code', 'verification_code', 'token', 'smtp_password', 'authorization'
+})
+
+DEFAULT_LOGGING = {
+    'level': 'INFO',
+    'loggers': {'werkzeug': 'WARNING'},
+    'sampling': {'http.request': 0.01},
+    'queue_size': 10000
+}
+
+# LogRecord 自带的属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_state = {'pid': None, 'handler': None, 'listener': None}
+
+
+def mask_email(email):
+    if not isinstance(email, str) or '@' not in email:
+        return email
+    local, domain = email.rsplit('@', 1)
+    return f"{local[:1]}***@{domain}"
+
+
+class RedactFilter(logging.Filter):
+    """在进入队列之前替换敏感字段，邮箱只保留首字母和域名"""
+
+    def filter(self, record):
+        for name in SECRET_FIELDS.intersection(vars(record)):
+            setattr(record, name, '***')
+        if hasattr(record, 'email'):
+            record.email = mask_email(record.email)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """按 event 字段抽样，WARNING 及以上级别总是保留"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or rate >= 1:
+            return True
+        return random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'msg': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS and not name.startswith('_'):
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """请求线程只做格式无关的轻量处理并放入有界队列，队列满时丢弃并计数而不是阻塞"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # 异常对象持有栈帧，在请求线程中转换为文本后再交给后台线程
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('aurora_log_dropped_total')
+
+
+def setup_logging(logging_config=None):
+    """为当前进程安装队列日志，fork 之后在子进程中再次调用会重建队列和后台线程"""
+    config = dict(DEFAULT_LOGGING)
+    config.update(logging_config or {})
+
+    if _state['pid'] == os.getpid():
+        return _state['listener']
+
+    root = logging.getLogger()
+    if _state['handler'] is not None:
+        # 从父进程继承的处理器对应的后台线程在子进程中已不存在
+        root.removeHandler(_state['handler'])
+
+    log_queue = queue.Queue(maxsize=config['queue_size'])
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(config['sampling']))
+    handler.addFilter(RedactFilter())
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+
+    root.addHandler(handler)
+    root.setLevel(config['level'])
+    for name, level in (config.get('loggers') or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    _state.update(pid=os.getpid(), handler=handler, listener=listener)
+    atexit.register(listener.stop)
+    return listener
+
+
+def shutdown_logging():
+    """停止当前进程的日志后台线程并写出队列中剩余的日志，供以 os._exit 退出、不执行 atexit 的进程调用"""
+    listener = _state['listener']
+    if listener is None or _state['pid'] != os.getpid():
+        return
+    atexit.unregister(listener.stop)
+    listener.stop()
+    _state.update(pid=None, listener=None)
@@ -0,0 +1,55 @@
+import atexit
+import fakeredis
+import pytest
+from audit_events import AuditLog, mask_ip
+from redis_keys import AUDIT_STREAM_KEY
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def make_log(redis_client, **config):
+    audit_log = AuditLog(redis_client, dict({'flush_interval': 60}, **config))
+    atexit.unregister(audit_log.close)
+    return audit_log
+
+
+def stream(redis_client):
+    return [fields for _, fields in redis_client.xrange(AUDIT_STREAM_KEY)]
+
+
+def test_stream_has_no_plaintext_identity(redis_client):
+    audit_log = make_log(redis_client)
+    audit_log.emit('login.failed', ip='203.0.113.7', email='alice@example.com', reason='bad_password', uuid=None)
+    assert audit_log.flush() == 1
+    [entry] = stream(redis_client)
+    assert entry['email'] == 'a***@example.com' and entry['ip'] == '203.0.113.0/24'
+    assert entry['event'] == 'login.failed' and entry['reason'] == 'bad_password' and 'uuid' not in entry
+
+
+def test_keyed_hash_keeps_events_correlated(redis_client):
+    audit_log = make_log(redis_client, hash_key='audit-secret')
+    audit_log.emit('login.failed', ip='203.0.113.7', email='alice@example.com')
+    audit_log.emit('login.succeeded', ip='203.0.113.7', email='alice@example.com')
+    audit_log.emit('login.succeeded', ip='203.0.113.8', email='bob@example.com')
+    audit_log.flush()
+    first, second, third = stream(redis_client)
+    assert first['email'] == second['email'] != third['email']
+    assert first['ip'] == second['ip'] != third['ip']
+    assert 'alice' not in first['email'] and '203.0.113' not in first['ip']
+
+    other = make_log(fakeredis.FakeRedis(decode_responses=True), hash_key='other-secret')
+    other.emit('login.failed', ip='203.0.113.7', email='alice@example.com')
+    other.flush()
+    assert stream(other.redis_client)[0]['email'] != first['email']
+
+
+@pytest.mark.parametrize('ip, masked', [
+    ('192.168.1.20', '192.168.1.0/24'),
+    ('2001:db8:1:2::1', '2001:db8:1::/48'),
+    ('not-an-ip', '***'),
+])
+def test_mask_ip(ip, masked):
+    assert mask_ip(ip) == masked
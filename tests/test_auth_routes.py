@@ -0,0 +1,126 @@
+import json
+import fakeredis
+import pytest
+from flask import Flask
+from auth_routes import auth_bp
+from mail_queue import MailQueue
+from password_hasher import PasswordHasher
+from session_tokens import TokenService
+from user_lookup import lookup_config
+from user_store import MemoryUserStore
+
+EMAIL = 'alice@example.com'
+
+
+@pytest.fixture(scope='module')
+def password_hasher():
+    hasher = PasswordHasher({'scheme': 'pbkdf2_sha256', 'pbkdf2_iterations': 1000, 'pool_size': 1})
+    yield hasher
+    hasher.shutdown()
+
+
+@pytest.fixture
+def app(password_hasher):
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    app = Flask(__name__)
+    app.extensions.update({
+        'redis_client': redis_client,
+        'user_store': MemoryUserStore({'cooldown': 0, 'email_limit': 2}),
+        'password_hasher': password_hasher,
+        'mail_queue': MailQueue(redis_client, {}),
+        'token_service': TokenService({'active_key': 'k1', 'keys': {'k1': 'secret'}}, redis_client),
+        'lookup_config': lookup_config({'api_key': 'lookup-key'}),
+        'concurrency_limits': {},
+    })
+    app.register_blueprint(auth_bp)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def sent_code(app):
+    _, code = app.extensions['user_store'].send_verification_code(EMAIL, '127.0.0.1', '000000')
+    return code
+
+
+def register(app, client):
+    assert client.post('/send_verification_code', json={'email': EMAIL}).get_json()['success']
+    response = client.post('/login', json={'email': EMAIL, 'code': sent_code(app)})
+    assert response.status_code == 200
+    return response.get_json()['data']
+
+
+def test_send_code_validation(client):
+    response = client.post('/send_verification_code', data='not json')
+    assert response.status_code == 400 and not response.get_json()['success']
+    assert client.post('/send_verification_code', json={}).status_code == 400
+
+
+def test_send_code_limited(client):
+    for _ in range(2):
+        assert client.post('/send_verification_code', json={'email': EMAIL}).status_code == 200
+    response = client.post('/send_verification_code', json={'email': EMAIL})
+    assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+
+
+def test_register_then_password_login(app, client):
+    user = register(app, client)
+    assert user['username'] == 'alice' and user['token']
+
+    # 初始密码只在欢迎邮件任务中，队列中先是验证码邮件
+    mail_queue = app.extensions['mail_queue']
+    jobs = [json.loads(mail_queue.fetch(timeout=1)) for _ in range(2)]
+    assert [job['kind'] for job in jobs] == ['verification', 'welcome']
+    password = jobs[1]['payload']['password']
+
+    response = client.post('/login', json={'email': EMAIL, 'password': password})
+    assert response.get_json()['data']['uuid'] == user['uuid']
+    response = client.post('/login', json={'email': EMAIL, 'password': 'wrong'})
+    assert response.get_json() == {'success': False, 'message': '密码错误', 'hash_match': False}
+
+
+def test_login_rejects_bad_requests(client):
+    response = client.post('/login', data='{"email": ', content_type='application/json')
+    assert response.status_code == 400 and response.get_json()['raw_data'] == '{"email": '
+    assert client.post('/login', data='x', content_type='text/plain').status_code == 400
+    assert client.post('/login', json={'email': 'bad'}).get_json()['message'] == '邮箱格式不正确'
+    assert client.post('/login', json={'email': EMAIL, 'code': '123456'}).get_json()['message'] == '验证码错误'
+    assert client.post('/login', json={'email': EMAIL}).get_json()['provided_fields'] == ['email']
+
+
+def test_change_password(app, client, password_hasher):
+    user_store = app.extensions['user_store']
+    register(app, client)
+    user_store.update_password(EMAIL, user_store.get_credentials(EMAIL)['password'],
+                               password_hasher.hash('old-password'), password_hasher.scheme)
+
+    request = {'email': EMAIL, 'old_password': 'wrong', 'new_password': 'new-password'}
+    assert client.post('/change_password', json=request).status_code == 400
+    request['old_password'] = 'old-password'
+    assert client.post('/change_password', json=request).get_json()['success']
+    assert client.post('/login', json={'email': EMAIL, 'password': 'new-password'}).get_json()['success']
+    request['email'] = 'missing@example.com'
+    assert client.post('/change_password', json=request).status_code == 404
+
+
+def test_verify_and_revoke_token(app, client):
+    token = register(app, client)['token']
+    headers = {'Authorization': f"Bearer {token}"}
+    assert client.post('/verify_token', headers=headers).get_json()['success']
+    assert client.post('/verify_token', json={'token': token}).get_json()['success']
+    assert client.post('/verify_token').status_code == 400
+    assert client.post('/revoke_token', headers=headers).get_json()['success']
+    response = client.post('/verify_token', headers=headers)
+    assert response.status_code == 401 and response.get_json()['reason'] == 'revoked'
+
+
+def test_lookup(app, client):
+    user = register(app, client)
+    request = {'emails': [EMAIL, 'missing@example.com']}
+    assert client.post('/users/lookup', json=request).status_code == 403
+    response = client.post('/users/lookup', json=request, headers={'X-API-Key': 'lookup-key'})
+    data = response.get_json()['data']
+    assert data[0]['user']['uuid'] == user['uuid'] and data[1]['user'] is None
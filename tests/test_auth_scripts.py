@@ -0,0 +1,45 @@
+import fakeredis
+import pytest
+from auth_scripts import AuthScripts
+from redis_keys import user_uuid_key
+from user_codec import encode_record
+
+
+class NoSetRedis(fakeredis.FakeRedis):
+    """注册脚本之外的 SET 一律失败，模拟脚本返回后连接中断"""
+
+    def set(self, *args, **kwargs):
+        raise AssertionError("uuid索引应在注册脚本中写入")
+
+
+@pytest.mark.parametrize('user_format', ['standard', 'compact'])
+def test_registration_writes_uuid_index_in_script(user_format):
+    redis_client = NoSetRedis(decode_responses=user_format == 'standard')
+    scripts = AuthScripts(redis_client, {'cooldown': 0}, user_format=user_format)
+    email = 'alice@example.com'
+    status, code = scripts.send_verification_code(email, '10.0.0.1', '123456')
+    assert status == 'send'
+    status, user_info = scripts.login_with_code(email, code, 'alice', 'hash', 'scrypt')
+    assert status == 'registered'
+
+    stored = redis_client.get(user_uuid_key(user_info['uuid']))
+    assert stored in (email, email.encode('utf-8'))
+    [record] = scripts.lookup_users([user_info['uuid']], 'uuid')
+    assert record['email'] == email and record['uuid'] == user_info['uuid']
+
+
+def test_standard_update_password_on_migrated_record():
+    # 在线迁移期间服务仍以 standard 格式运行，记录的密码字段已被改写为 compact
+    redis_client = fakeredis.FakeRedis()
+    scripts = AuthScripts(redis_client, {'cooldown': 0}, user_format='standard')
+    email = 'bob@example.com'
+    old_hash = '5f4dcc3b5aa765d61d8327deb882cf99'
+    redis_client.hset(scripts.keys.user_key(email),
+                      mapping=encode_record(email, {'uuid': '1', 'password': old_hash, 'password_type': 'md5'},
+                                            'compact'))
+
+    assert not scripts.update_password(email, 'stale-hash', 'new-hash', 'scrypt')
+    assert scripts.update_password(email, old_hash, 'new-hash', 'scrypt')
+    credentials = scripts.get_credentials(email)
+    assert (credentials['password'], credentials['password_type']) == ('new-hash', 'scrypt')
+    assert redis_client.hget(scripts.keys.user_key(email), 'p') is None
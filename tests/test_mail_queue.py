@@ -0,0 +1,172 @@
+import json
+import time
+import fakeredis
+import pytest
+from mail_queue import MAIL_DEAD_KEY, MAIL_DELAYED_KEY, MAIL_QUEUE_KEY, MailQueue, process_job
+
+
+class FakeEmailService:
+    def __init__(self, result=True):
+        self.result = result
+        self.sent = []
+
+    def _send(self, kind, to_email, secret):
+        self.sent.append((kind, to_email, secret))
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def send_verification_email(self, to_email, code):
+        return self._send('verification', to_email, code)
+
+    def send_welcome_email(self, to_email, password):
+        return self._send('welcome', to_email, password)
+
+    def retry_after(self):
+        return 0
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def make_queue(redis_client, **config):
+    return MailQueue(redis_client, dict({'max_attempts': 3, 'base_delay': 2, 'max_delay': 300}, **config),
+                     code_ttl=300)
+
+
+def processing(queue):
+    return queue.redis_client.lrange(queue.processing_key, 0, -1)
+
+
+def dead_entries(redis_client):
+    return [json.loads(raw) for raw in redis_client.lrange(MAIL_DEAD_KEY, 0, -1)]
+
+
+def test_enqueue_and_deliver(redis_client):
+    queue = make_queue(redis_client)
+    assert queue.enqueue_verification('a@example.com', '123456')
+    raw = queue.fetch(timeout=1)
+    assert json.loads(raw)['payload'] == {'code': '123456'}
+    assert processing(queue) == [raw]
+
+    email_service = FakeEmailService()
+    assert process_job(queue, email_service, raw) == 'sent'
+    assert email_service.sent == [('verification', 'a@example.com', '123456')]
+    assert processing(queue) == [] and redis_client.llen(MAIL_QUEUE_KEY) == 0
+
+
+def test_retry_backs_off_and_promotes_when_due(redis_client):
+    queue = make_queue(redis_client)
+    queue.enqueue_welcome('a@example.com', 'initial-password')
+    raw = queue.fetch(timeout=1)
+    before = time.time()
+    assert process_job(queue, FakeEmailService(result=False), raw) == 'retry'
+    assert processing(queue) == []
+
+    [(retried, due_at)] = redis_client.zrange(MAIL_DELAYED_KEY, 0, -1, withscores=True)
+    assert json.loads(retried)['attempts'] == 1
+    # 第一次重试延迟 base_delay 的 50%~100%
+    assert before + 1 <= due_at <= time.time() + 2
+    assert queue.promote_due() == 0
+
+    redis_client.zadd(MAIL_DELAYED_KEY, {retried: time.time() - 1})
+    assert queue.promote_due() == 1
+    assert redis_client.zcard(MAIL_DELAYED_KEY) == 0
+    assert redis_client.lrange(MAIL_QUEUE_KEY, 0, -1) == [retried]
+
+
+def test_backoff_is_capped(redis_client):
+    queue = make_queue(redis_client, max_attempts=20, base_delay=2, max_delay=10)
+    queue.enqueue_welcome('a@example.com', 'initial-password')
+    raw = queue.fetch(timeout=1)
+    job = json.loads(raw)
+    job['attempts'] = 10
+    before = time.time()
+    assert queue.retry(raw, job)
+    [(_, due_at)] = redis_client.zrange(MAIL_DELAYED_KEY, 0, -1, withscores=True)
+    assert due_at <= before + 10 + 1
+
+
+def test_recover_processing(redis_client):
+    queue = make_queue(redis_client)
+    queue.enqueue_verification('a@example.com', '111111')
+    queue.enqueue_verification('b@example.com', '222222')
+    queue.fetch(timeout=1)
+    queue.fetch(timeout=1)
+    assert redis_client.llen(MAIL_QUEUE_KEY) == 0
+
+    restarted = make_queue(redis_client)
+    assert restarted.recover_processing() == 2
+    assert processing(restarted) == [] and redis_client.llen(MAIL_QUEUE_KEY) == 2
+
+
+def test_dead_letter_is_redacted(redis_client):
+    queue = make_queue(redis_client, max_attempts=1)
+    queue.enqueue_welcome('a@example.com', 'initial-password')
+    raw = queue.fetch(timeout=1)
+    assert process_job(queue, FakeEmailService(result=False), raw) == 'dead'
+    assert processing(queue) == []
+    [entry] = dead_entries(redis_client)
+    assert entry['reason'] == 'max_attempts' and entry['to'] == 'a@example.com' and entry['attempts'] == 1
+    assert 'payload' not in entry and 'initial-password' not in json.dumps(entry)
+
+
+def test_dead_letter_list_is_capped(redis_client):
+    queue = make_queue(redis_client, max_attempts=1, dead_max_len=3)
+    for i in range(5):
+        queue.enqueue_welcome(f"user{i}@example.com", 'initial-password')
+        process_job(queue, FakeEmailService(result=False), queue.fetch(timeout=1))
+    assert [entry['to'] for entry in dead_entries(redis_client)] == [
+        'user4@example.com', 'user3@example.com', 'user2@example.com']
+
+
+@pytest.mark.parametrize('raw', [
+    'not json',
+    '[1, 2]',
+    json.dumps({'kind': 'verification', 'payload': {'code': '1'}}),
+    json.dumps({'kind': 'verification', 'to': 'a@example.com', 'payload': {}}),
+    json.dumps({'kind': 'welcome', 'to': 'a@example.com', 'payload': 'secret'}),
+    json.dumps({'kind': 'unknown', 'to': 'a@example.com', 'payload': {'code': '1'}}),
+])
+def test_invalid_job_goes_to_dead_letter(redis_client, raw):
+    queue = make_queue(redis_client)
+    redis_client.lpush(queue.processing_key, raw)
+    email_service = FakeEmailService()
+    assert process_job(queue, email_service, raw) == 'invalid'
+    assert email_service.sent == [] and processing(queue) == []
+    [entry] = dead_entries(redis_client)
+    assert entry['reason'] == 'invalid' and 'payload' not in entry
+
+
+def test_delivery_exception_is_retried(redis_client):
+    queue = make_queue(redis_client)
+    queue.enqueue_verification('a@example.com', '123456')
+    raw = queue.fetch(timeout=1)
+    assert process_job(queue, FakeEmailService(result=RuntimeError('boom')), raw) == 'retry'
+    assert processing(queue) == [] and redis_client.zcard(MAIL_DELAYED_KEY) == 1
+
+
+def test_expired_verification_is_dropped(redis_client):
+    queue = make_queue(redis_client)
+    queue.enqueue_verification('a@example.com', '123456')
+    raw = queue.fetch(timeout=1)
+    job = json.loads(raw)
+    job['created_at'] -= 301
+    redis_client.lset(queue.processing_key, 0, json.dumps(job))
+    email_service = FakeEmailService()
+    assert process_job(queue, email_service, json.dumps(job)) == 'expired'
+    assert email_service.sent == [] and processing(queue) == []
+    assert redis_client.llen(MAIL_DEAD_KEY) == 0
+
+
+def test_retry_past_ttl_does_not_keep_the_secret(redis_client):
+    queue = make_queue(redis_client, welcome_ttl=1)
+    queue.enqueue_welcome('a@example.com', 'initial-password')
+    raw = queue.fetch(timeout=1)
+    # 下一次重试时已超过 welcome_ttl，密码不再写入延迟队列
+    assert process_job(queue, FakeEmailService(result=False), raw) == 'dead'
+    assert redis_client.zcard(MAIL_DELAYED_KEY) == 0
+    [entry] = dead_entries(redis_client)
+    assert entry['reason'] == 'expired' and 'initial-password' not in json.dumps(entry)
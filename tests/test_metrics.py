@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+from metrics import AGGREGATE_FILE, Metrics, _read_file, _write_file, _dump, clear_directory
+
+
+def make_metrics(directory):
+    metrics = Metrics()
+    metrics.configure({'directory': str(directory), 'flush_interval': 60})
+    return metrics
+
+
+def worker_file(directory, pid, requests):
+    key = ('aurora_http_requests_total', (('route', 'login'), ('status', 200)))
+    _write_file(os.path.join(directory, f"{pid}.json"), _dump({key: requests}, {}))
+
+
+def total(metrics):
+    counters, _ = metrics.collect()
+    return counters.get(('aurora_http_requests_total', (('route', 'login'), ('status', 200))), 0)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_collect_merges_other_workers(tmp_path):
+    metrics = make_metrics(tmp_path)
+    metrics.inc('aurora_http_requests_total', route='login', status=200)
+    worker_file(tmp_path, 101, 2)
+    worker_file(tmp_path, 102, 3)
+    assert total(metrics) == 6
+
+
+def test_retire_folds_worker_into_aggregate(tmp_path):
+    metrics = make_metrics(tmp_path)
+    worker_file(tmp_path, 101, 2)
+    worker_file(tmp_path, 102, 3)
+    metrics.retire(101)
+    assert not os.path.exists(tmp_path / '101.json')
+    assert total(metrics) == 5
+
+    # 重启后的worker从零计数，已退出worker的计数保留在汇总文件中
+    worker_file(tmp_path, 103, 1)
+    metrics.retire(102)
+    assert total(metrics) == 6
+    metrics.retire(999)
+    assert total(metrics) == 6
+
+
+def test_retired_file_is_not_counted_twice(tmp_path):
+    metrics = make_metrics(tmp_path)
+    worker_file(tmp_path, 101, 2)
+    metrics.retire(101)
+    # 模拟读取方看到汇总文件时旧文件尚未删除
+    worker_file(tmp_path, 101, 2)
+    assert total(metrics) == 2
+    assert _read_file(tmp_path / AGGREGATE_FILE)['retired'] == [101]
+
+
+def test_clear_directory_keeps_live_processes(tmp_path):
+    worker_file(tmp_path, os.getpid(), 1)
+    worker_file(tmp_path, dead_pid(), 1)
+    _write_file(os.path.join(tmp_path, AGGREGATE_FILE), _dump({}, {}))
+    clear_directory(str(tmp_path))
+    assert os.listdir(tmp_path) == [f"{os.getpid()}.json"]
+
+
+def test_clear_directory_pattern(tmp_path):
+    for name in (f"slow-{dead_pid()}.json", f"slow-{os.getpid()}.json", 'report.json', 'profile.prof'):
+        (tmp_path / name).write_text('[]')
+    clear_directory(str(tmp_path), 'slow-*.json')
+    assert sorted(os.listdir(tmp_path)) == ['profile.prof', 'report.json', f"slow-{os.getpid()}.json"]
@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import logging
+import pytest
+from password_hasher import PasswordHasher, hash_password, verify_password
+
+PARAMS = {'scrypt_n': 1024, 'scrypt_r': 8, 'scrypt_p': 1, 'pbkdf2_iterations': 1000}
+
+
+@pytest.fixture(scope='module')
+def hasher():
+    hasher = PasswordHasher({'scheme': 'scrypt', 'scrypt_n': 1024, 'pool_size': 1})
+    yield hasher
+    hasher.shutdown()
+
+
+@pytest.mark.parametrize('scheme', ['scrypt', 'pbkdf2_sha256'])
+def test_round_trip(scheme):
+    encoded = hash_password('correct horse', scheme, PARAMS)
+    assert encoded.startswith(f"{scheme}$")
+    assert verify_password('correct horse', encoded)
+    assert not verify_password('wrong horse', encoded)
+
+
+def test_legacy_md5():
+    encoded = hashlib.md5('密码'.encode('utf-8')).hexdigest()
+    assert verify_password('密码', encoded)
+    assert not verify_password('password', encoded)
+
+
+CORRUPT = [
+    'scrypt$abc$8$1$c2FsdA$ZGlnZXN0',
+    'scrypt$1000$8$1$c2FsdA$ZGlnZXN0',
+    'scrypt$1024$8$1$!!!!$ZGlnZXN0',
+    'scrypt$1024$8$1$c2FsdA$ZGlnZXN0A',
+    'pbkdf2_sha256$many$c2FsdA$ZGlnZXN0',
+    'pbkdf2_sha256$0$c2FsdA$ZGlnZXN0',
+    'pbkdf2_sha256$1000$c2Fs*A$ZGlnZXN0',
+]
+
+
+@pytest.mark.parametrize('encoded', CORRUPT)
+def test_corrupt_hash_is_rejected_and_logged(encoded, caplog):
+    with caplog.at_level(logging.ERROR, logger='aurora.password'):
+        assert verify_password('password', encoded, 'a@example.com') is False
+    [record] = caplog.records
+    assert record.event == 'password.corrupt_hash' and record.email == 'a@example.com'
+    assert encoded not in record.getMessage()
+
+
+@pytest.mark.parametrize('encoded', ['', 'scrypt$1$2', 'bcrypt$12$abc', 'x' * 31])
+def test_unknown_format_is_rejected(encoded):
+    assert verify_password('password', encoded) is False
+
+
+def test_pool_verify(hasher, caplog):
+    encoded = hasher.hash('correct horse')
+    assert not hasher.needs_rehash(encoded)
+    assert hasher.verify('correct horse', encoded)
+    assert not hasher.verify('wrong horse', encoded)
+    # 损坏的哈希在子进程中抛出，由父进程记录日志
+    with caplog.at_level(logging.ERROR, logger='aurora.password'):
+        assert hasher.verify('password', CORRUPT[0], 'a@example.com') is False
+    assert [r.event for r in caplog.records] == ['password.corrupt_hash']
+
+
+def test_pool_verify_async(hasher):
+    encoded = hasher.hash('correct horse')
+
+    async def run():
+        return (await hasher.verify_async('correct horse', encoded),
+                await hasher.verify_async('password', CORRUPT[4], 'a@example.com'))
+
+    assert asyncio.run(run()) == (True, False)
@@ -0,0 +1,107 @@
+import fakeredis
+import pytest
+from main import check_config
+from session_tokens import TokenService, issue_token, verify_token
+
+KEYS = {'k1': 'secret-one', 'k2': 'secret-two'}
+NOW = 1_700_000_000
+
+
+def test_round_trip():
+    token, expires_at = issue_token('42', 'k1', KEYS['k1'], 3600, now=NOW)
+    status, claims = verify_token(token, KEYS, now=NOW + 10)
+    assert status == 'valid'
+    assert claims['uuid'] == '42' and claims['kid'] == 'k1'
+    assert claims['iat'] == NOW and claims['exp'] == expires_at == NOW + 3600
+
+
+def test_rotated_key_still_verifies():
+    token, _ = issue_token('42', 'k2', KEYS['k2'], 3600, now=NOW)
+    assert verify_token(token, KEYS, now=NOW)[0] == 'valid'
+
+
+@pytest.mark.parametrize('field', [1, 3, 5])
+def test_tampered_token(field):
+    token, _ = issue_token('42', 'k1', KEYS['k1'], 3600, now=NOW)
+    parts = token.split('.')
+    # 改动用户ID、过期时间或签名本身都会使签名不匹配
+    parts[field] = parts[field][:-1] + ('0' if parts[field][-1] != '0' else '1')
+    assert verify_token('.'.join(parts), KEYS, now=NOW)[0] == 'bad_signature'
+
+
+def test_signed_with_other_secret():
+    token, _ = issue_token('42', 'k1', 'not-the-secret', 3600, now=NOW)
+    assert verify_token(token, KEYS, now=NOW)[0] == 'bad_signature'
+
+
+def test_expired():
+    token, expires_at = issue_token('42', 'k1', KEYS['k1'], 60, now=NOW)
+    status, claims = verify_token(token, KEYS, now=expires_at)
+    assert status == 'expired' and claims['uuid'] == '42'
+
+
+def test_unknown_key_id():
+    token, _ = issue_token('42', 'k9', 'retired-secret', 3600, now=NOW)
+    assert verify_token(token, KEYS, now=NOW) == ('unknown_key', None)
+
+
+@pytest.mark.parametrize('token', [
+    None,
+    '',
+    'not-a-token',
+    'k1.42.1.2.abc',
+    'k1.42.x.2.abc.sig',
+    'k1.42.1.2.abc.签名',
+    'k1.42.1.2.abc.sigé',
+])
+def test_malformed(token):
+    assert verify_token(token, KEYS, now=NOW) == ('malformed', None)
+
+
+def make_service(**overrides):
+    config = dict({'active_key': 'k1', 'keys': KEYS, 'ttl': 3600, 'revocation_refresh': 0}, **overrides)
+    return TokenService(config, fakeredis.FakeRedis(decode_responses=True))
+
+
+def test_service_issue_and_verify():
+    service = make_service()
+    token, _ = service.issue('7')
+    status, claims = service.verify(token)
+    assert status == 'valid' and claims['uuid'] == '7'
+
+
+def test_revoke_then_verify():
+    service = make_service()
+    token, _ = service.issue('7')
+    _, claims = service.verify(token)
+    service.revoke(claims)
+    assert service.verify(token)[0] == 'revoked'
+
+
+def test_revocation_seen_by_other_process():
+    service = make_service()
+    other = TokenService(dict(active_key='k1', keys=KEYS, revocation_refresh=0), service.redis_client)
+    token, _ = service.issue('7')
+    assert other.verify(token)[0] == 'valid'
+    service.revoke(service.verify(token)[1])
+    assert other.verify(token)[0] == 'revoked'
+
+
+def test_service_disabled_without_key():
+    service = make_service(active_key='k3')
+    assert not service.enabled
+    assert service.issue('7') == (None, None)
+    assert not make_service(enabled=False).enabled
+
+
+def base_config(tokens):
+    return {'redis': {}, 'smtp': {}, 'app': {}, 'tokens': tokens}
+
+
+def test_check_config_rejects_enabled_tokens_without_key():
+    with pytest.raises(SystemExit):
+        check_config(base_config({'enabled': True, 'active_key': 'k1', 'keys': {}}))
+    with pytest.raises(SystemExit):
+        check_config(base_config({'enabled': True, 'active_key': 'k1', 'keys': {'k1': ''}}))
+    check_config(base_config({'enabled': True, 'active_key': 'k1', 'keys': KEYS}))
+    check_config(base_config({}))
@@ -0,0 +1,78 @@
+import pytest
+from password_hasher import hash_password
+from user_codec import (RECORD_FIELDS, decode_mapping, decode_record, encode_record, pack_password, pack_type,
+                        unpack_password, unpack_type)
+
+PARAMS = {'scrypt_n': 1024, 'scrypt_r': 8, 'scrypt_p': 1, 'pbkdf2_iterations': 1000}
+EMAIL = 'alice@example.com'
+
+
+@pytest.mark.parametrize('encoded', [
+    '5f4dcc3b5aa765d61d8327deb882cf99',
+    hash_password('password', 'scrypt', PARAMS),
+    hash_password('password', 'pbkdf2_sha256', PARAMS),
+])
+def test_pack_round_trip(encoded):
+    packed = pack_password(encoded)
+    assert isinstance(packed, bytes) and packed[:1] != b'\x00'
+    assert len(packed) < len(encoded)
+    assert unpack_password(packed) == encoded
+
+
+@pytest.mark.parametrize('encoded', [
+    # 非2的幂的N、带填充的base64、未知格式都无法无损打包，按原样存储
+    'scrypt$1000$8$1$c2FsdHNhbHRzYWx0c2FsdA$ZGlnZXN0',
+    'pbkdf2_sha256$1000$c2FsdA==$ZGlnZXN0',
+    'scrypt$abc$8$1$c2FsdA$ZGlnZXN0',
+    'bcrypt$2b$12$abcdefghijklmnopqrstuv',
+    '密码哈希',
+])
+def test_unpackable_hash_is_stored_raw(encoded):
+    packed = pack_password(encoded)
+    assert packed[:1] == b'\x00'
+    assert unpack_password(packed) == encoded
+
+
+def test_empty_password():
+    assert pack_password('') == b''
+    assert unpack_password(b'') == '' and unpack_password(None) == ''
+
+
+def test_unpack_requires_bytes():
+    with pytest.raises(ValueError):
+        unpack_password('\x01abc')
+
+
+def test_type_codes():
+    for name in ('md5', 'scrypt', 'pbkdf2_sha256', 'system_generated', 'user_set'):
+        assert len(pack_type(name)) == 1 and unpack_type(pack_type(name).encode('utf-8')) == name
+    assert unpack_type(pack_type('argon2')) == 'argon2'
+
+
+def values(**fields):
+    return [fields.get(name) for name in RECORD_FIELDS]
+
+
+def test_decode_standard_and_compact():
+    record = {'uuid': '7', 'username': 'alice', 'password': hash_password('pw', 'scrypt', PARAMS),
+              'password_type': 'scrypt'}
+    standard = encode_record(EMAIL, record, 'standard')
+    compact = encode_record(EMAIL, record, 'compact')
+    # 用户名与邮箱前缀相同时 compact 格式不存储
+    assert 'n' not in compact
+    assert decode_mapping(EMAIL, standard) == record
+    assert decode_mapping(EMAIL, {k.encode(): v if isinstance(v, bytes) else v.encode()
+                                  for k, v in compact.items()}) == record
+
+
+def test_decode_mixed_record_prefers_compact_fields():
+    packed = pack_password(hash_password('new', 'pbkdf2_sha256', PARAMS))
+    # 迁移过程中密码已写为 compact 字段，其余仍是 standard 字段
+    decoded = decode_record(EMAIL, values(uuid=b'7', username=b'al', password=b'5f4dcc3b5aa765d61d8327deb882cf99',
+                                          password_type=b'md5', p=packed, t=b'k'))
+    assert decoded == {'uuid': '7', 'username': 'al', 'password': unpack_password(packed),
+                       'password_type': 'pbkdf2_sha256'}
+
+    decoded = decode_record(EMAIL, values(i=b'8', password='legacy', password_type='user_set'))
+    assert decoded == {'uuid': '8', 'username': 'alice', 'password': 'legacy', 'password_type': 'user_set'}
+    assert decode_record(EMAIL, values(username='orphan')) is None
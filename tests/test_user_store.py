@@ -0,0 +1,163 @@
+import threading
+import time
+import fakeredis
+import pytest
+from user_store import MemoryUserStore, SQLiteUserStore, create_user_store
+
+DOMAIN = "conformance.invalid"
+
+# 各用例使用的限流参数，按需覆盖
+BASE_LIMITS = {
+    'window': 60,
+    'email_limit': 100,
+    'ip_limit': 1000,
+    'cooldown': 0,
+    'code_ttl': 30,
+    'max_code_attempts': 3
+}
+
+# redis 后端的两种用户记录格式都需要通过同一组用例
+BACKENDS = ['memory', 'sqlite', 'redis-standard', 'redis-compact']
+
+
+@pytest.fixture(params=BACKENDS)
+def make_store(request, tmp_path):
+    stores = []
+    # compact 格式的密码字段是二进制，与服务一样以 decode_responses=False 连接
+    redis_client = fakeredis.FakeRedis(decode_responses=request.param == 'redis-standard')
+
+    def make(**overrides):
+        limits = dict(BASE_LIMITS, **overrides)
+        if request.param == 'memory':
+            store = MemoryUserStore(limits)
+        elif request.param == 'sqlite':
+            store = SQLiteUserStore(str(tmp_path / f"{len(stores)}.db"), limits)
+        else:
+            user_format = request.param.split('-')[1]
+            config = {'rate_limit': limits, 'redis': {}, 'user_storage': {'format': user_format}}
+            store = create_user_store(config, redis_client)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        if isinstance(store, SQLiteUserStore):
+            store.close()
+
+
+def register(store, label, password_hash='hash-1', client_ip='10.0.0.1'):
+    email = f"{label}@{DOMAIN}"
+    status, code = store.send_verification_code(email, client_ip, '123456')
+    assert status == 'send'
+    assert store.login_with_code(email, code, label)[0] == 'needs_password'
+    status, user_info = store.login_with_code(email, code, label, password_hash, 'scrypt')
+    assert status == 'registered'
+    return email, user_info
+
+
+def test_register_and_login(make_store):
+    store = make_store()
+    email, user_info = register(store, 'alice')
+    assert user_info['username'] == 'alice'
+
+    status, code = store.send_verification_code(email, '10.0.0.1', '654321')
+    assert (status, code) == ('send', '654321')
+    status, again = store.login_with_code(email, code, 'alice')
+    assert status == 'login' and again['uuid'] == user_info['uuid']
+    assert store.login_with_code(email, code, 'alice')[0] == 'no_code'
+
+
+def test_bad_code_invalidates_after_max_attempts(make_store):
+    store = make_store(max_code_attempts=3)
+    email = f"bad@{DOMAIN}"
+    status, code = store.send_verification_code(email, '10.0.0.1', '111111')
+    assert status == 'send'
+    assert store.login_with_code(email, '000000', 'bad')[0] == 'bad_code'
+    assert store.login_with_code(email, '000000', 'bad')[0] == 'bad_code'
+    assert store.login_with_code(email, '000000', 'bad')[0] == 'code_invalidated'
+    assert store.login_with_code(email, code, 'bad')[0] == 'no_code'
+
+
+def test_valid_code_is_reused(make_store):
+    store = make_store()
+    email = f"reuse@{DOMAIN}"
+    first = store.send_verification_code(email, '10.0.0.1', '222222')
+    second = store.send_verification_code(email, '10.0.0.1', '333333')
+    assert first == second == ('send', '222222')
+
+
+def test_cooldown(make_store):
+    store = make_store(cooldown=60)
+    email = f"cooldown@{DOMAIN}"
+    assert store.send_verification_code(email, '10.0.0.1', '444444')[0] == 'send'
+    status, retry = store.send_verification_code(email, '10.0.0.1', '444444')
+    assert status == 'cooldown' and 1 <= retry <= 60
+
+
+def test_email_limit(make_store):
+    store = make_store(email_limit=2)
+    email = f"email-limit@{DOMAIN}"
+    for _ in range(2):
+        assert store.send_verification_code(email, '10.0.0.1', '555555')[0] == 'send'
+    status, retry = store.send_verification_code(email, '10.0.0.1', '555555')
+    assert status == 'limited' and 1 <= retry <= 60
+
+
+def test_ip_limit(make_store):
+    store = make_store(ip_limit=2)
+    for i in range(2):
+        assert store.send_verification_code(f"ip-limit-{i}@{DOMAIN}", '10.0.0.2', '666666')[0] == 'send'
+    other = f"ip-limit-2@{DOMAIN}"
+    assert store.send_verification_code(other, '10.0.0.2', '666666')[0] == 'limited'
+    # 被限流的请求不占用邮箱窗口，也不生成验证码
+    assert store.login_with_code(other, '666666', 'x')[0] == 'no_code'
+
+
+def test_code_expires(make_store):
+    store = make_store(code_ttl=1)
+    email = f"ttl@{DOMAIN}"
+    status, code = store.send_verification_code(email, '10.0.0.1', '777777')
+    assert status == 'send'
+    time.sleep(1.2)
+    assert store.login_with_code(email, code, 'ttl')[0] == 'no_code'
+
+
+def test_update_password(make_store):
+    store = make_store()
+    email, user_info = register(store, 'bob', 'hash-old')
+    credentials = store.get_credentials(email)
+    assert credentials['uuid'] == user_info['uuid'] and credentials['password'] == 'hash-old'
+    assert store.update_password(email, 'hash-old', 'hash-new', 'pbkdf2_sha256')
+    assert not store.update_password(email, 'hash-old', 'hash-other', 'pbkdf2_sha256')
+    credentials = store.get_credentials(email)
+    assert (credentials['password'], credentials['password_type']) == ('hash-new', 'pbkdf2_sha256')
+    assert store.get_credentials(f"missing@{DOMAIN}") is None
+
+
+def test_lookup(make_store):
+    store = make_store()
+    first, first_info = register(store, 'carol')
+    second, second_info = register(store, 'dave')
+    records = store.lookup_users([first, f"missing@{DOMAIN}", second], 'email')
+    assert records[1] is None and records[0]['uuid'] == first_info['uuid']
+    assert records[2]['email'] == second and 'password' not in records[2]
+    records = store.lookup_users([second_info['uuid'], first_info['uuid']], 'uuid')
+    assert [r['email'] for r in records] == [second, first]
+
+
+def test_allocate_id_is_unique_across_threads(make_store):
+    store = make_store()
+    allocated = []
+    lock = threading.Lock()
+
+    def worker():
+        ids = [store.allocate_id() for _ in range(200)]
+        with lock:
+            allocated.extend(ids)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(allocated)) == len(allocated) == 800
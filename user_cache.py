@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from metrics import metrics
+from redis_factory import primary_clients
+from redis_keys import USER_PREFIX, email_from_user_key
+
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+DEFAULT_USER_CACHE = {
+    'enabled': False,
+    'max_size': 10000,
+    'ttl': 60,
+    'ping_interval': 30
+}
+
+logger = logging.getLogger('aurora.user_cache')
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class UserCache:
+    """进程内的用户记录LRU缓存，通过 CLIENT TRACKING 的 BCAST 模式接收 user: 前缀的失效通知，TTL作为兜底
+
+    集群模式下每个主节点各有一条通知连接，任一连接断开期间缓存不提供命中，重新订阅后清空缓存再恢复
+    """
+
+    def __init__(self, redis_client, cache_config=None, prefix=USER_PREFIX):
+        config = dict(DEFAULT_USER_CACHE)
+        config.update(cache_config or {})
+        self.redis_client = redis_client
+        self.max_size = config['max_size']
+        self.ttl = config['ttl']
+        self.ping_interval = config['ping_interval']
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 每次失效都递增，读Redis期间发生过失效的结果不写入缓存
+        self._generation = 0
+        self._tracking = False
+        self._nodes = primary_clients(redis_client)
+        self._live_nodes = set()
+        for index, node_client in enumerate(self._nodes):
+            threading.Thread(target=self._listen_forever, args=(index, node_client), daemon=True).start()
+
+    def get(self, email, loader):
+        """命中时返回缓存的副本，否则调用 loader 读取并在跟踪正常时写入缓存"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(email) if self._tracking else None
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(email)
+                self.hits += 1
+                metrics.inc('aurora_user_cache_total', result='hit')
+                return dict(entry[1])
+            generation = self._generation
+            self.misses += 1
+        metrics.inc('aurora_user_cache_total', result='miss')
+
+        record = loader(email)
+        if record is None:
+            return None
+        with self._lock:
+            if self._tracking and generation == self._generation:
+                self._entries[email] = (now + self.ttl, dict(record))
+                self._entries.move_to_end(email)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return record
+
+    def invalidate(self, email):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _on_invalidate(self, keys):
+        if keys is None:
+            # FLUSHDB / FLUSHALL 时通知中不带key
+            self.clear()
+            return
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                key = _to_str(key)
+                if key.startswith(self.prefix):
+                    self._entries.pop(email_from_user_key(key), None)
+
+    def _set_live(self, index, live):
+        with self._lock:
+            if live:
+                self._live_nodes.add(index)
+            else:
+                self._live_nodes.discard(index)
+            self._tracking = len(self._live_nodes) == len(self._nodes)
+
+    def _listen_forever(self, index, node_client):
+        while True:
+            try:
+                self._listen(index, node_client)
+            except Exception:
+                logger.warning("用户缓存失效通知连接中断，稍后重连", exc_info=True,
+                               extra={'event': 'user_cache.disconnected'})
+            self._set_live(index, False)
+            time.sleep(1)
+
+    def _listen(self, index, node_client):
+        connection = node_client.connection_pool.make_connection()
+        try:
+            connection.connect()
+            connection.send_command('CLIENT', 'ID')
+            client_id = connection.read_response()
+            # RESP2 下失效通知只能发往订阅了 __redis__:invalidate 的连接，这里重定向到自身
+            connection.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id,
+                                    'BCAST', 'PREFIX', self.prefix)
+            connection.read_response()
+            connection.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+            connection.read_response()
+
+            self.clear()
+            self._set_live(index, True)
+            logger.info("用户缓存已开始接收失效通知", extra={'event': 'user_cache.tracking'})
+
+            last_activity = time.monotonic()
+            while True:
+                if not connection.can_read(timeout=1):
+                    if time.monotonic() - last_activity >= self.ping_interval:
+                        # 订阅状态下PING的回复是 ['pong', '']，redis-py 的健康检查会当作错误断开连接，
+                        # 与 PubSub 一样发送时跳过健康检查，回复作为普通消息忽略
+                        connection.send_command('PING', check_health=False)
+                        last_activity = time.monotonic()
+                    continue
+                message = connection.read_response()
+                last_activity = time.monotonic()
+                if message and _to_str(message[0]) == 'message':
+                    self._on_invalidate(message[2])
+        finally:
+            connection.disconnect()
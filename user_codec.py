@@ -0,0 +1,138 @@
+import base64
+import struct
+
+# 用户哈希有两种字段布局，读取时逐字段合并，迁移过程中新旧字段混存的记录也能正确读取
+# standard: uuid / username / password / password_type，均为字符串
+# compact:  i / n / p / t，密码哈希打包为二进制，用户名与邮箱前缀相同时不存储
+FORMATS = ('standard', 'compact')
+STANDARD_FIELDS = ('uuid', 'username', 'password', 'password_type')
+COMPACT_FIELDS = ('i', 'n', 'p', 't')
+RECORD_FIELDS = STANDARD_FIELDS + COMPACT_FIELDS
+
+# password_type 记录密码哈希算法；system_generated / user_set 是旧版本写入的来源标记，仅为读取旧记录保留
+TYPE_CODES = {
+    'system_generated': 'g',
+    'user_set': 'u',
+    'md5': 'm',
+    'scrypt': 's',
+    'pbkdf2_sha256': 'k'
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+_RAW, _MD5, _SCRYPT, _PBKDF2 = b'\x00', b'\x01', b'\x02', b'\x03'
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def default_username(email):
+    return email.split('@')[0]
+
+
+def _pack(encoded):
+    parts = encoded.split('$')
+    if len(encoded) == 32 and '$' not in encoded:
+        return _MD5 + bytes.fromhex(encoded)
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        salt = _b64decode(parts[4])
+        return _SCRYPT + struct.pack('>BBBB', n.bit_length() - 1, r, p, len(salt)) + salt + _b64decode(parts[5])
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        salt = _b64decode(parts[2])
+        return _PBKDF2 + struct.pack('>IB', int(parts[1]), len(salt)) + salt + _b64decode(parts[3])
+    return _RAW + encoded.encode('utf-8')
+
+
+def unpack_password(value):
+    if not value:
+        return ''
+    if isinstance(value, str):
+        # 客户端开启了 decode_responses 时无法读取二进制字段
+        raise ValueError("compact 格式需要 redis.decode_responses 为 false")
+    tag, body = value[:1], value[1:]
+    if tag == _MD5:
+        return body.hex()
+    if tag == _SCRYPT:
+        log_n, r, p, salt_len = struct.unpack('>BBBB', body[:4])
+        salt, digest = body[4:4 + salt_len], body[4 + salt_len:]
+        return f"scrypt${1 << log_n}${r}${p}${_b64encode(salt)}${_b64encode(digest)}"
+    if tag == _PBKDF2:
+        iterations, salt_len = struct.unpack('>IB', body[:5])
+        salt, digest = body[5:5 + salt_len], body[5 + salt_len:]
+        return f"pbkdf2_sha256${iterations}${_b64encode(salt)}${_b64encode(digest)}"
+    return body.decode('utf-8')
+
+
+def pack_password(encoded):
+    """打包为二进制，无法无损还原的格式（例如非2的幂的scrypt参数或带填充的base64）按原样存储"""
+    if not encoded:
+        return b''
+    try:
+        packed = _pack(encoded)
+        if unpack_password(packed) == encoded:
+            return packed
+    except (ValueError, struct.error):
+        pass
+    return _RAW + encoded.encode('utf-8')
+
+
+def pack_type(password_type):
+    return TYPE_CODES.get(password_type, password_type)
+
+
+def unpack_type(value):
+    value = _to_str(value)
+    return TYPE_NAMES.get(value, value)
+
+
+def encode_record(email, record, user_format):
+    """生成HSET使用的字段映射，record 包含 uuid / username / password / password_type"""
+    username = record.get('username') or default_username(email)
+    if user_format != 'compact':
+        return {
+            'uuid': record['uuid'],
+            'username': username,
+            'password': record.get('password') or '',
+            'password_type': record.get('password_type') or ''
+        }
+    mapping = {
+        'i': record['uuid'],
+        'p': pack_password(record.get('password') or ''),
+        't': pack_type(record.get('password_type') or '')
+    }
+    if username != default_username(email):
+        mapping['n'] = username
+    return mapping
+
+
+def decode_record(email, values):
+    """values 为按 RECORD_FIELDS 顺序HMGET的结果，用户不存在时返回 None"""
+    uuid, username, password, password_type, i, n, p, t = values
+    if i is None and uuid is None:
+        return None
+    return {
+        'uuid': _to_str(i if i is not None else uuid),
+        'username': _to_str(n if n is not None else username) or default_username(email),
+        'password': unpack_password(p) if p is not None else (_to_str(password) or ''),
+        'password_type': unpack_type(t) if t is not None else (_to_str(password_type) or '')
+    }
+
+
+def decode_mapping(email, fields):
+    """解码HGETALL的结果"""
+    fields = {_to_str(k): v for k, v in fields.items()}
+    return decode_record(email, [fields.get(name) for name in RECORD_FIELDS])
+
+
+def other_fields(user_format):
+    """写入某种格式时需要删除的另一种格式的字段"""
+    return STANDARD_FIELDS if user_format == 'compact' else COMPACT_FIELDS
@@ -0,0 +1,125 @@
+import hmac
+from redis_keys import user_uuid_key
+from user_codec import RECORD_FIELDS, decode_record
+
+LOOKUP_FIELDS = ('uuid', 'username', 'password_type')
+
+DEFAULT_LOOKUP = {
+    'batch_size': 500,
+    'max_items': 10000,
+    'stream_threshold': 1000,
+    'api_key': ''
+}
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def lookup_config(config):
+    merged = dict(DEFAULT_LOOKUP)
+    merged.update(config or {})
+    return merged
+
+
+def is_authorized(config, api_key):
+    """未配置 api_key 时拒绝所有请求，避免默认配置下任何人都能用uuid换出邮箱"""
+    # 按字节比较，compare_digest 不接受含非ASCII字符的str
+    return bool(config['api_key']) and hmac.compare_digest((api_key or '').encode('utf-8'),
+                                                           str(config['api_key']).encode('utf-8'))
+
+
+def _pack(email, values):
+    # 两种存储格式的字段都读取，由 user_codec 合并，响应中不包含密码哈希
+    decoded = decode_record(email, values)
+    if decoded is None:
+        return None
+    record = {field: decoded[field] for field in LOOKUP_FIELDS}
+    record['email'] = email
+    return record
+
+
+def _queue_hmget(pipe, keys, emails):
+    for email in emails:
+        if email:
+            pipe.hmget(keys.user_key(email), RECORD_FIELDS)
+
+
+def _collect(emails, results):
+    results = iter(results)
+    return [_pack(email, next(results)) if email else None for email in emails]
+
+
+def lookup_by_email(redis_client, keys, emails):
+    """一个管道批量HMGET，按输入顺序返回用户记录，不存在的用户为 None，keys 为 redis_keys.KeyBuilder"""
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_hmget(pipe, keys, emails)
+    return _collect(emails, pipe.execute())
+
+
+def _queue_get(pipe, user_ids):
+    # 索引key分布在不同的槽，使用管道GET代替MGET，集群模式下按节点分组发送
+    for user_id in user_ids:
+        pipe.get(user_uuid_key(user_id))
+
+
+def lookup_by_uuid(redis_client, keys, user_ids):
+    """先用一个管道通过 user_uuid 索引换出邮箱，再批量HMGET"""
+    if not user_ids:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_get(pipe, user_ids)
+    emails = [_to_str(e) for e in pipe.execute()]
+    return lookup_by_email(redis_client, keys, emails)
+
+
+def iter_lookup(user_store, identifiers, by, batch_size):
+    """分批查询并逐条产出 (查询值, 用户记录)，任何时刻只保留一个批次的结果"""
+    for start in range(0, len(identifiers), batch_size):
+        batch = identifiers[start:start + batch_size]
+        yield from zip(batch, user_store.lookup_users(batch, by))
+
+
+async def lookup_by_email_async(redis_client, keys, emails):
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_hmget(pipe, keys, emails)
+    return _collect(emails, await pipe.execute())
+
+
+async def lookup_by_uuid_async(redis_client, keys, user_ids):
+    if not user_ids:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    _queue_get(pipe, user_ids)
+    emails = [_to_str(e) for e in await pipe.execute()]
+    return await lookup_by_email_async(redis_client, keys, emails)
+
+
+async def iter_lookup_async(user_store, identifiers, by, batch_size):
+    for start in range(0, len(identifiers), batch_size):
+        batch = identifiers[start:start + batch_size]
+        for item in zip(batch, await user_store.lookup_users(batch, by)):
+            yield item
+
+
+def parse_lookup_request(data, config):
+    """校验请求体，返回 (错误信息, 查询类型, 查询值列表)"""
+    if not isinstance(data, dict):
+        return '请求数据无效', None, None
+    emails = data.get('emails')
+    user_ids = data.get('uuids')
+    if (emails is None) == (user_ids is None):
+        return '必须且只能提供 emails 或 uuids 之一', None, None
+
+    by, identifiers = ('email', emails) if emails is not None else ('uuid', user_ids)
+    if not isinstance(identifiers, list):
+        return f'{by}s 必须为列表', None, None
+    if len(identifiers) > config['max_items']:
+        return f"单次最多查询 {config['max_items']} 个用户", None, None
+    if by == 'uuid':
+        identifiers = [str(i) for i in identifiers]
+        if not all(i.isdigit() for i in identifiers):
+            return 'uuid 必须为数字', None, None
+    elif not all(isinstance(e, str) and e for e in identifiers):
+        return '邮箱必须为非空字符串', None, None
+    return None, by, identifiers
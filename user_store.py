@@ -0,0 +1,398 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from auth_scripts import DEFAULT_ID_BLOCK_SIZE, DEFAULT_RATE_LIMIT, AuthScripts
+from redis_keys import key_builder
+
+# 用户记录、带过期时间的验证码和用户ID分配的存储接口，路由只依赖以下方法，各后端语义一致：
+#   send_verification_code(email, client_ip, new_code) -> (send, 验证码) / (cooldown, 秒数) / (limited, 秒数)
+#   login_with_code(email, code, username, password_hash='', password_type='') -> (状态, 用户信息)
+#   get_credentials(email) -> uuid / username / password / password_type，用户不存在时为 None
+#   update_password(email, old_hash, new_hash, password_type) -> 旧密码未被并发修改时写入并返回 True
+#   lookup_users(identifiers, by) -> 按输入顺序返回的用户记录，不存在的为 None
+#   allocate_id() -> 新用户ID
+# redis 为默认后端（AuthScripts），memory 只在单个进程内有效，sqlite 可供同一台机器上的多个worker共享
+USER_STORE_BACKENDS = ('redis', 'memory', 'sqlite')
+
+DEFAULT_SQLITE_PATH = './aurora.db'
+
+# 过期的验证码、冷却标记和限流记录在访问时判断，另外每隔一段时间整体清理一次
+PURGE_INTERVAL = 60
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL,
+    password_type TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verification_codes (
+    email TEXT PRIMARY KEY,
+    code TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS send_cooldowns (
+    email TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_events (
+    bucket TEXT NOT NULL,
+    sent_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_events_bucket ON rate_events (bucket, sent_at);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# 语句文本固定，sqlite3 按连接缓存编译后的语句，重复执行时不再解析SQL
+SELECT_USER = "SELECT uuid, username, password, password_type FROM users WHERE email = ?"
+SELECT_USER_BY_UUID = "SELECT email, uuid, username, password_type FROM users WHERE uuid = ?"
+SELECT_LOOKUP = "SELECT email, uuid, username, password_type FROM users WHERE email = ?"
+INSERT_USER = "INSERT INTO users (email, uuid, username, password, password_type) VALUES (?, ?, ?, ?, ?)"
+UPDATE_PASSWORD = ("UPDATE users SET password = ?, password_type = ? "
+                   "WHERE email = ? AND password = ?")
+SELECT_CODE = "SELECT code, expires_at, attempts FROM verification_codes WHERE email = ?"
+UPSERT_CODE = ("INSERT INTO verification_codes (email, code, expires_at, attempts) VALUES (?, ?, ?, 0) "
+               "ON CONFLICT (email) DO UPDATE SET code = excluded.code, expires_at = excluded.expires_at, "
+               "attempts = 0")
+EXTEND_CODE = "UPDATE verification_codes SET expires_at = ? WHERE email = ?"
+INCREMENT_ATTEMPTS = "UPDATE verification_codes SET attempts = attempts + 1 WHERE email = ?"
+DELETE_CODE = "DELETE FROM verification_codes WHERE email = ?"
+SELECT_COOLDOWN = "SELECT expires_at FROM send_cooldowns WHERE email = ?"
+UPSERT_COOLDOWN = ("INSERT INTO send_cooldowns (email, expires_at) VALUES (?, ?) "
+                   "ON CONFLICT (email) DO UPDATE SET expires_at = excluded.expires_at")
+TRIM_WINDOW = "DELETE FROM rate_events WHERE bucket = ? AND sent_at <= ?"
+COUNT_WINDOW = "SELECT COUNT(*), MIN(sent_at) FROM rate_events WHERE bucket = ?"
+INSERT_EVENT = "INSERT INTO rate_events (bucket, sent_at) VALUES (?, ?)"
+INCREMENT_COUNTER = ("INSERT INTO counters (name, value) VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET value = value + 1")
+SELECT_COUNTER = "SELECT value FROM counters WHERE name = ?"
+
+USER_COUNTER = 'user_counter'
+
+
+def _limits(rate_limit_config):
+    limits = dict(DEFAULT_RATE_LIMIT)
+    limits.update(rate_limit_config or {})
+    return limits
+
+
+def _retry_seconds(seconds):
+    # 与Redis后端一致，剩余时间向上取整且至少为1秒
+    return max(1, math.ceil(seconds))
+
+
+def _lookup_record(email, uuid, username, password_type):
+    return {'uuid': uuid, 'username': username, 'password_type': password_type, 'email': email}
+
+
+class MemoryUserStore:
+    """进程内存储，所有操作在一把锁内完成，适合单进程部署、测试和基准
+
+    数据不跨进程共享也不持久化，prefork 多worker部署应使用 sqlite 或 redis
+    """
+
+    def __init__(self, rate_limit_config=None):
+        self.limits = _limits(rate_limit_config)
+        self._lock = threading.Lock()
+        self._users = {}
+        self._uuid_index = {}
+        # email -> [验证码, 过期时间, 错误次数]
+        self._codes = {}
+        self._cooldowns = {}
+        self._windows = {}
+        self._counter = 0
+        self._purged_at = time.time()
+
+    def _window_retry(self, bucket, now, limit):
+        """返回需要等待的秒数，未超限时返回 None，同时丢弃窗口外的记录"""
+        window = self.limits['window']
+        events = self._windows.get(bucket)
+        if events is None:
+            return None
+        while events and events[0] <= now - window:
+            events.popleft()
+        if len(events) >= limit:
+            return events[0] + window - now
+        return None
+
+    def _record(self, bucket, now):
+        self._windows.setdefault(bucket, deque()).append(now)
+
+    def _purge(self, now):
+        if now - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        window = self.limits['window']
+        self._codes = {email: entry for email, entry in self._codes.items() if entry[1] > now}
+        self._cooldowns = {email: until for email, until in self._cooldowns.items() if until > now}
+        self._windows = {bucket: events for bucket, events in self._windows.items()
+                         if events and events[-1] > now - window}
+
+    def send_verification_code(self, email, client_ip, new_code):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            ip_bucket, email_bucket = 'ip:' + client_ip, 'email:' + email
+            retry = self._window_retry(ip_bucket, now, self.limits['ip_limit'])
+            if retry is not None:
+                return 'limited', _retry_seconds(retry)
+
+            cooldown = self._cooldowns.get(email, 0) - now
+            if cooldown > 0:
+                return 'cooldown', _retry_seconds(cooldown)
+
+            retry = self._window_retry(email_bucket, now, self.limits['email_limit'])
+            if retry is not None:
+                return 'limited', _retry_seconds(retry)
+            self._record(ip_bucket, now)
+            self._record(email_bucket, now)
+
+            entry = self._codes.get(email)
+            if entry is None or entry[1] <= now:
+                # 验证码已过期时连同错误次数一起重置
+                entry = [new_code, 0, 0]
+                self._codes[email] = entry
+            entry[1] = now + self.limits['code_ttl']
+            if self.limits['cooldown'] > 0:
+                self._cooldowns[email] = now + self.limits['cooldown']
+            return 'send', entry[0]
+
+    def login_with_code(self, email, code, username, password_hash='', password_type=''):
+        now = time.time()
+        with self._lock:
+            entry = self._codes.get(email)
+            if entry is None or entry[1] <= now:
+                self._codes.pop(email, None)
+                return 'no_code', None
+            if entry[0] != code:
+                entry[2] += 1
+                if entry[2] >= self.limits['max_code_attempts']:
+                    del self._codes[email]
+                    return 'code_invalidated', None
+                return 'bad_code', None
+
+            user = self._users.get(email)
+            if user is not None:
+                del self._codes[email]
+                return 'login', {'uuid': user['uuid'], 'username': user['username']}
+            if not password_hash:
+                return 'needs_password', None
+
+            del self._codes[email]
+            self._counter += 1
+            user = {'uuid': str(self._counter), 'username': username,
+                    'password': password_hash, 'password_type': password_type}
+            self._users[email] = user
+            self._uuid_index[user['uuid']] = email
+            return 'registered', {'uuid': user['uuid'], 'username': username}
+
+    def get_credentials(self, email):
+        with self._lock:
+            user = self._users.get(email)
+            return dict(user) if user is not None else None
+
+    def update_password(self, email, old_hash, new_hash, password_type):
+        with self._lock:
+            user = self._users.get(email)
+            if user is None or user['password'] != old_hash:
+                return False
+            user['password'] = new_hash
+            user['password_type'] = password_type
+            return True
+
+    def lookup_users(self, identifiers, by):
+        with self._lock:
+            if by == 'uuid':
+                emails = [self._uuid_index.get(user_id) for user_id in identifiers]
+            else:
+                emails = identifiers
+            records = []
+            for email in emails:
+                user = self._users.get(email) if email else None
+                records.append(_lookup_record(email, user['uuid'], user['username'], user['password_type'])
+                               if user is not None else None)
+            return records
+
+    def allocate_id(self):
+        with self._lock:
+            self._counter += 1
+            return str(self._counter)
+
+
+class SQLiteUserStore:
+    """SQLite存储，WAL模式下读不阻塞写，同一台机器上的多个worker进程可共享一个数据库文件
+
+    每个线程使用独立连接；读改写操作在 BEGIN IMMEDIATE 事务中执行，与Redis脚本一样是原子的
+    """
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, rate_limit_config=None, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.limits = _limits(rate_limit_config)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._purged_at = time.time()
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # isolation_level=None 关闭自动事务，由 _transaction 显式开始
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False, cached_statements=64)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def _window_retry(self, connection, bucket, now, limit):
+        window = self.limits['window']
+        connection.execute(TRIM_WINDOW, (bucket, now - window))
+        count, oldest = connection.execute(COUNT_WINDOW, (bucket,)).fetchone()
+        if count >= limit:
+            return oldest + window - now
+        return None
+
+    def _purge(self, connection, now):
+        if now - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        connection.execute("DELETE FROM verification_codes WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM send_cooldowns WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM rate_events WHERE sent_at <= ?", (now - self.limits['window'],))
+
+    def send_verification_code(self, email, client_ip, new_code):
+        now = time.time()
+        with self._transaction() as connection:
+            self._purge(connection, now)
+            ip_bucket, email_bucket = 'ip:' + client_ip, 'email:' + email
+            retry = self._window_retry(connection, ip_bucket, now, self.limits['ip_limit'])
+            if retry is not None:
+                return 'limited', _retry_seconds(retry)
+
+            row = connection.execute(SELECT_COOLDOWN, (email,)).fetchone()
+            if row is not None and row[0] > now:
+                return 'cooldown', _retry_seconds(row[0] - now)
+
+            retry = self._window_retry(connection, email_bucket, now, self.limits['email_limit'])
+            if retry is not None:
+                return 'limited', _retry_seconds(retry)
+            connection.execute(INSERT_EVENT, (ip_bucket, now))
+            connection.execute(INSERT_EVENT, (email_bucket, now))
+
+            row = connection.execute(SELECT_CODE, (email,)).fetchone()
+            expires_at = now + self.limits['code_ttl']
+            if row is not None and row[1] > now:
+                # 验证码仍有效时沿用并保留错误次数，否则连同错误次数一起重置
+                code = row[0]
+                connection.execute(EXTEND_CODE, (expires_at, email))
+            else:
+                code = new_code
+                connection.execute(UPSERT_CODE, (email, code, expires_at))
+            if self.limits['cooldown'] > 0:
+                connection.execute(UPSERT_COOLDOWN, (email, now + self.limits['cooldown']))
+            return 'send', code
+
+    def login_with_code(self, email, code, username, password_hash='', password_type=''):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(SELECT_CODE, (email,)).fetchone()
+            if row is None or row[1] <= now:
+                connection.execute(DELETE_CODE, (email,))
+                return 'no_code', None
+            stored, _, attempts = row
+            if stored != code:
+                if attempts + 1 >= self.limits['max_code_attempts']:
+                    connection.execute(DELETE_CODE, (email,))
+                    return 'code_invalidated', None
+                connection.execute(INCREMENT_ATTEMPTS, (email,))
+                return 'bad_code', None
+
+            user = connection.execute(SELECT_USER, (email,)).fetchone()
+            if user is not None:
+                connection.execute(DELETE_CODE, (email,))
+                return 'login', {'uuid': user[0], 'username': user[1]}
+            if not password_hash:
+                return 'needs_password', None
+
+            connection.execute(DELETE_CODE, (email,))
+            user_id = self._next_id(connection)
+            connection.execute(INSERT_USER, (email, user_id, username, password_hash, password_type))
+            return 'registered', {'uuid': user_id, 'username': username}
+
+    def get_credentials(self, email):
+        row = self._connection().execute(SELECT_USER, (email,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('uuid', 'username', 'password', 'password_type'), row))
+
+    def update_password(self, email, old_hash, new_hash, password_type):
+        with self._transaction() as connection:
+            cursor = connection.execute(UPDATE_PASSWORD, (new_hash, password_type, email, old_hash))
+            return cursor.rowcount == 1
+
+    def lookup_users(self, identifiers, by):
+        connection = self._connection()
+        statement = SELECT_USER_BY_UUID if by == 'uuid' else SELECT_LOOKUP
+        records = []
+        for identifier in identifiers:
+            row = connection.execute(statement, (identifier,)).fetchone() if identifier else None
+            records.append(_lookup_record(*row) if row is not None else None)
+        return records
+
+    def _next_id(self, connection):
+        connection.execute(INCREMENT_COUNTER, (USER_COUNTER,))
+        return str(connection.execute(SELECT_COUNTER, (USER_COUNTER,)).fetchone()[0])
+
+    def allocate_id(self):
+        with self._transaction() as connection:
+            return self._next_id(connection)
+
+
+def user_store_backend(config):
+    return config.get('user_storage', {}).get('backend', 'redis')
+
+
+def create_user_store(config, redis_client=None, user_cache=None):
+    """根据 user_storage.backend 创建存储，用户缓存只用于Redis后端"""
+    storage_config = config.get('user_storage', {})
+    backend = user_store_backend(config)
+    rate_limit_config = config.get('rate_limit', {})
+    if backend == 'memory':
+        return MemoryUserStore(rate_limit_config)
+    if backend == 'sqlite':
+        return SQLiteUserStore(storage_config.get('sqlite_path', DEFAULT_SQLITE_PATH), rate_limit_config,
+                               storage_config.get('sqlite_busy_timeout', 5))
+    redis_config = config.get('redis', {})
+    return AuthScripts(redis_client, rate_limit_config, user_cache,
+                       redis_config.get('id_block_size', DEFAULT_ID_BLOCK_SIZE),
+                       storage_config.get('format', 'standard'), key_builder(redis_config))
@@ -0,0 +1,441 @@
+import argparse
+import csv
+import hashlib
+import json
+import random
+import string
+import sys
+import time
+from clear_account import Throttle, iter_batches, load_config
+from password_hasher import hash_password, PasswordHasher
+from mail_queue import MAIL_DEAD_KEY, MAIL_DELAYED_KEY, MAIL_PROCESSING_KEY, MAIL_QUEUE_KEY
+from redis_factory import create_redis_client, is_cluster
+from redis_keys import USER_COUNTER_KEY, KeyBuilder, email_from_user_key, key_builder, user_uuid_key
+from user_codec import (COMPACT_FIELDS, FORMATS, RECORD_FIELDS, STANDARD_FIELDS, decode_mapping, encode_record,
+                        other_fields)
+
+USER_FIELDS = ['email', 'uuid', 'username', 'password', 'password_type']
+
+# 计数器只增不减，保证之后注册的用户不会拿到导入数据已占用的ID
+RAISE_COUNTER = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return current
+"""
+
+# KEYS[1] 用户哈希  ARGV[1] 当前密码所在字段  ARGV[2] 读取时的密码值  ARGV[3..] 新格式的字段和值
+# 读取之后密码被修改过的记录不覆盖，留给下一轮迁移处理
+CONVERT_RECORD = """
+if (redis.call('HGET', KEYS[1], ARGV[1]) or '') ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[1], 'uuid', 'username', 'password', 'password_type', 'i', 'n', 'p', 't')
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+MEMORY_PROBE_PREFIX = "memprobe:"
+
+
+def _to_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def load_tool_client(config_path):
+    """compact 格式的密码字段是二进制，工具始终以 decode_responses=False 连接
+
+    返回 (客户端, 用户存储格式, key布局)，key布局与服务使用同一份 redis 配置
+    """
+    config = load_config(config_path)
+    redis_config = config.get('redis', {})
+    redis_client = create_redis_client(dict(redis_config, decode_responses=False))
+    return redis_client, config.get('user_storage', {}).get('format', 'standard'), key_builder(redis_config)
+
+
+class Progress:
+    def __init__(self, label, interval=5.0):
+        self.label = label
+        self.interval = interval
+        self.count = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def add(self, count):
+        self.count += count
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        prefix = "完成" if final else "进行中"
+        print(f"[{self.label}] {prefix}: {self.count} 条记录，{self.count / elapsed:.0f} 条/秒",
+              file=sys.stderr)
+
+
+def open_output(path):
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def open_input(path):
+    if path == '-':
+        return sys.stdin
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+class RecordWriter:
+    def __init__(self, stream, fmt):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(stream, fieldnames=USER_FIELDS, extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self.writer.writerow(record)
+        else:
+            self.stream.write(json.dumps(record, ensure_ascii=False))
+            self.stream.write('\n')
+
+
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def chunked(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_users(redis_client, output, fmt, batch_size, scan_count):
+    writer = RecordWriter(output, fmt)
+    progress = Progress('导出')
+    for keys in iter_batches(redis_client, 'user:*', scan_count, batch_size):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        for key, fields in zip(keys, pipe.execute()):
+            email = email_from_user_key(_to_str(key))
+            record = decode_mapping(email, fields) if fields else None
+            if record is None:
+                continue
+            record['email'] = email
+            writer.write(record)
+        progress.add(len(keys))
+    progress.report(final=True)
+
+
+def import_users(redis_client, keys, records, batch_size, reassign_ids=False, skip_existing=False, user_format='standard'):
+    """按固定批次写入用户，缺少uuid的记录从 user_counter 按批次整块分配ID"""
+    progress = Progress('导入')
+    max_id = 0
+    for batch in chunked(records, batch_size):
+        if skip_existing:
+            pipe = redis_client.pipeline(transaction=False)
+            for record in batch:
+                pipe.exists(keys.user_key(record['email']))
+            batch = [record for record, exists in zip(batch, pipe.execute()) if not exists]
+            if not batch:
+                continue
+
+        needs_id = [record for record in batch if reassign_ids or not record.get('uuid')]
+        if needs_id:
+            last_id = redis_client.incrby(USER_COUNTER_KEY, len(needs_id))
+            for offset, record in enumerate(needs_id):
+                record['uuid'] = str(last_id - len(needs_id) + 1 + offset)
+
+        pipe = redis_client.pipeline(transaction=False)
+        for record in batch:
+            email = record['email']
+            pipe.hdel(keys.user_key(email), *other_fields(user_format))
+            pipe.hset(keys.user_key(email), mapping=encode_record(email, record, user_format))
+            pipe.set(user_uuid_key(record['uuid']), email)
+            if str(record['uuid']).isdigit():
+                max_id = max(max_id, int(record['uuid']))
+        pipe.execute()
+        progress.add(len(batch))
+
+    if max_id:
+        redis_client.eval(RAISE_COUNTER, 1, USER_COUNTER_KEY, max_id)
+    progress.report(final=True)
+
+
+def reindex_users(redis_client, batch_size, scan_count):
+    """为已有用户补建 uuid 到邮箱的索引"""
+    progress = Progress('重建索引')
+    for keys in iter_batches(redis_client, 'user:*', scan_count, batch_size):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'i', 'uuid')
+        user_ids = [values[0] or values[1] for values in pipe.execute()]
+        pipe = redis_client.pipeline(transaction=False)
+        for key, user_id in zip(keys, user_ids):
+            if user_id:
+                pipe.set(user_uuid_key(_to_str(user_id)), email_from_user_key(_to_str(key)))
+        pipe.execute()
+        progress.add(len(keys))
+    progress.report(final=True)
+
+
+def migrate_keys(redis_client, batch_size, scan_count):
+    """把旧格式的 user:email 和邮件队列key重命名为带哈希标签的格式，需在停服后、切换到集群之前于单节点上执行
+
+    迁移后服务需以 cluster 模式或 redis.hash_tags: true 启动，否则会按旧格式查找用户
+    """
+    if is_cluster(redis_client):
+        raise SystemExit("集群模式下无法跨槽重命名，请在迁移到集群之前执行")
+    tagged = KeyBuilder(hash_tags=True)
+    progress = Progress('迁移key')
+    for keys in iter_batches(redis_client, 'user:*', scan_count, batch_size):
+        legacy = [_to_str(key) for key in keys if not _to_str(key).endswith('}')]
+        pipe = redis_client.pipeline(transaction=False)
+        for key in legacy:
+            pipe.renamenx(key, tagged.user_key(email_from_user_key(key)))
+        pipe.execute(raise_on_error=False)
+        progress.add(len(legacy))
+
+    queue_keys = [('mail_queue', MAIL_QUEUE_KEY), ('mail_queue:delayed', MAIL_DELAYED_KEY),
+                  ('mail_queue:dead', MAIL_DEAD_KEY)]
+    for keys in iter_batches(redis_client, 'mail_queue:processing:*', scan_count, batch_size):
+        for key in keys:
+            key = _to_str(key)
+            queue_keys.append((key, MAIL_PROCESSING_KEY + key[len('mail_queue:processing'):]))
+    for old, new in queue_keys:
+        if redis_client.exists(old):
+            redis_client.renamenx(old, new)
+    progress.report(final=True)
+    print("迁移完成，请以 cluster 模式或设置 redis.hash_tags 为 true 后再启动服务", file=sys.stderr)
+
+
+def _password_field(fields):
+    """返回记录中当前密码所在的字段，compact 字段优先，与读取时的合并规则一致"""
+    return 'p' if b'p' in fields else 'password'
+
+
+def _convert_args(email, fields, user_format):
+    record = decode_mapping(email, fields)
+    password_field = _password_field(fields)
+    args = [password_field, fields.get(password_field.encode('utf-8'), b'')]
+    for name, value in encode_record(email, record, user_format).items():
+        args.extend([name, value])
+    return args
+
+
+def convert_users(redis_client, user_format, batch_size, scan_count, max_rate=None, dry_run=False):
+    """在线把用户记录改写为目标格式，每条记录用一次比较后写入的脚本，服务无需停机"""
+    progress = Progress('格式迁移')
+    throttle = Throttle(max_rate)
+    target_fields = set(COMPACT_FIELDS if user_format == 'compact' else STANDARD_FIELDS)
+    converted = skipped = conflicts = 0
+    for keys in iter_batches(redis_client, 'user:*', scan_count, batch_size):
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        pending = []
+        for key, fields in zip(keys, pipe.execute()):
+            names = {_to_str(name) for name in fields}
+            if not fields or not names & set(RECORD_FIELDS) - target_fields:
+                skipped += 1
+                continue
+            pending.append((key, _convert_args(email_from_user_key(_to_str(key)), fields, user_format)))
+
+        if pending and not dry_run:
+            pipe = redis_client.pipeline(transaction=False)
+            for key, args in pending:
+                pipe.eval(CONVERT_RECORD, 1, key, *args)
+            results = pipe.execute()
+            converted += sum(1 for r in results if r == 1)
+            conflicts += sum(1 for r in results if r != 1)
+        else:
+            converted += len(pending)
+        progress.add(len(keys))
+        throttle.wait(len(keys))
+    progress.report(final=True)
+    action = "需要迁移" if dry_run else "已迁移"
+    print(f"{action} {converted} 个用户，已是目标格式 {skipped} 个，并发修改跳过 {conflicts} 个", file=sys.stderr)
+
+
+def _sample_user_keys(redis_client, samples, scan_count):
+    keys = []
+    for batch in iter_batches(redis_client, 'user:*', scan_count, samples):
+        keys.extend(batch)
+        if len(keys) >= samples:
+            break
+    return keys[:samples]
+
+
+def memory_report(redis_client, samples, scan_count):
+    """抽样读取 MEMORY USAGE，并把样本按两种格式写入临时key测量，报告每个用户的平均字节数"""
+    keys = _sample_user_keys(redis_client, samples, scan_count)
+    if not keys:
+        print("没有找到用户记录")
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+        pipe.memory_usage(key, samples=0)
+    results = pipe.execute()
+    records = [(email_from_user_key(_to_str(key)), fields)
+               for key, fields in zip(keys, results[0::2]) if fields]
+    current = [usage for usage in results[1::2] if usage]
+
+    measured = {}
+    for user_format in FORMATS:
+        # 临时key与用户key使用相同的哈希标签，集群模式下写入同一个槽
+        pipe = redis_client.pipeline(transaction=False)
+        for email, fields in records:
+            probe_key = f"{MEMORY_PROBE_PREFIX}{{{email}}}"
+            pipe.delete(probe_key)
+            pipe.hset(probe_key, mapping=encode_record(email, decode_mapping(email, fields), user_format))
+            pipe.memory_usage(probe_key, samples=0)
+            pipe.delete(probe_key)
+        measured[user_format] = [usage for usage in pipe.execute()[2::4] if usage]
+
+    def average(values):
+        return sum(values) / len(values) if values else 0
+
+    standard, compact = average(measured['standard']), average(measured['compact'])
+    print(f"样本用户数: {len(records)}")
+    print(f"当前每用户: {average(current):.1f} 字节")
+    print(f"standard 格式每用户: {standard:.1f} 字节")
+    print(f"compact 格式每用户: {compact:.1f} 字节")
+    if standard:
+        saved = standard - compact
+        print(f"compact 每用户节省 {saved:.1f} 字节 ({saved / standard:.1%})，"
+              f"每百万用户约 {saved * 1_000_000 / 1024 / 1024:.1f} MiB")
+
+
+def write_records(output, fmt, records, batch_size):
+    writer = RecordWriter(output, fmt)
+    progress = Progress('生成')
+    for batch in chunked(records, batch_size):
+        for record in batch:
+            writer.write(record)
+        progress.add(len(batch))
+    progress.report(final=True)
+
+
+def generate_users(count, domain, password_hash, password_type, start=1):
+    """生成合成用户，所有用户共用一个预先计算的密码哈希，长度与真实数据一致"""
+    for i in range(start, start + count):
+        local = ''.join(random.choices(string.ascii_lowercase + string.digits, k=random.randint(6, 14)))
+        yield {
+            'email': f"{local}.{i}@{domain}",
+            'uuid': '',
+            'username': f"{local}.{i}",
+            'password': password_hash,
+            'password_type': password_type
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AuroraID 用户批量导入/导出与合成数据生成工具')
+    parser.add_argument('--config', default='./config.yml', help='配置文件路径')
+    parser.add_argument('--batch-size', type=int, default=1000, help='每个管道批次的记录数')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='以SCAN方式导出全部用户')
+    export_parser.add_argument('-o', '--output', default='-', help='输出文件，默认标准输出')
+    export_parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    export_parser.add_argument('--scan-count', type=int, default=1000)
+
+    import_parser = subparsers.add_parser('import', help='从NDJSON/CSV导入用户')
+    import_parser.add_argument('-i', '--input', default='-', help='输入文件，默认标准输入')
+    import_parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    import_parser.add_argument('--reassign-ids', action='store_true', help='忽略原有uuid，重新分配ID')
+    import_parser.add_argument('--skip-existing', action='store_true', help='跳过已存在的用户')
+
+    reindex_parser = subparsers.add_parser('reindex', help='为已有用户重建 uuid 索引')
+    reindex_parser.add_argument('--scan-count', type=int, default=1000)
+
+    migrate_parser = subparsers.add_parser('migrate-keys', help='将旧格式的key迁移为带哈希标签的格式')
+    migrate_parser.add_argument('--scan-count', type=int, default=1000)
+
+    convert_parser = subparsers.add_parser('compact', help='在线将用户记录改写为指定的存储格式')
+    convert_parser.add_argument('--to', choices=FORMATS, default='compact', help='目标格式，默认 compact')
+    convert_parser.add_argument('--scan-count', type=int, default=1000)
+    convert_parser.add_argument('--max-rate', type=float, help='每秒最多处理的key数量')
+    convert_parser.add_argument('--dry-run', action='store_true', help='只统计需要迁移的用户数')
+
+    report_parser = subparsers.add_parser('memory-report', help='抽样比较两种存储格式每个用户占用的内存')
+    report_parser.add_argument('--samples', type=int, default=1000, help='抽样的用户数')
+    report_parser.add_argument('--scan-count', type=int, default=1000)
+
+    generate_parser = subparsers.add_parser('generate', help='生成合成用户数据')
+    generate_parser.add_argument('-n', '--count', type=int, required=True)
+    generate_parser.add_argument('--domain', default='synthetic.invalid')
+    generate_parser.add_argument('-o', '--output', help='写入文件而不是Redis')
+    generate_parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    generate_parser.add_argument('--password-scheme', choices=['md5', 'scrypt', 'pbkdf2_sha256'], default='scrypt',
+                                 help='合成数据使用的密码哈希格式')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        if args.password_scheme == 'md5':
+            password_hash = hashlib.md5(b'synthetic-password').hexdigest()
+        else:
+            password_hash = hash_password('synthetic-password', args.password_scheme,
+                                          PasswordHasher({'scheme': args.password_scheme}).params)
+        records = generate_users(args.count, args.domain, password_hash, args.password_scheme)
+        if args.output:
+            output = open_output(args.output)
+            try:
+                write_records(output, args.format, records, args.batch_size)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+            return
+        redis_client, user_format, keys = load_tool_client(args.config)
+        import_users(redis_client, keys, records, args.batch_size, user_format=user_format)
+        return
+
+    redis_client, user_format, keys = load_tool_client(args.config)
+    if args.command == 'export':
+        output = open_output(args.output)
+        try:
+            export_users(redis_client, output, args.format, args.batch_size, args.scan_count)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    elif args.command == 'import':
+        stream = open_input(args.input)
+        try:
+            import_users(redis_client, keys, read_records(stream, args.format), args.batch_size,
+                         reassign_ids=args.reassign_ids, skip_existing=args.skip_existing, user_format=user_format)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+    elif args.command == 'migrate-keys':
+        migrate_keys(redis_client, args.batch_size, args.scan_count)
+    elif args.command == 'reindex':
+        reindex_users(redis_client, args.batch_size, args.scan_count)
+    elif args.command == 'compact':
+        convert_users(redis_client, args.to, args.batch_size, args.scan_count, args.max_rate, args.dry_run)
+    elif args.command == 'memory-report':
+        memory_report(redis_client, args.samples, args.scan_count)
+
+
+if __name__ == '__main__':
+    main()